@@ -1,21 +1,16 @@
 __version__ = "0.9.12"
 
-import io
 import sys
 if sys.version_info[0] < 3 and sys.version_info[1] < 6:
     raise ImportError("Visualize module requires Python3.6+!")
-from array import array
-from PIL import Image
-from cairo import Context, ImageSurface, FORMAT_A8, FORMAT_ARGB32
-from diffenator.constants import FTHintMode
-from freetype.raw import *
-import uharfbuzz as hb
-import os
+# The rendering stack (Cairo, PIL, FreeType and HarfBuzz) is imported
+# by diffenator.render when an image is requested. Keep it out of this
+# module so the CLIs start quickly.
+from itertools import islice
+import heapq
 import logging
-try:
-    from StringIO import StringIO
-except ImportError:  # py3 workaround
-    from io import BytesIO as StringIO
+import numbers
+import os
 if sys.version_info.major == 3:
     unicode = str
 
@@ -45,12 +40,29 @@ class Tbl:
         self.table_name = table_name
         self.renderable = renderable
         self._report_columns = None
+        self._count = None
+        # min, max and mean of the keys select sorted every row by
+        self.summary = None
+        # File select wrote every row to
+        self.spill = None
 
     def append(self, item):
         self._data.append(item)
         if not self._report_columns:
             self._report_columns = item.keys()
 
+    @property
+    def count(self):
+        """Amount of rows in the table, including rows which weren't
+        kept"""
+        if self._count is None:
+            return len(self._data)
+        return self._count
+
+    @count.setter
+    def count(self, value):
+        self._count = value
+
     def report_columns(self, items):
         """Columns to display in report"""
         self._report_columns = items
@@ -88,7 +100,7 @@ class Tbl:
             report.paragraph(string)
         else:
             report.subsubheading("{}: {}".format(
-                self.table_name, len(self._data)
+                self.table_name, self.count
             ))
             if self._report_columns:
                 report.start_table()
@@ -108,26 +120,12 @@ class Tbl:
         return report.text
 
     def _shape_string(self, font, string, ot_features):
-        buf = hb.Buffer.create()
-        buf.add_str(string)
-        buf.guess_segment_properties()
-        try:
-            features = {f: True for f in ot_features}
-            hb.shape(font.hbfont, buf, features)
-        except KeyError:
-            hb.shape(font.hbfont, buf)
-        return buf
+        from diffenator.render import shape_string
+        return shape_string(font, string, ot_features)
 
     def _tab_width(self, font, limit=800):
-        result = 0
-        for row in self._data[:limit]:
-            buf = self._shape_string(font, row['string'], row['features'])
-            if not buf.glyph_positions:
-                continue
-            adv = sum([i.x_advance for i in buf.glyph_positions])
-            if adv > result:
-                result = adv
-        return result + 300
+        from diffenator.render import tab_width
+        return tab_width(self, font, limit)
 
     def _to_png(self, font, font_position=None, dst=None,
                 limit=800, size=1500, tab_width=1500, prefix_characters="",
@@ -142,109 +140,90 @@ class Tbl:
         dst: str
             Path to output image. If no path is given, return in-memory
         """
-        # TODO (M Foley) better packaging for pycairo, freetype-py
-        # and uharfbuzz.
-        # Users should be able to pip install these bindings without needing
-        # to install the correct libs.
-
-        # A special mention to the individuals who maintain these packages. Using
-        # these dependencies has sped up the process of creating diff images
-        # significantly. It's an incredible age we live in.
-        y_tab = int(1500 / 25)
-        x_tab = int(tab_width / 64)
-        width, height = 1024, 200
-
-        cells_per_row = int((width - x_tab) / x_tab)
-        # Compute height of image
-        x, y, baseline = x_tab, 0, 0
-        for idx, row in enumerate(self._data[:limit]):
-            x += x_tab
-
-            if idx % cells_per_row == 0:
-                y += y_tab
-                x = x_tab
-        height += y
-        height += 100
-
-        # draw image
-        Z = ImageSurface(FORMAT_ARGB32, width, height)
-        ctx = Context(Z)
-        ctx.rectangle(0, 0, width, height)
-        ctx.set_source_rgb(1, 1, 1)
-        ctx.fill()
-
-        # label image
-        ctx.set_font_size(30)
-        ctx.set_source_rgb(0.5, 0.5, 0.5)
-        ctx.move_to(x_tab, 50)
-        ctx.show_text("{}: {}".format(self.table_name, len(self._data)))
-        ctx.move_to(x_tab, 100)
-        if font_position:
-            ctx.show_text("Font Set: {}".format(font_position))
-        if len(self._data) > limit:
-            ctx.set_font_size(20)
-            ctx.move_to(x_tab, 150)
-            ctx.show_text("Warning: {} different items. Only showing most serious {}".format(
-                len(self._data), limit)
-            )
-
-        hb.ot_font_set_funcs(font.hbfont)
-
-        # Draw glyphs
-        x, y, baseline = x_tab, 200, 0
-        x_pos = x_tab
-        y_pos = 200
-        for idx, row in enumerate(self._data[:limit]):
-            string = "{}{}{}".format(
-                prefix_characters,
-                row['string'],
-                suffix_characters)
-            buf = self._shape_string(font, string, row['features'])
-            char_info = buf.glyph_infos
-            char_pos = buf.glyph_positions
-            if not char_info or not char_pos:
-                continue
-            for info, pos in zip(char_info, char_pos):
-                gid = info.codepoint
-                font.ftfont.load_glyph(gid, flags=font.ft_load_glyph_flags)
-                bitmap = font.ftslot.bitmap
-
-                if bitmap.width > 0:
-                    ctx.set_source_rgb(0, 0, 0)
-                    glyph_surface = _make_image_surface(font.ftfont.glyph.bitmap, copy=False)
-                    ctx.set_source_surface(glyph_surface,
-                                           x_pos + font.ftslot.bitmap_left + (pos.x_offset / 64.),
-                                           y_pos - font.ftslot.bitmap_top - (pos.y_offset / 64.))
-                    glyph_surface.flush()
-                    ctx.paint()
-                x_pos += (pos.x_advance) / 64.
-                y_pos += (pos.y_advance) / 64.
-
-            x_pos += x_tab - (x_pos % x_tab)
-            if idx % cells_per_row == 0:
-                # add label
-                if font_position:
-                    ctx.set_source_rgb(0.5, 0.5, 0.5)
-                    ctx.set_font_size(10)
-                    ctx.move_to(width - 20, y_pos)
-                    ctx.rotate(1.5708)
-                    ctx.show_text(font_position)
-                    ctx.set_source_rgb(0,0,0)
-                    ctx.rotate(-1.5708)
-                # Start a new row
-                y_pos += y_tab
-                x_pos = x_tab
-        Z.flush()
-        if dst:
-            Z.write_to_png(dst)
-        else:
-            img = StringIO()
-            Z.write_to_png(img)
-            return Image.open(img)
+        from diffenator.render import table_to_png
+        return table_to_png(self, font, font_position=font_position, dst=dst,
+                            limit=limit, size=size, tab_width=tab_width,
+                            prefix_characters=prefix_characters,
+                            suffix_characters=suffix_characters)
 
     def sort(self, *args, **kwargs):
         self._data.sort(*args, **kwargs)
 
+    def select(self, limit=None, key=None, reverse=False, spill_dir=None,
+               rows=None):
+        """Sort the table by key and keep its first limit rows.
+
+        Rows are picked with a bounded heap, so the full table is never
+        sorted. count still includes every row and summary holds the
+        min, max and mean of their keys, if the keys are numbers.
+
+        Parameters
+        ----------
+        limit: int
+            Amount of rows to keep. None keeps every row.
+        key: function
+            Sort key for each row. If None, rows keep their order.
+        reverse: bool
+            If True, keep the rows with the largest keys
+        spill_dir: str
+            Directory to write every row to, unsorted, before rows are
+            dropped. Rows are written as tab separated report columns to
+            a file named after the table.
+        rows: iterable
+            Rows to select from instead of the table's rows. They are
+            consumed one at a time, so only limit rows are held.
+        """
+        rows = self._data if rows is None else rows
+        stats = dict(count=0, values=0, min=None, max=None, total=0)
+        spill = None
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill = os.path.join(
+                spill_dir, self.table_name.replace(" ", "_") + ".tsv")
+            spill = open(self.spill, 'w')
+            columns = list(self._report_columns or [])
+            spill.write("\t".join(columns) + "\n")
+
+        def decorated():
+            for row in rows:
+                idx = stats["count"]
+                stats["count"] += 1
+                if spill:
+                    spill.write("\t".join(str(row[c]) for c in columns) + "\n")
+                value = key(row) if key else None
+                if isinstance(value, numbers.Real) and \
+                        not isinstance(value, bool):
+                    if stats["min"] is None or value < stats["min"]:
+                        stats["min"] = value
+                    if stats["max"] is None or value > stats["max"]:
+                        stats["max"] = value
+                    stats["values"] += 1
+                    stats["total"] += value
+                # The index keeps rows with equal keys in their order
+                yield value, -idx if reverse else idx, row
+
+        try:
+            items = decorated()
+            if not key:
+                kept = list(islice(items, limit))
+                # Count the rest
+                for _ in items:
+                    pass
+            elif limit is None:
+                kept = sorted(items, reverse=reverse)
+            elif reverse:
+                kept = heapq.nlargest(limit, items)
+            else:
+                kept = heapq.nsmallest(limit, items)
+        finally:
+            if spill:
+                spill.close()
+        self._data = [row for _, _, row in kept]
+        self.count = stats["count"]
+        if stats["min"] is not None:
+            self.summary = dict(min=stats["min"], max=stats["max"],
+                                mean=stats["total"] / stats["values"])
+
     def __len__(self):
         return len(self._data)
 
@@ -253,43 +232,6 @@ class Tbl:
             yield i
 
 
-def _to_array(content, pixel_mode, dst_pitch):
-    buffer_size = content.rows * dst_pitch
-    buff = array("B", b"0" * buffer_size)
-    dstaddr = buff.buffer_info()[0]
-    srcaddr = cast(content.buffer, FT_Pointer).value
-    src_pitch = content.pitch
-
-    for i in range(content.rows) :
-        memmove(dstaddr, srcaddr, src_pitch)
-        dstaddr += dst_pitch
-        srcaddr += src_pitch
-    return buff
-
-
-def _make_image_surface(bitmap, copy=True):
-    """Convert FreeType bitmap to Cairo ImageSurface.
-
-    Special thanks to Hintak and his example code:
-    https://github.com/rougier/freetype-py/blob/master/examples/bitmap_to_surface.py
-
-
-    TODO (M Foley) understand this better and see if a more elegant
-    solution exists."""
-    content = bitmap._FT_Bitmap
-    cairo_format = FORMAT_A8
-
-    src_pitch = content.pitch
-    dst_pitch = ImageSurface.format_stride_for_width(cairo_format, content.width)
-
-    pixels = _to_array(content, content.pixel_mode, dst_pitch)
-    result = ImageSurface.create_for_data(
-        pixels, cairo_format,
-        content.width, content.rows,
-        dst_pitch)
-    return result
-
-
 class DiffTable(Tbl):
     def __init__(self, table_name, font_a, font_b,
                  data=None, renderable=False):
@@ -298,30 +240,8 @@ class DiffTable(Tbl):
         self._font_b = font_b
 
     def to_cbdt_gif(self, dst):
-        font_a_images = read_cbdt(self._font_a.ttfont)
-        font_b_images = read_cbdt(self._font_b.ttfont)
-
-        for element in self._data:
-            key_before = element["glyph before"]
-            key_after = element["glyph after"]
-
-            image_1 = font_a_images[key_before]
-            image_1_gif = Image.new('RGBA', image_1.size, (255, 255, 255))
-            image_1_gif.paste(image_1, image_1)
-            image_1_gif = image_1_gif.convert('RGB').convert('P', palette=Image.ADAPTIVE)
-
-            image_2 = font_b_images[key_after]
-            image_2_gif = Image.new('RGBA', image_2.size, (255, 255, 255))
-            image_2_gif.paste(image_2, image_2)
-            image_2_gif = image_2_gif.convert('RGB').convert('P', palette=Image.ADAPTIVE)
-
-            img_path = os.path.join(dst, f"{key_before}.gif")
-            image_1_gif.save(img_path,
-                             save_all=True,
-                             append_images=[image_2_gif],
-                             duration=1000,
-                             loop=0
-            )
+        from diffenator.render import cbdt_to_gif
+        cbdt_to_gif(self, dst)
 
     def to_gif(self, dst, prefix_characters="", suffix_characters="", limit=800):
         tab_width = max(self._tab_width(self._font_a),
@@ -513,12 +433,3 @@ class HTMLFormatter(Formatter):
 
     def img(self, path):
         self._text.append("<img src='%s'>" % path)
-
-def read_cbdt(ttfont):
-    cbdt_glyphs = {}
-    if ttfont.has_key("CBDT"):
-        cbdt = ttfont["CBDT"]
-        for strike_data in cbdt.strikeData:
-            for key, data in strike_data.items():
-                cbdt_glyphs[key] = Image.open(io.BytesIO(data.imageData)).convert("RGBA")
-    return cbdt_glyphs
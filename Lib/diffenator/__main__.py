@@ -39,29 +39,57 @@ diffenator /path/to/font_before.ttf /path/to/font_after.ttf -td kerns --kerns_th
 
 Output images:
 diffenator /path/to/font_before.ttf /path/to/font_after.ttf -r /path/to/img_dir
+
+Diff two variable fonts at every named instance:
+diffenator /path/to/vf_before.ttf /path/to/vf_after.ttf --all-instances
+
+Diff a variable font against a directory of static fonts:
+diffenator /path/to/vf_before.ttf /path/to/statics_after --all-instances
+
+Diff a font against a snapshot written by dumper --snapshot:
+diffenator /path/to/font_before.dsnap /path/to/font_after.ttf
+
+Reuse font dumps between runs:
+diffenator /path/to/font_before.ttf /path/to/font_after.ttf --cache-dir /path/to/cache
+
+Diff categories concurrently over 4 processes:
+diffenator /path/to/font_before.ttf /path/to/font_after.ttf --diff-jobs 4 --diff-pool process
+
+Output diff tables as JSON Lines:
+diffenator /path/to/font_before.ttf /path/to/font_after.ttf --json > diff.jsonl
+
+Write diff tables as MessagePack to a file:
+diffenator /path/to/font_before.ttf /path/to/font_after.ttf --msgpack diff.msgpack
 """
 from argparse import RawTextHelpFormatter
 import logging
 from diffenator import CHOICES, __version__
 from diffenator.font import DFont, font_matcher
-from diffenator.diff import DiffFonts
-from diffenator.constants import FTHintMode
+from diffenator.diff import DiffFonts, DIFF_POOLS
+from diffenator.constants import FTHintMode, SNAPSHOT_EXT
 import argparse
+import os
 
 
-def main():
-    parser = argparse.ArgumentParser(description=__doc__,
-                                     formatter_class=RawTextHelpFormatter)
-    parser.add_argument('--version', action='version', version=__version__)
+# Rows reported for each diff table unless --output-lines is given
+OUTPUT_LINES = 50
 
-    parser.add_argument('font_before')
-    parser.add_argument('font_after')
+
+def add_diff_arguments(parser):
+    """Add the options which set how fonts are diffed and reported.
+    Return the group of mutually exclusive report formats."""
     parser.add_argument('-td', '--to_diff', nargs='+', choices=CHOICES,
                         default='*',
                         help="Categories to diff. '*' diffs everything")
 
-    parser.add_argument('-ol', '--output-lines', type=int, default=50,
-                        help="Amout of rows to report for each diff table")
+    parser.add_argument('-ol', '--output-lines', type=int, default=None,
+                        help=("Amount of rows to report for each diff "
+                              "table. Defaults to {}. --json and --msgpack "
+                              "write every row unless it is given.".format(
+                                  OUTPUT_LINES)))
+    parser.add_argument('--spill-dir',
+                        help=("Directory to write every row of each diff "
+                              "table to, as tab separated values"))
     formatter_group = parser.add_mutually_exclusive_group(required=False)
     formatter_group.add_argument('-txt', '--txt', action='store_true', default=True,
                         help="Output report as txt.")
@@ -73,9 +101,16 @@ def main():
                         help='Output verbose reports')
     parser.add_argument('-l', '--log-level', choices=('INFO', 'DEBUG', 'WARN'),
                         default='INFO')
-    parser.add_argument('-i', '--vf-instance',
-                        default=None,
-                        help='Set vf variations e.g "wght=400"')
+    parser.add_argument('--diff-jobs', type=int, default=1,
+                        help=("Diff this many categories concurrently. "
+                              "0 uses the cpu count. Helps when no single "
+                              "dump, such as marks, dominates."))
+    parser.add_argument('--diff-pool', choices=DIFF_POOLS, default="thread",
+                        help="Pool to diff categories concurrently with")
+    parser.add_argument('--no-skip-unchanged', dest='skip_unchanged',
+                        action='store_false',
+                        help=("Diff categories even if the font tables they "
+                              "read are identical"))
 
     parser.add_argument('--marks_thresh', type=int, default=0,
                         help="Ignore modified marks under this value")
@@ -89,48 +124,163 @@ def main():
                         help="Ignore modified metrics under this value")
     parser.add_argument('--cbdt_thresh', type=float, default=0,
                         help="Ignore modified CBDT glyphs under this value")
+    parser.add_argument('--pixel_tolerance', type=int, default=0,
+                        help=("Ignore rendered pixels which differ by no "
+                              "more than this value"))
     parser.add_argument('-rd', '--render_diffs', action='store_true',
                         help=("Render glyphs with hb-view and compare "
                               "pixel diffs."))
+    parser.add_argument('--render-jobs', type=int, default=1,
+                        help=("Processes to render glyph diffs with. "
+                              "0 uses the cpu count."))
     parser.add_argument('-r', '--render-path',
                         help="Path to generate before and after gifs to.")
+    parser.add_argument('--cache-dir',
+                        help=("Directory to cache font dumps in. Dumps are "
+                              "reused while the font file is unchanged."))
     parser.add_argument('--ft-hinting', type=str, default="unhinted",
                         choices=[e.name.lower() for e in FTHintMode],
                         help="Set FreeType hinting mode")
-    args = parser.parse_args()
+    return formatter_group
+
+
+def output_lines(args):
+    """Rows to report for each diff table, see --output-lines"""
+    if args.output_lines is None:
+        return OUTPUT_LINES
+    return args.output_lines
 
-    logger = logging.getLogger("fontdiffenator")
-    logger.setLevel(args.log_level)
 
-    diff_options = dict(
+def diff_options(args):
+    """DiffFonts settings for parsed add_diff_arguments options"""
+    rows_limit = output_lines(args)
+    if args.output_lines is None and \
+            (getattr(args, "json", None) or getattr(args, "msgpack", None)):
+        # Machine readable output keeps every row
+        rows_limit = None
+    return dict(
             marks_thresh=args.marks_thresh,
             mkmks_thresh=args.mkmks_thresh,
             kerns_thresh=args.kerns_thresh,
+            rows_limit=rows_limit,
             glyphs_thresh=args.glyphs_thresh,
             metrics_thresh=args.metrics_thresh,
             cbdt_thresh=args.cbdt_thresh,
+            pixel_tolerance=args.pixel_tolerance,
             to_diff=args.to_diff,
             render_diffs=args.render_diffs,
+            render_jobs=args.render_jobs,
             render_path=args.render_path,
             html_output=args.html,
+            diff_jobs=args.diff_jobs,
+            diff_pool=args.diff_pool,
+            skip_unchanged=args.skip_unchanged,
+            spill_dir=args.spill_dir,
     )
+
+
+def report_type(args):
+    if args.markdown:
+        return "md"
+    elif args.html:
+        return "html"
+    return "txt"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--version', action='version', version=__version__)
+
+    parser.add_argument('font_before')
+    parser.add_argument('font_after')
+    parser.add_argument('-i', '--vf-instance',
+                        default=None,
+                        help='Set vf variations e.g "wght=400"')
+    parser.add_argument('--all-instances', action='store_true',
+                        help=("Diff every named instance of a variable "
+                              "font. Either font may be a directory of "
+                              "static fonts."))
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help=("Processes to diff instances with. Defaults "
+                              "to the cpu count."))
+    formatter_group = add_diff_arguments(parser)
+    formatter_group.add_argument('--json', nargs='?', const='-',
+                                 metavar='PATH',
+                                 help=("Write diff tables as JSON Lines to "
+                                       "PATH, or to stdout."))
+    formatter_group.add_argument('--msgpack', nargs='?', const='-',
+                                 metavar='PATH',
+                                 help=("Write diff tables as MessagePack to "
+                                       "PATH, or to stdout. Needs msgpack."))
+    args = parser.parse_args()
+    if args.all_instances and (args.json or args.msgpack):
+        parser.error("--json and --msgpack can't be used with "
+                     "--all-instances")
+
+    logger = logging.getLogger("fontdiffenator")
+    logger.setLevel(args.log_level)
+
     ft_hint_mode = int(getattr(FTHintMode, args.ft_hinting.upper()))
-    font_before = DFont(args.font_before, ft_load_glyph_flags=ft_hint_mode)
-    font_after = DFont(args.font_after, ft_load_glyph_flags=ft_hint_mode)
-    font_matcher(font_before, font_after, args.vf_instance)
 
-    diff = DiffFonts(font_before, font_after, diff_options)
+    def load_font(path):
+        if args.all_instances and os.path.isdir(path):
+            return path
+        if path.endswith(SNAPSHOT_EXT):
+            if args.all_instances:
+                parser.error("Snapshots can't be diffed at every instance")
+            from diffenator.snapshot import DSnapshot
+            return DSnapshot(path)
+        return DFont(path, lazy=True, ft_load_glyph_flags=ft_hint_mode,
+                     cache_dir=args.cache_dir)
+
+    font_before = load_font(args.font_before)
+    font_after = load_font(args.font_after)
+    r_type = report_type(args)
+    limit = output_lines(args)
+
+    if args.all_instances:
+        # The sweep and its process pool are only imported when used,
+        # to keep the CLI's startup short
+        from diffenator.sweep import diff_instances, instances_report
+        try:
+            instance_diffs = diff_instances(font_before, font_after,
+                                            diff_options(args),
+                                            limit=limit,
+                                            r_type=r_type, jobs=args.jobs)
+        except ValueError as e:
+            parser.error(str(e))
+        print(instances_report(instance_diffs, limit, r_type))
+        return
+
+    if not isinstance(font_before, DFont) or \
+            not isinstance(font_after, DFont):
+        from diffenator.snapshot import match_snapshot
+        try:
+            match_snapshot(font_before, font_after, args.vf_instance)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        font_matcher(font_before, font_after, args.vf_instance)
+
+    diff = DiffFonts(font_before, font_after, diff_options(args))
+    for font in (font_before, font_after):
+        if isinstance(font, DFont):
+            font.save_cache()
 
     if args.render_path:
-        diff.to_gifs(args.render_path, args.output_lines)
+        diff.to_gifs(args.render_path, limit)
 
-    if args.markdown:
-        print(diff.to_md(args.output_lines))
+    if args.json:
+        diff.to_json(None if args.json == '-' else args.json)
+    elif args.msgpack:
+        diff.to_msgpack(None if args.msgpack == '-' else args.msgpack)
+    elif args.markdown:
+        print(diff.to_md(limit))
     elif args.html:
-        print(diff.to_html(args.output_lines, image_dir=args.render_path))
+        print(diff.to_html(limit, image_dir=args.render_path))
     else:
-        print(diff.to_txt(args.output_lines))
-
+        print(diff.to_txt(limit))
 
 
 if __name__ == '__main__':
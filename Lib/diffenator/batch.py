@@ -0,0 +1,298 @@
+"""
+Diffenator Batch
+~~~~~~~~~~~~~~~~
+
+Diff two families of fonts.
+
+Each family is a directory or a glob pattern of fonts. Fonts are paired
+by file name. A static font without a namesake is paired with a
+variable font of the same family and slope in the other family, which
+is instantiated to match it.
+
+Pairs are diffed over a pool of forked processes. Variable fonts are
+parsed once, before the workers fork.
+
+Examples
+--------
+Diff two directories of static fonts:
+diffenator-batch /path/to/family_before /path/to/family_after
+
+Diff static fonts against a variable font:
+diffenator-batch "/path/to/statics/*.ttf" /path/to/vf_dir
+
+Output report as markdown:
+diffenator-batch /path/to/family_before /path/to/family_after -md
+"""
+from argparse import RawTextHelpFormatter
+from collections import namedtuple
+from glob import glob
+import argparse
+import logging
+import os
+from fontTools.ttLib import TTFont
+from diffenator import Tbl, __version__
+from diffenator.__main__ import (
+    add_diff_arguments,
+    diff_options,
+    output_lines,
+    report_type
+)
+from diffenator.constants import FTHintMode
+from diffenator.diff import CATEGORY_DUMPS, FORMATTERS
+from diffenator.font import DFont, font_matcher
+from diffenator.multidiff import (
+    combined_report,
+    diff_report,
+    preload,
+    run_pool
+)
+from diffenator.sweep import FONT_EXTS
+
+
+__all__ = ['FontPair', 'PairDiff', 'pair_fonts', 'diff_family',
+           'family_report']
+
+logger = logging.getLogger('fontdiffenator')
+
+FontPair = namedtuple("FontPair", ["name", "path_before", "path_after"])
+
+PairDiff = namedtuple("PairDiff", ["name", "before", "after", "counts",
+                                   "tables"])
+
+
+def font_paths(src):
+    """Return the fonts in a directory, or the fonts matching a glob
+    pattern"""
+    paths = glob(os.path.join(src, "*")) if os.path.isdir(src) else glob(src)
+    return sorted(p for p in paths if p.lower().endswith(FONT_EXTS))
+
+
+def _is_variable(path):
+    with TTFont(path, lazy=True) as ttfont:
+        return "fvar" in ttfont
+
+
+def _family_key(path):
+    """Family name and slope from a file name such as
+    Family-BoldItalic.ttf or Family-Italic[wght].ttf"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    family = stem.split("[")[0].split("-")[0]
+    return family, "Italic" in stem
+
+
+def pair_fonts(paths_before, paths_after):
+    """Pair the fonts of two families.
+
+    Fonts with the same file name are paired. Each remaining static
+    font is paired with the variable font in the other family which has
+    the same family name and slope, or with its only variable font.
+
+    Parameters
+    ----------
+    paths_before: list
+    paths_after: list
+
+    Returns
+    -------
+    pairs: list of FontPair
+    unmatched: list
+        Paths which have no font to be diffed against
+    """
+    names_before = {os.path.basename(p): p for p in paths_before}
+    names_after = {os.path.basename(p): p for p in paths_after}
+    pairs = [FontPair(n, names_before[n], names_after[n])
+             for n in sorted(set(names_before) & set(names_after))]
+    rest_before = [p for n, p in names_before.items() if n not in names_after]
+    rest_after = [p for n, p in names_after.items() if n not in names_before]
+
+    vfs_before = [p for p in paths_before if _is_variable(p)]
+    vfs_after = [p for p in paths_after if _is_variable(p)]
+    unmatched = []
+    for rest, vfs, static_is_before in ((rest_before, vfs_after, True),
+                                        (rest_after, vfs_before, False)):
+        vf_keys = {_family_key(p): p for p in vfs}
+        for path in rest:
+            if path in vfs_before or path in vfs_after:
+                continue
+            vf = vf_keys.get(_family_key(path))
+            if not vf and len(vfs) == 1:
+                vf = vfs[0]
+            if not vf:
+                unmatched.append(path)
+            elif static_is_before:
+                pairs.append(FontPair(os.path.basename(path), path, vf))
+            else:
+                pairs.append(FontPair(os.path.basename(path), vf, path))
+    paired = set(p for pair in pairs for p in pair[1:])
+    unmatched += [p for p in rest_before + rest_after if p not in paired
+                  and p not in unmatched]
+    return pairs, unmatched
+
+
+def _shared_vf(pair, variable):
+    """Return the variable font path of a pair which diffs a variable
+    font against a static font"""
+    if variable[pair.path_before] != variable[pair.path_after]:
+        return pair.path_before if variable[pair.path_before] \
+            else pair.path_after
+    return None
+
+
+def _load_font(path, batch):
+    return DFont(path, lazy=True,
+                 ft_load_glyph_flags=batch["ft_load_glyph_flags"],
+                 cache_dir=batch["cache_dir"])
+
+
+def _diff_pair(pair, batch):
+    """Diff a single pair, reusing the variable fonts of the batch"""
+    vf = _shared_vf(pair, batch["variable"])
+    font_before, font_after = [
+        batch["fonts"][path] if path == vf else _load_font(path, batch)
+        for path in (pair.path_before, pair.path_after)
+    ]
+    font_matcher(font_before, font_after)
+
+    diff, tables = diff_report(pair.name, font_before, font_after,
+                               batch["settings"], batch["limit"],
+                               batch["r_type"])
+    counts = {category: sum(t.count for t in diff._data[category].values())
+              for category in diff._data}
+    return PairDiff(pair.name, os.path.basename(pair.path_before),
+                    os.path.basename(pair.path_after), counts, tables)
+
+
+def diff_family(pairs, settings=None, limit=50, r_type="txt", jobs=None,
+                ft_load_glyph_flags=FTHintMode.UNHINTED, cache_dir=None):
+    """Diff pairs of fonts over a pool of processes.
+
+    Variable fonts which are paired with static fonts are parsed once
+    here. Each worker inherits them and instantiates its own copy to
+    match the static fonts it diffs.
+
+    Parameters
+    ----------
+    pairs: list of FontPair
+    settings: dict
+        DiffFonts settings. If it has a render_path or spill_dir, gifs
+        and spilled rows for each pair are written to a subdirectory
+        named after it.
+    limit: int
+        Amount of rows to report for each diff table
+    r_type: str
+        Report type, either "txt", "md" or "html"
+    jobs: int
+        Amount of processes to use. Defaults to the cpu count. Pairs
+        are diffed in this process if jobs is 1 or the platform can't
+        fork.
+    ft_load_glyph_flags: int
+        FreeType hinting mode to load fonts with
+    cache_dir: str
+        Directory to cache font dumps in
+
+    Returns
+    -------
+    list of PairDiff
+    """
+    paths = set(p for pair in pairs for p in pair[1:])
+    variable = {p: _is_variable(p) for p in paths}
+    fonts = {}
+    for pair in pairs:
+        vf = _shared_vf(pair, variable)
+        if vf and vf not in fonts:
+            fonts[vf] = DFont(vf, lazy=True,
+                              ft_load_glyph_flags=ft_load_glyph_flags,
+                              cache_dir=cache_dir)
+            preload(fonts[vf])
+
+    batch = dict(
+        fonts=fonts,
+        variable=variable,
+        settings=dict(settings or {}),
+        limit=limit,
+        r_type=r_type,
+        ft_load_glyph_flags=ft_load_glyph_flags,
+        cache_dir=cache_dir,
+    )
+    return run_pool(_diff_pair, pairs, batch, jobs)
+
+
+def family_report(pair_diffs, unmatched=None, limit=50, r_type="txt",
+                  dst=None):
+    """Combine pair diffs into a single report. A summary of the
+    differences in each category of every pair is followed by a
+    section for each pair.
+
+    Parameters
+    ----------
+    pair_diffs: list of PairDiff
+    unmatched: list
+        Paths of fonts which weren't paired
+    limit: int
+        Amount of rows reported for each diff table
+    r_type: str
+        Report type, either "txt", "md" or "html"
+    dst: str
+        Path to write the report to. If no path is given, return it.
+
+    Returns
+    -------
+    str
+    """
+    categories = [c for c in CATEGORY_DUMPS
+                  if any(c in p.counts for p in pair_diffs)]
+    summary = Tbl("pairs", data=[
+        dict(pair=p.name, before=p.before, after=p.after,
+             **{c: p.counts.get(c, "") for c in categories})
+        for p in pair_diffs
+    ])
+    summary.report_columns(["pair", "before", "after"] + categories)
+    summaries = [getattr(summary, "to_" + r_type)(limit=len(summary))]
+    if unmatched:
+        section = FORMATTERS[r_type]()
+        section.paragraph("Unmatched fonts: {}".format(
+            ", ".join(os.path.basename(p) for p in unmatched)))
+        summaries.append(section.text)
+
+    sections = [("{} ({} vs {})".format(p.name, p.before, p.after), p.tables)
+                for p in pair_diffs]
+    return combined_report(sections, limit, r_type, dst, summaries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--version', action='version', version=__version__)
+
+    parser.add_argument('family_before',
+                        help="Directory or glob pattern of fonts")
+    parser.add_argument('family_after',
+                        help="Directory or glob pattern of fonts")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help=("Processes to diff pairs with. Defaults to "
+                              "the cpu count."))
+    add_diff_arguments(parser)
+    args = parser.parse_args()
+
+    logger.setLevel(args.log_level)
+
+    paths_before = font_paths(args.family_before)
+    paths_after = font_paths(args.family_after)
+    if not paths_before or not paths_after:
+        parser.error("No fonts found in {}".format(
+            args.family_before if not paths_before else args.family_after))
+    pairs, unmatched = pair_fonts(paths_before, paths_after)
+    if not pairs:
+        parser.error("No fonts could be paired")
+
+    r_type = report_type(args)
+    pair_diffs = diff_family(
+        pairs, diff_options(args), limit=output_lines(args), r_type=r_type,
+        jobs=args.jobs,
+        ft_load_glyph_flags=int(getattr(FTHintMode, args.ft_hinting.upper())),
+        cache_dir=args.cache_dir)
+    print(family_report(pair_diffs, unmatched, output_lines(args), r_type))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""Module for the on-disk DFont dump cache.
+
+Each dump table is pickled and zlib compressed on its own, so loading
+one table doesn't decompress the others. Glyphs and the font they
+belong to are stored by reference, so a cached table only holds its
+rows and gets rebound to the font which loads it.
+
+Cache entries are pickles. Only point a DumpCache at directories you
+trust.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+from diffenator import __version__
+
+
+logger = logging.getLogger('fontdiffenator')
+
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024  # bytes
+
+DEFAULT_BITMAP_CACHE_SIZE = 64 * 1024 * 1024  # bytes
+
+# Bytes each cached bitmap is charged on top of its pixels
+BITMAP_ENTRY_OVERHEAD = 128
+
+CACHE_EXT = ".dcache"
+
+# Bump when the contents of dump tables change, so entries written by
+# older code stop matching.
+CACHE_FORMAT = 10
+
+# Errors raised when unpacking a truncated, corrupt or outdated cache
+# entry or table. They are treated as a cache miss.
+UNPACK_ERRORS = (EOFError, pickle.UnpicklingError, zlib.error, ValueError,
+                 AttributeError, ImportError, IndexError)
+
+
+class _TablePickler(pickle.Pickler):
+    """Pickle dump tables, storing glyphs by name and fonts by
+    reference."""
+    def __init__(self, file, fonts):
+        super(_TablePickler, self).__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._fonts = {id(font): idx for idx, font in enumerate(fonts)}
+        # Only built glyphs can be referenced. Don't build the glyphset
+        # here, tables it depends on get packed while it is built.
+        self._glyph_names = {}
+        for idx, font in enumerate(fonts):
+            glyphset = font._tables.get("glyphset", {})
+            self._glyph_names.update((id(g), (n, idx))
+                                     for n, g in glyphset.items())
+
+    def persistent_id(self, obj):
+        idx = self._fonts.get(id(obj))
+        if idx is not None:
+            return ("font", idx)
+        glyph = self._glyph_names.get(id(obj))
+        if glyph is not None:
+            return ("glyph",) + glyph
+        return None
+
+
+class _TableUnpickler(pickle.Unpickler):
+    def __init__(self, file, fonts):
+        super(_TableUnpickler, self).__init__(file)
+        self._fonts = fonts
+
+    def persistent_load(self, pid):
+        if pid[0] == "font":
+            return self._fonts[pid[1]]
+        if pid[0] == "glyph":
+            return self._fonts[pid[2]].glyph(pid[1])
+        raise pickle.UnpicklingError("Unknown reference {}".format(pid))
+
+
+def pack_table(font, table):
+    """Serialise a DFont dump table to compressed bytes"""
+    return pack_tables([font], table)
+
+
+def unpack_table(font, data):
+    """Load a dump table serialised by pack_table and bind it to font"""
+    return unpack_tables([font], data)
+
+
+def pack_tables(fonts, tables):
+    """Serialise tables which reference several DFonts, such as diff
+    tables, to compressed bytes"""
+    buf = BytesIO()
+    _TablePickler(buf, fonts).dump(tables)
+    return zlib.compress(buf.getvalue(), 1)
+
+
+def unpack_tables(fonts, data):
+    """Load tables serialised by pack_tables and bind them to fonts.
+    The fonts must be given in the same order they were packed with."""
+    return _TableUnpickler(BytesIO(zlib.decompress(data)), fonts).load()
+
+
+def font_cache_key(font):
+    """Cache key for a DFont.
+
+    Combines the font file's content hash, the diffenator version and
+    cache format, the variation coordinates and the FreeType hinting
+    mode."""
+    key = hashlib.sha256()
+    key.update(font.content_hash.encode("ascii"))
+    key.update(__version__.encode("ascii"))
+    key.update(str(CACHE_FORMAT).encode("ascii"))
+    if font.instance_coordinates:
+        coords = sorted(font.instance_coordinates.items())
+        key.update(repr([(k, float(v)) for k, v in coords]).encode("ascii"))
+    key.update(str(int(font.ft_load_glyph_flags)).encode("ascii"))
+    return key.hexdigest()
+
+
+class DumpCache:
+    """Size bounded LRU cache of DFont dump tables on disk.
+
+    Each entry is a single file. Loading an entry marks it as recently
+    used. Once the directory grows past max_size bytes, the least
+    recently used entries are removed.
+
+    Parameters
+    ----------
+    path: str
+        Directory to store the cache in. Created if it doesn't exist.
+    max_size: int
+        Maximum size of the cache in bytes.
+    """
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + CACHE_EXT)
+
+    def load(self, key):
+        """Return the entry stored under key, or None on a miss.
+
+        An entry is a dict with a 'glyphset' list of
+        (name, features, characters) tuples and a 'tables' dict
+        of dump names to bytes made by pack_table."""
+        path = self._entry_path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as doc:
+                entry = pickle.loads(doc.read())
+        except (OSError,) + UNPACK_ERRORS:
+            logger.warning("Ignoring unreadable cache entry {}".format(path))
+            return None
+        if not isinstance(entry, dict) or \
+                entry.get("version") != __version__:
+            return None
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            # Evicted by another process since it was read
+            pass
+        logger.debug("Loaded cache entry {}".format(path))
+        return entry
+
+    def save(self, key, entry):
+        """Store an entry under key and evict old entries"""
+        entry = dict(entry, version=__version__)
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as doc:
+            doc.write(data)
+        os.replace(tmp_path, self._entry_path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits
+        in max_size.
+
+        Several processes may share a cache, entries another process
+        removes meanwhile are skipped."""
+        entries = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith(CACHE_EXT):
+                continue
+            path = os.path.join(self.path, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.debug("Evicting cache entry {}".format(path))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class BitmapCache:
+    """Size bounded LRU cache of rasterized glyphs in memory.
+
+    Each entry is charged its pixel bytes plus BITMAP_ENTRY_OVERHEAD.
+    Once the entries grow past max_size bytes, the least recently used
+    ones are dropped.
+
+    Parameters
+    ----------
+    max_size: int
+        Maximum size of the cache in bytes.
+
+    Attributes
+    ----------
+    hits: int
+        Lookups which found a bitmap
+    misses: int
+        Lookups which didn't
+    """
+    def __init__(self, max_size=DEFAULT_BITMAP_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Return the bitmap stored under key, or None on a miss"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, bitmap, nbytes):
+        """Store a bitmap of nbytes pixel bytes under key and evict old
+        entries"""
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        size = nbytes + BITMAP_ENTRY_OVERHEAD
+        if size > self.max_size:
+            return
+        self._entries[key] = (bitmap, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self.size -= old_size
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,7 +1,18 @@
-from freetype.raw import *
 from enum import IntEnum
 
 
+# File extension of dump snapshots. Kept here so the CLIs can spot
+# snapshot paths without importing diffenator.snapshot.
+SNAPSHOT_EXT = ".dsnap"
+
+# FT_LOAD_* flags from freetype.h. They are spelled out so the CLIs
+# don't have to load FreeType just to parse their arguments.
+FT_LOAD_NO_HINTING = 0x2
+FT_LOAD_RENDER = 0x4
+FT_LOAD_TARGET_NORMAL = 0x0
+FT_LOAD_TARGET_LIGHT = 0x10000
+
+
 class FTHintMode(IntEnum):
     """Set FreeType hinting mode."""
     # This enum contains flag combinations which are used in the
@@ -16,11 +16,29 @@ Module to diff fonts.
 """
 from __future__ import print_function
 import collections
-from diffenator import DiffTable, TXTFormatter, MDFormatter, HTMLFormatter, read_cbdt
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait
+)
+from diffenator import DiffTable, TXTFormatter, MDFormatter, HTMLFormatter
+from diffenator.cache import pack_tables, unpack_tables
+from diffenator.dump import read_cbdt
+from diffenator.font import (
+    DFont,
+    RAW_TABLES,
+    TABLE_BUILDERS,
+    TABLE_DEPENDENCIES
+)
+from diffenator.serialise import encode_row, header_record, table_record, \
+    write_records
+import heapq
+import multiprocessing
 import os
 import time
 import logging
-from PIL import Image
+import numpy as np
 
 
 __all__ = ['DiffFonts', 'diff_metrics', 'diff_kerning',
@@ -44,13 +62,122 @@ def timer(method):
     return timed
 
 
+# Dumps each diff category reads from both fonts, in the order
+# categories are diffed. The dumps these depend on are found in
+# TABLE_DEPENDENCIES.
+CATEGORY_DUMPS = {
+    "names": ("names",),
+    "attribs": ("attribs",),
+    "glyphs": ("glyphs", "glyph_store"),
+    "kerns": ("glyphset", "class_kerns"),
+    "metrics": ("metrics",),
+    "marks": ("marks",),
+    "mkmks": ("mkmks",),
+    "cbdt": ("glyphs",),
+    "gdef_base": ("gdef_base",),
+    "gdef_mark": ("gdef_mark",),
+}
+
+# Diff tables each category's diff function returns, as (subtable,
+# table name, renderable, report columns). Categories skipped because
+# their font tables are unchanged get these tables, empty.
+_GLYPH_ROWS = ["glyph", "area", "string"]
+_KERN_ROWS = ["left", "right", "value", "string"]
+_MARK_ROWS = ["base_glyph", "base_x", "base_y",
+              "mark_glyph", "mark_x", "mark_y"]
+_MARK_DIFF_ROWS = ["base_glyph", "mark_glyph", "diff_x", "diff_y"]
+CATEGORY_DIFF_TABLES = {
+    "names": (
+        ("new", "names new", False, ["id", "string"]),
+        ("missing", "names missing", False, ["id", "string"]),
+        ("modified", "names modified", False,
+         ["id", "string_a", "string_b"]),
+    ),
+    "attribs": (
+        ("modified", "attribs modified", False,
+         ["table", "attrib", "value_a", "value_b"]),
+    ),
+    "glyphs": (
+        ("new", "glyphs new", True, _GLYPH_ROWS),
+        ("missing", "glyphs missing", True, _GLYPH_ROWS),
+        ("modified", "glyphs modified", True, ["glyph", "diff", "string"]),
+    ),
+    "kerns": (
+        ("missing", "kerns missing", True, _KERN_ROWS),
+        ("new", "kerns new", True, _KERN_ROWS),
+        ("modified", "kerns modified", True,
+         ["left", "right", "diff", "string"]),
+    ),
+    "metrics": (
+        ("modified", "metrics modified", True, ["glyph", "diff_adv"]),
+    ),
+    "marks": (
+        ("new", "marks_new", True, _MARK_ROWS),
+        ("missing", "marks_missing", True, _MARK_ROWS),
+        ("modified", "marks_modified", True, _MARK_DIFF_ROWS),
+    ),
+    "mkmks": (
+        ("new", "mkmks_new", True, _MARK_ROWS),
+        ("missing", "mkmks_missing", True, _MARK_ROWS),
+        ("modified", "mkmks_modified", True, _MARK_DIFF_ROWS),
+    ),
+    "cbdt": (
+        ("modified", "cbdt glyphs modified", True,
+         ["glyph before", "glyph after", "diff", "string"]),
+    ),
+    "gdef_base": (
+        ("new", "gdef_base new", True, ["glyph"]),
+        ("missing", "gdef_base missing", True, ["glyph"]),
+    ),
+    "gdef_mark": (
+        ("new", "gdef_mark new", True, ["glyph"]),
+        ("missing", "gdef_mark missing", True, ["glyph"]),
+    ),
+}
+
+# Font tables categories read besides the tables their dumps are
+# built from
+CATEGORY_TABLES = {
+    "cbdt": ("CBDT", "CBLC"),
+}
+
+# Font tables glyph keys are made from, along with the glyph order.
+# Categories whose dumps read the glyphset depend on them.
+GLYPH_KEY_TABLES = ("cmap", "GSUB", "GDEF")
+
+# Font tables glyphs are rendered from besides their outlines
+RENDER_TABLES = ("fpgm", "prep", "cvt ", "cvar", "gasp")
+
+DIFF_POOLS = ("thread", "process")
+
+
 class DiffFonts:
     """Wrapper to diff all font tables
 
+    Categories are diffed one after another unless the diff_jobs
+    setting is above 1. They are then diffed concurrently over a
+    "thread" or "process" pool, set by diff_pool, and each dump is
+    built once, after the dumps it depends on. This only pays off when
+    the time is spread over several dumps. Each dump is built by a
+    single job, so a font whose marks dump takes most of the time, such
+    as one with many mark anchors, diffs little faster. Threads share
+    the parsed fonts and are cheaper to start, processes sidestep the
+    GIL but send their diff tables back.
+
+    Either font may be a DSnapshot. Categories which need the font
+    binary, cbdt and render diffs, are then skipped.
+
+    If the skip_unchanged setting is on, categories whose font tables
+    are byte for byte identical in both fonts get empty diff tables
+    without building any dumps.
+
+    Diff tables only keep their rows_limit most significant rows, and
+    write every row to spill_dir if it is set. See Tbl.select.
+
     Paramters
     ---------
-    font_before: DFont
-    font_after: DFont
+    font_before: DFont or DSnapshot
+    font_after: DFont or DSnapshot
     settings: dict
     """
 
@@ -60,18 +187,25 @@ class DiffFonts:
         mkmks_thresh=0,
         metrics_thresh=0,
         kerns_thresh=0,
+        kerns_limit=None,
         cbdt_thresh=0,
+        pixel_tolerance=0,
         to_diff=["*"],
         render_diffs=False,
+        render_jobs=1,
         render_path=False,
         html_output=False,
+        diff_jobs=1,
+        diff_pool="thread",
+        skip_unchanged=True,
+        rows_limit=None,
+        spill_dir=None,
     )
     def __init__(self, font_before, font_after, settings=None):
         self.font_before = font_before
         self.font_after = font_after
-        self.renderable = font_after.ftfont.is_scalable and font_before.ftfont.is_scalable
         self._data = collections.defaultdict(dict)
-        self._settings = self.SETTINGS
+        self._settings = dict(self.SETTINGS)
         if settings:
             for key in settings:
                 if key not in self._settings:
@@ -81,42 +215,158 @@ class DiffFonts:
         if "*" in self._settings["to_diff"]:
             self.run_all_diffs()
         else:
-            if "names" in self._settings["to_diff"]:
-                self.names()
-            if "attribs" in self._settings["to_diff"]:
-                self.attribs()
-            if "glyphs" in self._settings["to_diff"]:
-                self.glyphs(self._settings["glyphs_thresh"])
-            if "kerns" in self._settings["to_diff"]:
-                self.kerns(self._settings["kerns_thresh"])
-            if "metrics" in self._settings["to_diff"]:
-                self.metrics(self._settings["metrics_thresh"])
-            if "marks" in self._settings["to_diff"]:
-                self.marks(self._settings["marks_thresh"])
-            if "mkmks" in self._settings["to_diff"]:
-                self.mkmks(self._settings["mkmks_thresh"])
-            if "cbdt" in self._settings["to_diff"]:
-                self.cbdt(self._settings["cbdt_thresh"])
-            if "gdef_base" in self._settings["to_diff"]:
-                self.gdef_base()
-            if "gdef_mark" in self._settings["to_diff"]:
-                self.gdef_mark()
+            self.run_diffs([c for c in CATEGORY_DUMPS
+                            if c in self._settings["to_diff"]])
+
+    @property
+    def has_snapshot(self):
+        # Fonts which aren't DFonts are DSnapshots. diffenator.snapshot
+        # is only imported once a snapshot is diffed.
+        return not isinstance(self.font_before, DFont) or \
+               not isinstance(self.font_after, DFont)
+
+    @property
+    def renderable(self):
+        if self.has_snapshot:
+            return False
+        return self.font_after.ftfont.is_scalable and \
+               self.font_before.ftfont.is_scalable
 
     def run_all_diffs(self):
-        self.names()
-        self.attribs()
-        self.glyphs(self._settings["glyphs_thresh"])
-        self.kerns(self._settings["kerns_thresh"])
-        self.metrics(self._settings["metrics_thresh"])
-        self.marks(self._settings["marks_thresh"])
-        self.mkmks(self._settings["mkmks_thresh"])
-        self.cbdt(self._settings["cbdt_thresh"])
-        self.gdef_base()
-        self.gdef_mark()
+        self.run_diffs(list(CATEGORY_DUMPS))
+
+    def run_diffs(self, categories):
+        """Diff categories, concurrently if the diff_jobs setting is
+        above 1.
+
+        Parameters
+        ----------
+        categories: list
+            Category names from CATEGORY_DUMPS
+        """
+        if self.has_snapshot:
+            from diffenator.snapshot import SNAPSHOT_CATEGORIES
+            skipped = [c for c in categories if c not in SNAPSHOT_CATEGORIES]
+            if skipped:
+                logger.info("Skipping {}, snapshots can't be diffed for "
+                            "them".format(", ".join(skipped)))
+            categories = [c for c in categories if c in SNAPSHOT_CATEGORIES]
+
+        requested = categories
+        if self._settings["skip_unchanged"]:
+            unchanged = [c for c in categories if self.unchanged(c)]
+            if unchanged:
+                logger.info("Skipping {}, their tables are identical".format(
+                    ", ".join(unchanged)))
+            for category in unchanged:
+                self._data[category] = self._unchanged_tables(category)
+            categories = [c for c in categories if c not in unchanged]
+
+        jobs = self._settings["diff_jobs"] or os.cpu_count() or 1
+        jobs = min(jobs, len(categories))
+        if jobs <= 1:
+            for category in categories:
+                getattr(self, category)()
+        else:
+            self._run_pooled(categories, jobs)
+
+        # Keep reports in category order
+        for category in requested:
+            if category in self._data:
+                self._data[category] = self._data.pop(category)
+
+    def _unchanged_tables(self, category):
+        """Empty diff tables for a category which has no differences"""
+        tables = {}
+        for subtable, name, renderable, columns in \
+                CATEGORY_DIFF_TABLES[category]:
+            table = DiffTable(name, self.font_before, self.font_after,
+                              renderable=renderable)
+            table.report_columns(list(columns))
+            tables[subtable] = table
+        return tables
+
+    def _run_pooled(self, categories, jobs):
+        """Diff categories over the diff_pool setting's pool"""
+        pool = self._settings["diff_pool"]
+        if pool not in DIFF_POOLS:
+            raise ValueError("diff_pool must be one of {}".format(DIFF_POOLS))
+        if pool == "process" and \
+                "fork" not in multiprocessing.get_all_start_methods():
+            logger.info("Platform can't fork, diffing categories in threads")
+            pool = "thread"
+        if self._settings["render_jobs"] != 1:
+            # Categories already use every job, render glyph diffs
+            # serially
+            self._settings["render_jobs"] = 1
+
+        logger.info("Diffing {} categories over {} {}".format(
+            len(categories), jobs,
+            "threads" if pool == "thread" else "processes"))
+        if pool == "thread":
+            _diff_in_threads(self, categories, jobs)
+        else:
+            _diff_in_processes(self, categories, jobs)
+
+    def unchanged(self, category):
+        """Check whether both fonts have identical copies of every font
+        table a category reads, along with the same glyph order and
+        upm, so diffing it can't find any differences.
+
+        Tables are compared by the digests of their bytes in the font
+        files. Tables which may have changed since they were read, such
+        as those of VF instances, never match.
+
+        Parameters
+        ----------
+        category: str
+            Category name from CATEGORY_DUMPS
+
+        Returns
+        -------
+        bool
+        """
+        before, after = self.font_before, self.font_after
+        if before.upm != after.upm:
+            return False
+        sources = _dump_sources(CATEGORY_DUMPS[category])
+        sources.update(CATEGORY_TABLES.get(category, ()))
+        if "glyphset" in sources:
+            if before.glyph_order is None or \
+                    before.glyph_order != after.glyph_order:
+                return False
+            sources.update(GLYPH_KEY_TABLES)
+        if "glyf" in sources:
+            sources.add("loca")
+        if category == "glyphs" and self._settings["render_diffs"] and \
+                not self.has_snapshot and not _same_rendering(before, after):
+            return False
+        return _same_tables(before, after, sources - set(TABLE_BUILDERS))
 
     def to_dict(self):
-        serialised_data = self._serialise()
-        return serialised_data
+        """Diff tables as plain Python types.
+
+        Returns
+        -------
+        dict
+            The header record, with a "categories" dict which holds the
+            tables of each category. Each table has its rows and the
+            fields of its table record.
+        """
+        result = {}
+        for record in self._serialise():
+            record_type = record.pop("type")
+            if record_type == "header":
+                result.update(record, categories={})
+            elif record_type == "category":
+                tables = result["categories"][record["category"]] = {}
+            elif record_type == "table":
+                table = tables[record.pop("table")] = record
+                del table["category"]
+                table["rows"] = []
+            else:
+                table["rows"].append(record["row"])
+        return result
 
     def to_gifs(self, dst, limit=800):
         """output before and after gifs for table"""
@@ -147,20 +397,24 @@ class DiffFonts:
 
     def _to_report(self, limit=50, dst=None, r_type="txt", image_dir=None):
         """Output before and after report"""
-        reports = []
+        report_header = report_formatter(r_type, limit)
+        reports = [report_header.text]
+        reports += self.table_reports(limit, r_type, image_dir)
+
+        if dst:
+            with open(dst, 'w') as doc:
+                doc.write("\n\n".join(reports))
+        else:
+            return "\n\n".join(reports)
+
+    def table_reports(self, limit=50, r_type="txt", image_dir=None):
+        """Report each diff table which has differences.
 
-        if r_type == "txt":
-            report_header = TXTFormatter()
-        elif r_type == "md":
-            report_header = MDFormatter()
-        elif r_type == "html":
-            report_header = HTMLFormatter()
-
-        report_header.style()
-        report_header.heading("Diffenator")
-        report_header.paragraph(("Displaying the {} most significant items in "
-            "each table. To increase use the '-ol' flag").format(limit))
-        reports.append(report_header.text)
+        Returns
+        -------
+        list of str
+        """
+        reports = []
         for table in self._data:
             for subtable in self._data[table]:
                 current_table = self._data[table][subtable]
@@ -177,12 +431,7 @@ class DiffFonts:
                                        image=image))
                     else:
                         reports.append(current_table.to_html(limit=limit))
-
-        if dst:
-            with open(dst, 'w') as doc:
-                doc.write("\n\n".join(reports))
-        else:
-            return "\n\n".join(reports)
+        return reports
 
     def to_txt(self, limit=50, dst=None):
         """Output diff report as txt"""
@@ -196,10 +445,34 @@ class DiffFonts:
         return self._to_report(limit=limit, dst=dst, r_type="html",
                                image_dir=image_dir)
 
+    def to_json(self, dst=None):
+        """Write the diff tables as JSON Lines, one record per line.
+        See diffenator.serialise for the records.
+
+        Parameters
+        ----------
+        dst: str or file object
+            Path or file to write to. Defaults to stdout.
+        """
+        write_records(self._serialise(), "json", dst)
+
+    def to_msgpack(self, dst=None):
+        """Write the diff tables as a stream of MessagePack objects, one
+        per record. Needs msgpack."""
+        write_records(self._serialise(), "msgpack", dst)
+
     def _serialise(self):
-        """Serialiser for container data"""
-        # TODO (M Foley)
-        pass
+        """Yield the diff tables as records, category by category.
+        Every table is included, even if it has no rows."""
+        yield header_record(self.font_before, self.font_after,
+                            self._settings["rows_limit"])
+        for category in self._data:
+            yield dict(type="category", category=category)
+            for subtable, table in self._data[category].items():
+                yield table_record(category, subtable, table)
+                for row in table:
+                    yield dict(type="row", category=category,
+                               table=subtable, row=encode_row(row))
 
     def marks(self, threshold=None):
         if not threshold:
@@ -208,7 +481,8 @@ class DiffFonts:
                 self.font_before, self.font_after,
                 self.font_before.marks, self.font_after.marks,
                 name="marks",
-                thresh=threshold
+                thresh=threshold,
+                **self._table_options()
         )
 
     def mkmks(self, threshold=None):
@@ -218,7 +492,8 @@ class DiffFonts:
             self.font_before, self.font_after,
             self.font_before.mkmks, self.font_after.mkmks,
             name="mkmks",
-            thresh=threshold
+            thresh=threshold,
+            **self._table_options()
         )
 
     def cbdt(self, threshold=None, render_path=None, html_output=None):
@@ -230,40 +505,266 @@ class DiffFonts:
             html_output = self._settings["html_output"]
         self._data["cbdt"] = diff_cbdt_glyphs(
             self.font_before, self.font_after,
-            thresh=threshold, render_path=render_path, html_output=html_output
+            thresh=threshold, render_path=render_path, html_output=html_output,
+            pixel_tolerance=self._settings["pixel_tolerance"],
+            **self._table_options()
         )
 
     def metrics(self, threshold=None):
         if not threshold:
             threshold = self._settings["metrics_thresh"]
         self._data["metrics"] = diff_metrics(self.font_before, self.font_after,
-                thresh=threshold)
+                thresh=threshold, **self._table_options())
 
     def glyphs(self, threshold=None, render_diffs=None):
         if not threshold:
             threshold = self._settings["glyphs_thresh"]
         if not render_diffs:
             render_diffs = self._settings["render_diffs"]
+        if render_diffs and self.has_snapshot:
+            logger.info("Snapshots can't be rendered, skipping render diffs")
+            render_diffs = False
         self._data["glyphs"] = diff_glyphs(self.font_before, self.font_after,
-            thresh=threshold, render_diffs=render_diffs)
+            thresh=threshold, render_diffs=render_diffs,
+            pixel_tolerance=self._settings["pixel_tolerance"],
+            render_jobs=self._settings["render_jobs"],
+            **self._table_options())
 
     def kerns(self, threshold=None):
         if not threshold:
             threshold = self._settings["kerns_thresh"]
+        options = self._table_options()
+        if self._settings["kerns_limit"] is not None:
+            options["limit"] = self._settings["kerns_limit"]
         self._data["kerns"] = diff_kerning(self.font_before, self.font_after,
-            thresh=threshold)
+            thresh=threshold, **options)
 
     def attribs(self):
-        self._data["attribs"] = diff_attribs(self.font_before, self.font_after)
+        self._data["attribs"] = diff_attribs(self.font_before, self.font_after,
+                                             **self._table_options())
 
     def names(self):
-        self._data["names"] = diff_nametable(self.font_before, self.font_after)
+        self._data["names"] = diff_nametable(self.font_before, self.font_after,
+                                             **self._table_options())
 
     def gdef_base(self):
-        self._data["gdef_base"] = diff_gdef_base(self.font_before, self.font_after)
+        self._data["gdef_base"] = diff_gdef_base(self.font_before, self.font_after,
+                                                 **self._table_options())
 
     def gdef_mark(self):
-        self._data["gdef_mark"] = diff_gdef_mark(self.font_before, self.font_after)
+        self._data["gdef_mark"] = diff_gdef_mark(self.font_before, self.font_after,
+                                                 **self._table_options())
+
+    def _table_options(self):
+        """Options the diff functions select table rows with"""
+        return dict(limit=self._settings["rows_limit"],
+                    spill_dir=self._settings["spill_dir"])
+
+
+# Concurrent DiffFonts state for the current process. Workers inherit
+# it when they are forked.
+_diff = {}
+
+
+def _dump_sources(names):
+    """Dumps and font tables which dumps read, directly or through
+    other dumps"""
+    sources = set()
+    stack = list(names)
+    while stack:
+        name = stack.pop()
+        if name not in sources:
+            sources.add(name)
+            stack += TABLE_DEPENDENCIES.get(name, ())
+    return sources
+
+
+def _same_tables(font_before, font_after, tags):
+    """Check both fonts have byte for byte identical tags tables"""
+    for tag in tags:
+        digest = font_before.table_digest(tag)
+        if digest is None or digest != font_after.table_digest(tag):
+            return False
+    return True
+
+
+def _same_rendering(font_before, font_after):
+    """Check identical glyphs of both fonts render identically"""
+    return font_before.ft_load_glyph_flags == font_after.ft_load_glyph_flags \
+        and font_before.size == font_after.size \
+        and _same_tables(font_before, font_after, RENDER_TABLES)
+
+
+def _decompile_tables(font, names):
+    """Decompile the font tables which the dumps names read up front.
+
+    TTFont isn't safe to decompile a table from several threads at
+    once. RAW_TABLES are left to GlyphStore, which reads them through
+    the font's locked reader. head and the glyph order are read by
+    most dumps."""
+    ttfont = font.ttfont
+    ttfont.getGlyphOrder()
+    for tag in _dump_sources(names) | {"head", "maxp"}:
+        if tag not in RAW_TABLES and tag in ttfont:
+            ttfont[tag]
+
+
+def _builder_dumps(builder):
+    """Names of the dumps a DFont table builder makes"""
+    return [n for n, b in TABLE_BUILDERS.items() if b == builder]
+
+
+def _dump_tasks(tasks, font_idx, font, names):
+    """Add a task to build each of names, and the dumps they depend on,
+    which font doesn't have yet. Return the tasks names need."""
+    needed = set()
+    for name in names:
+        if name in font._tables:
+            continue
+        task = ("dump", font_idx, TABLE_BUILDERS[name])
+        needed.add(task)
+        if task in tasks:
+            continue
+        tasks[task] = set()
+        deps = [d for n in _builder_dumps(task[2])
+                for d in TABLE_DEPENDENCIES[n] if d in TABLE_BUILDERS]
+        tasks[task] = _dump_tasks(tasks, font_idx, font, deps)
+    return needed
+
+
+def _diff_tasks(fonts, categories):
+    """Return a dict of each task needed to diff categories to the
+    tasks it depends on.
+
+    Tasks are ("dump", font index, table builder) or
+    ("diff", category) tuples."""
+    tasks = {}
+    for category in categories:
+        deps = set()
+        for idx, font in enumerate(fonts):
+            deps |= _dump_tasks(tasks, idx, font, CATEGORY_DUMPS[category])
+        tasks[("diff", category)] = deps
+    return tasks
+
+
+def _task_dumps(tasks, task):
+    """Dump tasks task depends on, directly or through other dumps"""
+    result = set()
+    stack = list(tasks[task])
+    while stack:
+        dep = stack.pop()
+        if dep not in result:
+            result.add(dep)
+            stack += tasks[dep]
+    return result
+
+
+def _run_task(diff_fonts, task):
+    if task[0] == "dump":
+        fonts = (diff_fonts.font_before, diff_fonts.font_after)
+        fonts[task[1]]._table(_builder_dumps(task[2])[0])
+    else:
+        getattr(diff_fonts, task[1])()
+
+
+def _diff_in_threads(diff_fonts, categories, jobs):
+    """Diff categories over a thread pool.
+
+    Each dump both fonts need is built by its own task, which starts
+    once the dumps it depends on are done. A category is diffed once
+    its dumps are done."""
+    pending = _diff_tasks((diff_fonts.font_before, diff_fonts.font_after),
+                          categories)
+    for idx, font in enumerate((diff_fonts.font_before,
+                                diff_fonts.font_after)):
+        if isinstance(font, DFont):
+            _decompile_tables(font, [
+                name for task in pending if task[:2] == ("dump", idx)
+                for name in _builder_dumps(task[2])])
+    running = {}
+    done = set()
+    with ThreadPoolExecutor(jobs) as pool:
+        while pending or running:
+            for task in [t for t, deps in pending.items() if deps <= done]:
+                del pending[task]
+                running[pool.submit(_run_task, diff_fonts, task)] = task
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+                done.add(running.pop(future))
+
+
+def _init_diff_worker():
+    """Drop the FreeType faces inherited from the parent, so each
+    worker opens its own faces on first use"""
+    diff_fonts = _diff["diff_fonts"]
+    for font in (diff_fonts.font_before, diff_fonts.font_after):
+        font._ftfont = None
+
+
+def _diff_categories(categories):
+    """Diff categories using the DiffFonts in _diff. Return their
+    diff tables packed by pack_tables."""
+    diff_fonts = _diff["diff_fonts"]
+    for category in categories:
+        getattr(diff_fonts, category)()
+    return pack_tables((diff_fonts.font_before, diff_fonts.font_after),
+                       {c: diff_fonts._data[c] for c in categories})
+
+
+def _diff_in_processes(diff_fonts, categories, jobs):
+    """Diff categories over a pool of forked processes.
+
+    Dumps which other dumps depend on, such as the glyphset, are built
+    here first so every worker inherits them. Categories which build
+    the same remaining dumps are diffed by the same worker. Only diff
+    tables are sent back, dumps built by workers are dropped with
+    them."""
+    fonts = (diff_fonts.font_before, diff_fonts.font_after)
+    tasks = _diff_tasks(fonts, categories)
+    shared = set().union(*(deps for task, deps in tasks.items()
+                           if task[0] == "dump"))
+    # Workers reference glyphs in the tables they return by name, the
+    # glyphsets must match
+    shared |= {t for t in tasks if t[0] == "dump" and t[2] == "glyphset"}
+    for task in shared:
+        _run_task(diff_fonts, task)
+
+    tasks = _diff_tasks(fonts, categories)
+    groups = []
+    for category in categories:
+        group = ([category], _task_dumps(tasks, ("diff", category)))
+        for other in [g for g in groups if g[1] & group[1]]:
+            groups.remove(other)
+            group = (other[0] + group[0], other[1] | group[1])
+        groups.append(group)
+
+    _diff["diff_fonts"] = diff_fonts
+    try:
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(min(jobs, len(groups)), mp_context=context,
+                                 initializer=_init_diff_worker) as pool:
+            for packed in pool.map(_diff_categories, [g[0] for g in groups]):
+                diff_fonts._data.update(unpack_tables(fonts, packed))
+    finally:
+        _diff.clear()
+
+
+FORMATTERS = {
+    "txt": TXTFormatter,
+    "md": MDFormatter,
+    "html": HTMLFormatter,
+}
+
+
+def report_formatter(r_type="txt", limit=50):
+    """Return a formatter of r_type with the report heading written"""
+    report_header = FORMATTERS[r_type]()
+    report_header.style()
+    report_header.heading("Diffenator")
+    report_header.paragraph(("Displaying the {} most significant items in "
+        "each table. To increase use the '-ol' flag").format(limit))
+    return report_header
 
 
 def _subtract_items(items_a, items_b):
@@ -272,7 +773,7 @@ def _subtract_items(items_a, items_b):
 
 
 @timer
-def diff_nametable(font_before, font_after):
+def diff_nametable(font_before, font_after, limit=None, spill_dir=None):
     """Find nametable differences between two fonts.
 
     Rows are matched by attribute id.
@@ -281,6 +782,11 @@ def diff_nametable(font_before, font_after):
     ----------
     font_before: DFont
     font_after: DFont
+    limit: int
+        Amount of the most significant rows to keep for each table.
+        Table counts include every row. Keep all rows if None.
+    spill_dir: str
+        Directory to write every row of each table to, see Tbl.select
 
     Returns
     -------
@@ -298,13 +804,13 @@ def diff_nametable(font_before, font_after):
 
     new = DiffTable("names new", font_before, font_after, data=new)
     new.report_columns(["id", "string"])
-    new.sort(key=lambda k: k["id"])
+    new.select(limit, key=lambda k: k["id"], spill_dir=spill_dir)
     missing = DiffTable("names missing", font_before, font_after, data=missing)
     missing.report_columns(["id", "string"])
-    missing.sort(key=lambda k: k["id"])
+    missing.select(limit, key=lambda k: k["id"], spill_dir=spill_dir)
     modified = DiffTable("names modified", font_before, font_after, data=modified)
     modified.report_columns(["id", "string_a", "string_b"])
-    modified.sort(key=lambda k: k["id"])
+    modified.select(limit, key=lambda k: k["id"], spill_dir=spill_dir)
     return {
         'new': new,
         'missing': missing,
@@ -329,7 +835,8 @@ def _modified_names(names_before, names_after):
 
 @timer
 def diff_glyphs(font_before, font_after,
-                thresh=0.00, scale_upms=True, render_diffs=False):
+                thresh=0.00, scale_upms=True, render_diffs=False,
+                pixel_tolerance=0, render_jobs=1, limit=None, spill_dir=None):
     """Find glyph differences between two fonts.
 
     Rows are matched by glyph key, which consists of
@@ -348,6 +855,15 @@ def diff_glyphs(font_before, font_after,
         pixels.
         If False, diff glyphs by calculating the surface area of each glyph.
         Return ratio of changed surface area.
+    pixel_tolerance: int
+        When rendering, ignore pixels which differ by no more than this
+    render_jobs: int
+        Amount of processes to render glyphs with, None for the cpu count
+    limit: int
+        Amount of the most significant rows to keep for each table.
+        Table counts include every row. Keep all rows if None.
+    spill_dir: str
+        Directory to write every row of each table to, see Tbl.select
 
     Returns
     -------
@@ -367,19 +883,22 @@ def diff_glyphs(font_before, font_after,
     missing = _subtract_items(glyphs_before_h, glyphs_after_h)
     new = _subtract_items(glyphs_after_h, glyphs_before_h)
     modified = _modified_glyphs(glyphs_before_h, glyphs_after_h, thresh,
-                                scale_upms=scale_upms, render_diffs=render_diffs)
+                                scale_upms=scale_upms, render_diffs=render_diffs,
+                                pixel_tolerance=pixel_tolerance,
+                                render_jobs=render_jobs)
     
     new = DiffTable("glyphs new", font_before, font_after, data=new, renderable=True)
     new.report_columns(["glyph", "area", "string"])
-    new.sort(key=lambda k: k["glyph"].name)
+    new.select(limit, key=lambda k: k["glyph"].name, spill_dir=spill_dir)
 
     missing = DiffTable("glyphs missing", font_before, font_after, data=missing, renderable=True)
     missing.report_columns(["glyph", "area", "string"])
-    missing.sort(key=lambda k: k["glyph"].name)
+    missing.select(limit, key=lambda k: k["glyph"].name, spill_dir=spill_dir)
 
     modified = DiffTable("glyphs modified", font_before, font_after, data=modified, renderable=True)
     modified.report_columns(["glyph", "diff", "string"])
-    modified.sort(key=lambda k: abs(k["diff"]), reverse=True)
+    modified.select(limit, key=lambda k: abs(k["diff"]), reverse=True,
+                    spill_dir=spill_dir)
     return {
         'new': new,
         'missing': missing,
@@ -389,10 +908,13 @@ def diff_glyphs(font_before, font_after,
 
 def _modified_glyphs(glyphs_before, glyphs_after, thresh=0.00,
                      upm_before=None, upm_after=None, scale_upms=False,
-                     render_diffs=False):
-    shared = set(glyphs_before.keys()) & set(glyphs_after.keys())
+                     render_diffs=False, pixel_tolerance=0, render_jobs=1):
+    shared = [k for k in glyphs_before if k in glyphs_after]
+    shared = _changed_keys(glyphs_before, glyphs_after, shared,
+                           rendered=render_diffs)
 
-    table = []
+    diffs = {}
+    to_render = []
     for k in shared:
         glyph_before = glyphs_before[k]
         glyph_after = glyphs_after[k]
@@ -401,39 +923,150 @@ def _modified_glyphs(glyphs_before, glyphs_after, thresh=0.00,
             glyph_after['area'] = (glyph_after['area'] / upm_after) * upm_before
 
         if render_diffs:
-            diff = diff_rendering(glyph_before['glyph'], glyph_after['glyph'])
+            fingerprint = glyph_before['glyph'].fingerprint
+            # Identical outlines render identically
+            if not fingerprint or fingerprint != glyph_after['glyph'].fingerprint:
+                to_render.append((k, glyph_before['glyph'], glyph_after['glyph']))
         else:
             # using abs does not take into consideration if a curve is reversed
             area_before = abs(glyph_before['area'])
             area_after = abs(glyph_after['area'])
-            diff = diff_area(area_before, area_after)
+            diffs[k] = diff_area(area_before, area_after)
+    if to_render:
+        diffs.update(diff_renderings(to_render, jobs=render_jobs,
+                                     tolerance=pixel_tolerance))
+
+    table = []
+    for k, diff in diffs.items():
         if diff > thresh:
-            glyph = glyph_before
+            glyph = glyphs_before[k]
             glyph['diff'] = round(diff, 4)
             table.append(glyph)
     return table
 
 
-def diff_rendering(glyph_before, glyph_after, ft_size=1500):
+def _changed_keys(rows_before, rows_after, keys, rendered=False):
+    """Keys of the rows whose glyphs have different raw data, see
+    GlyphStore.digests. Glyphs with identical raw data have the same
+    area and metrics, and render the same if both fonts share the
+    tables they are rendered from.
+
+    Every key is kept if the fonts have different upms, if either font
+    has no glyph digests, or if rendered is set and the fonts may render
+    identical glyphs differently.
+    """
+    if not keys:
+        return keys
+    font_before = rows_before[keys[0]]['glyph'].font
+    font_after = rows_after[keys[0]]['glyph'].font
+    if font_before.upm != font_after.upm:
+        return keys
+    digests_before = font_before.glyph_store.digests
+    digests_after = font_after.glyph_store.digests
+    if digests_before is None or digests_after is None:
+        return keys
+    if rendered and not _same_rendering(font_before, font_after):
+        return keys
+    changed = [k for k in keys
+               if digests_before[rows_before[k]['glyph'].index] !=
+               digests_after[rows_after[k]['glyph'].index]]
+    logger.debug("{} of {} shared glyphs changed".format(
+        len(changed), len(keys)))
+    return changed
+
+
+def diff_rendering(glyph_before, glyph_after, ft_size=1500, tolerance=0):
     """Diff two glyphs by rendering them. Return pixel differences
     as a percentage"""
-    font_before = glyph_before.font
-    font_before.ftfont.set_char_size(ft_size)
-    font_after = glyph_after.font
-    font_after.ftfont.set_char_size(ft_size)
+    return _diff_glyph_bitmaps(glyph_before.font, glyph_before.index,
+                               glyph_after.font, glyph_after.index,
+                               ft_size, tolerance)
+
+
+def _diff_glyph_bitmaps(font_before, index_before, font_after, index_after,
+                        ft_size=1500, tolerance=0):
+    pixels_before = font_before.render_glyph(index_before, ft_size).pixels
+    pixels_after = font_after.render_glyph(index_after, ft_size).pixels
+    return _diff_pixels(pixels_before, pixels_after, tolerance)
+
+
+# Render diff state for the current process. Workers inherit it when
+# they are forked.
+_render = {}
+
+# Chunks of glyphs handed to each render worker at a time
+RENDER_CHUNKS_PER_JOB = 4
+
 
-    # Image before
-    font_before.ftfont.load_glyph(glyph_before.index, flags=font_before.ft_load_glyph_flags)
-    bitmap_before = font_before.ftslot.bitmap
-    img_before = Image.new("L", (bitmap_before.width, bitmap_before.rows))
-    img_before.putdata(bitmap_before.buffer)
+def _init_render_worker():
+    """Drop the FreeType faces inherited from the parent, so each
+    worker opens its own faces on first use"""
+    for font in _render["fonts"]:
+        font._ftfont = None
 
-    # Image after
-    font_after.ftfont.load_glyph(glyph_after.index, flags=font_after.ft_load_glyph_flags)
-    bitmap_after = font_after.ftslot.bitmap
-    img_after = Image.new("L", (bitmap_after.width, bitmap_after.rows))
-    img_after.putdata(bitmap_after.buffer)
-    return _diff_images(img_before, img_after)
+
+def _diff_render_chunk(chunk):
+    """Render diff a list of (key, index_before, index_after) using
+    the fonts in _render"""
+    font_before, font_after = _render["fonts"]
+    return [(key, _diff_glyph_bitmaps(font_before, index_before,
+                                      font_after, index_after,
+                                      _render["ft_size"], _render["tolerance"]))
+            for key, index_before, index_after in chunk]
+
+
+def diff_renderings(pairs, jobs=1, tolerance=0, ft_size=1500):
+    """Render diff pairs of glyphs, optionally over a process pool.
+
+    Each worker opens its own FreeType faces for both fonts once and
+    diffs chunks of glyph ids. Glyphs are diffed in this process if
+    jobs is 1 or the platform can't fork.
+
+    Parameters
+    ----------
+    pairs: list
+        (key, glyph_before, glyph_after) tuples. All glyphs before
+        must belong to one font, and all glyphs after to another.
+    jobs: int
+        Amount of processes to use. None uses the cpu count.
+    tolerance: int
+        Ignore pixels which differ by no more than this
+    ft_size: int
+        FreeType char size to render at
+
+    Yields
+    ------
+    tuple
+        (key, diff) for each pair, in order
+    """
+    jobs = min(jobs or os.cpu_count() or 1, len(pairs))
+    if jobs > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        logger.info("Platform can't fork, rendering glyphs serially")
+        jobs = 1
+    if jobs <= 1:
+        for key, glyph_before, glyph_after in pairs:
+            yield key, diff_rendering(glyph_before, glyph_after, ft_size, tolerance)
+        return
+
+    glyphs = [(key, before.index, after.index) for key, before, after in pairs]
+    chunk_size = -(-len(glyphs) // (jobs * RENDER_CHUNKS_PER_JOB))
+    chunks = [glyphs[i:i + chunk_size] for i in range(0, len(glyphs), chunk_size)]
+    _render.update(
+        fonts=(pairs[0][1].font, pairs[0][2].font),
+        ft_size=ft_size,
+        tolerance=tolerance,
+    )
+    logger.info("Rendering {} glyph pairs over {} processes".format(
+        len(glyphs), jobs))
+    try:
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(jobs, mp_context=context,
+                                 initializer=_init_render_worker) as pool:
+            for results in pool.map(_diff_render_chunk, chunks):
+                for result in results:
+                    yield result
+    finally:
+        _render.clear()
 
 
 def diff_area(area_before, area_after):
@@ -448,45 +1081,71 @@ def diff_area(area_before, area_after):
     return diff
 
 
-def _diff_images(img_before, img_after):
+def _diff_images(img_before, img_after, tolerance=0):
     """Compare two rendered images and return the ratio of changed
     pixels.
+
+    Both images are centered on a canvas the size of the largest one.
+    Pixels outside either image count as changed.
+
+    Parameters
+    ----------
+    img_before: PIL.Image
+    img_after: PIL.Image
+    tolerance: int
+        Pixels whose channels differ by no more than this count as
+        unchanged.
+
     TODO (M FOLEY) Crop images so there are no sidebearings to glyphs"""
-    width_before, height_before = img_before.size
-    width_after, height_after = img_after.size
-    data_before = img_before.getdata()
-    data_after = img_after.getdata()
+    if img_before.mode != img_after.mode:
+        img_before = img_before.convert("RGBA")
+        img_after = img_after.convert("RGBA")
+    return _diff_pixels(np.asarray(img_before), np.asarray(img_after),
+                        tolerance)
+
+
+def _diff_pixels(pixels_before, pixels_after, tolerance=0):
+    """_diff_images for rows x columns (x channels) pixel arrays"""
+    height_before, width_before = pixels_before.shape[:2]
+    height_after, width_after = pixels_after.shape[:2]
 
     width, height = max(width_before, width_after), max(height_before, height_after)
+    if not width * height:
+        return 0.0
     offset_ax = (width - width_before) // 2
     offset_ay = (height - height_before) // 2
     offset_bx = (width - width_after) // 2
     offset_by = (height - height_after) // 2
 
-    diff = 0
-    for y in range(height):
-        for x in range(width):
-            ax, ay = x - offset_ax, y - offset_ay
-            bx, by = x - offset_bx, y - offset_by
-            if (ax < 0 or bx < 0 or ax >= width_before or bx >= width_after or
-                ay < 0 or by < 0 or ay >= height_before or by >= height_after):
-                diff += 1
-            else:
-                if data_before[ax + ay *width_before] != data_after[bx + by * width_after]:
-                    diff += 1
-    try:
-        return round(diff / float(width * height), 4)
-    except ZeroDivisionError:
-        return 0.0
+    # Only the area both images cover can be unchanged
+    x0, x1 = max(offset_ax, offset_bx), min(offset_ax + width_before, offset_bx + width_after)
+    y0, y1 = max(offset_ay, offset_by), min(offset_ay + height_before, offset_by + height_after)
+    diff = width * height
+    if x1 > x0 and y1 > y0:
+        data_before = pixels_before[
+            y0 - offset_ay:y1 - offset_ay, x0 - offset_ax:x1 - offset_ax]
+        data_after = pixels_after[
+            y0 - offset_by:y1 - offset_by, x0 - offset_bx:x1 - offset_bx]
+        changed = np.abs(data_before.astype(np.int16) -
+                         data_after.astype(np.int16)) > tolerance
+        if changed.ndim == 3:
+            changed = changed.any(axis=2)
+        diff -= changed.size - int(np.count_nonzero(changed))
+    return round(diff / float(width * height), 4)
 
 
 @timer
-def diff_kerning(font_before, font_after, thresh=2, scale_upms=True):
+def diff_kerning(font_before, font_after, thresh=2, scale_upms=True,
+                 limit=None, spill_dir=None):
     """Find kerning differences between two fonts.
 
-    Class kerns are flattened and then tested for differences.
+    Class kerns aren't flattened. Glyphs which share a key in both
+    fonts are grouped by the classes they kern with in each font, and
+    the kerning between each group is compared as a matrix. Only
+    changed cells are expanded into glyph pairs. Pair kerns override
+    the cell they fall in.
 
-    Rows are matched by the left and right glyph keys.
+    A kern value of 0 counts as no kern.
 
     Some fonts use a kern table instead of gpos kerns, test these
     if no gpos kerns exist. This problem exists in Open Sans v1.
@@ -499,6 +1158,12 @@ def diff_kerning(font_before, font_after, thresh=2, scale_upms=True):
     scale_upms:
         Scale values in relation to the font's upms. See readme
         for example.
+    limit: int
+        Amount of the most serious rows to keep for each table. Table
+        counts include every changed pair. Keep all rows if None.
+    spill_dir: str
+        Directory to write every changed pair of each table to, see
+        Tbl.select. Every pair then gets expanded.
 
     Returns
     -------
@@ -509,65 +1174,182 @@ def diff_kerning(font_before, font_after, thresh=2, scale_upms=True):
             "modified": [diff_table]
         }
     """
-    kern_before = font_before.kerns
-    kern_after = font_after.kerns
-
-    upm_before = font_before.ttfont['head'].unitsPerEm
-    upm_after = font_after.ttfont['head'].unitsPerEm
+    kern_before = font_before.class_kerns
+    kern_after = font_after.class_kerns
+
+    upm_before = font_before.upm
+    upm_after = font_after.upm
+    scale = upm_before / float(upm_after) if scale_upms else 1
+
+    glyphs_before = {g.key: g for g in font_before.glyphset.values()}
+    glyphs_after = {g.key: g for g in font_after.glyphset.values()}
+    keys = [k for k in glyphs_before if k in glyphs_after]
+    shared_before = [glyphs_before[k] for k in keys]
+    shared_after = [glyphs_after[k] for k in keys]
+    ids_before = np.array([g.index for g in shared_before], dtype=np.intp)
+    ids_after = np.array([g.index for g in shared_after], dtype=np.intp)
+
+    left_reps, left_groups = _group_glyphs(np.hstack(
+        [kern_before.left_classes[ids_before], kern_after.left_classes[ids_after]]))
+    right_reps, right_groups = _group_glyphs(np.hstack(
+        [kern_before.right_classes[ids_before], kern_after.right_classes[ids_after]]))
+    cells_before = kern_before.matrix(ids_before[left_reps], ids_before[right_reps])
+    cells_after = kern_after.matrix(ids_after[left_reps], ids_after[right_reps])
+
+    pairs = set()
+    for kerning, ids in ((kern_before, ids_before), (kern_after, ids_after)):
+        positions = {glyph_id: idx for idx, glyph_id in enumerate(ids.tolist())}
+        for left, right in kerning.pairs():
+            if left in positions and right in positions:
+                pairs.add((positions[left], positions[right]))
+    pairs = sorted(pairs)
+    pairs_before = np.array([kern_before.value(ids_before[l], ids_before[r])
+                             for l, r in pairs], dtype=np.int64)
+    pairs_after = np.array([kern_after.value(ids_after[l], ids_after[r])
+                            for l, r in pairs], dtype=np.int64)
+    # Glyph pairs in each cell which class kerns apply to
+    cell_sizes = np.outer(np.bincount(left_groups, minlength=len(left_reps)),
+                          np.bincount(right_groups, minlength=len(right_reps)))
+    if pairs:
+        pair_cells = np.array([(left_groups[l], right_groups[r]) for l, r in pairs])
+        np.subtract.at(cell_sizes, (pair_cells[:, 0], pair_cells[:, 1]), 1)
+
+    expander = _KernExpander(left_groups, right_groups, pairs)
+    tables = {}
+    for name, before, after in (("missing", True, False),
+                                ("new", False, True),
+                                ("modified", True, True)):
+        if name == "modified":
+            cell_values = cells_after * scale - cells_before
+            pair_values = pairs_after * scale - pairs_before
+            cell_mask = (cells_before != 0) & (cells_after != 0) & \
+                        (np.abs(cell_values) > thresh)
+            pair_mask = (pairs_before != 0) & (pairs_after != 0) & \
+                        (np.abs(pair_values) > thresh)
+            column = "diff"
+        else:
+            cell_values = cells_before if before else cells_after
+            pair_values = pairs_before if before else pairs_after
+            cell_others = cells_after if before else cells_before
+            pair_others = pairs_after if before else pairs_before
+            cell_mask = (cell_values != 0) & (cell_others == 0)
+            pair_mask = (pair_values != 0) & (pair_others == 0)
+            column = "value"
+        glyphs = shared_after if name == "new" else shared_before
+
+        # Pairs are expanded most serious first, only expand the pairs
+        # which are kept unless every pair gets spilled
+        rows = (_kern_row(glyphs[left], glyphs[right], column, value)
+                for left, right, value in expander.expand(
+                    cell_mask, cell_values, pair_mask, pair_values,
+                    None if spill_dir else limit))
+        table = DiffTable("kerns " + name, font_before, font_after,
+                          renderable=True)
+        table.report_columns(["left", "right", column, "string"])
+        table.select(limit, spill_dir=spill_dir, rows=rows)
+        table.count = int(cell_sizes[cell_mask].sum() + pair_mask.sum())
+        table.summary = _kern_summary(cell_sizes[cell_mask],
+                                      cell_values[cell_mask],
+                                      pair_values[pair_mask])
+        tables[name] = table
+    return tables
 
-    charset_before = set([font_before.glyph(g).key for g in font_before.glyphset])
-    charset_after = set([font_after.glyph(g).key for g in font_after.glyphset])
 
-    kern_before_h = {i['left'].key + i['right'].key: i for i in kern_before
-                if i['left'].key in charset_after and i['right'].key in charset_after}
-    kern_after_h = {i['left'].key + i['right'].key: i for i in kern_after
-                if i['left'].key in charset_before and i['right'].key in charset_before}
-
-    missing = _subtract_items(kern_before_h, kern_after_h)
-    missing = [i for i in missing if abs(i["value"]) >= 1]
-    new = _subtract_items(kern_after_h, kern_before_h)
-    new = [i for i in new if abs(i["value"]) >= 1]
-    modified = _modified_kerns(kern_before_h, kern_after_h, thresh,
-                               upm_before, upm_after, scale_upms=scale_upms)
-    missing = DiffTable("kerns missing", font_before, font_after, data=missing, renderable=True)
-    missing.report_columns(["left", "right", "value", "string"])
-    missing.sort(key=lambda k: abs(k["value"]), reverse=True)
-
-    new = DiffTable("kerns new", font_before, font_after, data=new, renderable=True)
-    new.report_columns(["left", "right", "value", "string"])
-    new.sort(key=lambda k: abs(k["value"]), reverse=True)
-    
-    modified = DiffTable("kerns modified", font_before, font_after, data=modified, renderable=True)
-    modified.report_columns(["left", "right", "diff", "string"])
-    modified.sort(key=lambda k: abs(k["diff"]), reverse=True)
-    return {
-        'new': new,
-        'missing': missing,
-        'modified': modified,
-    }
+def _kern_summary(cell_sizes, cell_values, pair_values):
+    """min, max and mean of the absolute kern values of changed pairs,
+    see Tbl.summary"""
+    cell_values = np.abs(cell_values[cell_sizes > 0]).astype(float)
+    cell_sizes = cell_sizes[cell_sizes > 0]
+    pair_values = np.abs(pair_values).astype(float)
+    count = cell_sizes.sum() + len(pair_values)
+    if not count:
+        return None
+    values = np.concatenate([cell_values, pair_values])
+    total = (cell_values * cell_sizes).sum() + pair_values.sum()
+    return dict(min=values.min().item(), max=values.max().item(),
+                mean=(total / count).item())
 
 
-def _modified_kerns(kern_before, kern_after, thresh=2,
-                    upm_before=None, upm_after=None, scale_upms=False):
-    shared = set(kern_before.keys()) & set(kern_after.keys())
+def _group_glyphs(classes):
+    """Group glyphs whose rows of classes are equal.
 
-    table = []
-    for k in shared:
-        if scale_upms and upm_before and upm_after:
-            kern_before[k]['value'] = (kern_before[k]['value'] / float(upm_before)) * upm_before
-            kern_after[k]['value'] = (kern_after[k]['value'] / float(upm_after)) * upm_before
-
-        diff = kern_after[k]['value'] - kern_before[k]['value']
-        if abs(diff) > thresh:
-            kern_diff = kern_before[k]
-            kern_diff['diff'] = kern_after[k]['value'] - kern_before[k]['value']
-            del kern_diff['value']
-            table.append(kern_diff)
-    return table
+    Returns
+    -------
+    tuple
+        The index of a glyph in each group, and the group of each glyph
+    """
+    if not classes.shape[1]:
+        return np.zeros(min(len(classes), 1), dtype=np.intp), \
+               np.zeros(len(classes), dtype=np.intp)
+    _, reps, groups = np.unique(classes, axis=0, return_index=True,
+                                return_inverse=True)
+    return reps, groups.ravel()
+
+
+class _KernExpander:
+    """Expand changed kern cells into glyph pairs, most serious
+    first"""
+    def __init__(self, left_groups, right_groups, pairs):
+        self._pairs = pairs
+        self._pair_set = set(pairs)
+        self._left_members = self._members(left_groups)
+        self._right_members = self._members(right_groups)
+
+    def _members(self, groups):
+        order = np.argsort(groups, kind="stable")
+        bounds = np.cumsum(np.bincount(groups))[:-1] if len(groups) else []
+        return [m.tolist() for m in np.split(order, bounds)]
+
+    def expand(self, cell_mask, cell_values, pair_mask, pair_values,
+               limit=None):
+        """Yield (left, right, value) for changed glyph pairs"""
+        cells = np.argwhere(cell_mask)
+        # Candidates are popped most serious first, so only the ones
+        # which get expanded are ordered
+        candidates = [(-abs(cell_values[l, r]), 0, idx, (l, r))
+                      for idx, (l, r) in enumerate(cells.tolist())]
+        candidates += [(-abs(pair_values[idx]), 1, idx, self._pairs[idx])
+                       for idx in np.flatnonzero(pair_mask).tolist()]
+        heapq.heapify(candidates)
+
+        count = 0
+        while candidates:
+            _, is_pair, idx, (left, right) = heapq.heappop(candidates)
+            if is_pair:
+                pairs = [(left, right, pair_values[idx])]
+            else:
+                value = cell_values[left, right]
+                pairs = ((l, r, value)
+                         for l in self._left_members[left]
+                         for r in self._right_members[right]
+                         if (l, r) not in self._pair_set)
+            for left_glyph, right_glyph, value in pairs:
+                if limit is not None and count >= limit:
+                    return
+                yield left_glyph, right_glyph, value.item()
+                count += 1
+
+
+def _kern_row(left, right, column, value):
+    return {
+        'left': left,
+        'right': right,
+        column: value,
+        'string': left.characters + right.characters,
+        'description': u'{}+{} | {}'.format(
+            left.name,
+            right.name,
+            left.features),
+        "features": left.features + right.features,
+        'htmlfeatures': u'{}, {}'.format(
+            ', '.join(left.features),
+            ', '.join(right.features))
+    }
 
 
 @timer
-def diff_metrics(font_before, font_after, thresh=1, scale_upms=True):
+def diff_metrics(font_before, font_after, thresh=1, scale_upms=True,
+                 limit=None, spill_dir=None):
     """Find metrics differences between two fonts.
 
     Rows are matched by each using glyph key, which consists of
@@ -582,6 +1364,11 @@ def diff_metrics(font_before, font_after, thresh=1, scale_upms=True):
     scale_upms:
         Scale values in relation to the font's upms. See readme
         for example.
+    limit: int
+        Amount of the most significant rows to keep for each table.
+        Table counts include every row. Keep all rows if None.
+    spill_dir: str
+        Directory to write every row of each table to, see Tbl.select
 
     Returns
     -------
@@ -595,8 +1382,8 @@ def diff_metrics(font_before, font_after, thresh=1, scale_upms=True):
     metrics_before = font_before.metrics
     metrics_after = font_after.metrics
 
-    upm_before = font_before.ttfont['head'].unitsPerEm
-    upm_after = font_after.ttfont['head'].unitsPerEm
+    upm_before = font_before.upm
+    upm_after = font_after.upm
 
     metrics_before_h = {i['glyph'].key: i for i in metrics_before}
     metrics_after_h = {i['glyph'].key: i for i in metrics_after}
@@ -605,7 +1392,8 @@ def diff_metrics(font_before, font_after, thresh=1, scale_upms=True):
             upm_before, upm_after, scale_upms)
     modified = DiffTable("metrics modified", font_before, font_after, data=modified, renderable=True)
     modified.report_columns(["glyph", "diff_adv"])
-    modified.sort(key=lambda k: k["diff_adv"], reverse=True)
+    modified.select(limit, key=lambda k: k["diff_adv"], reverse=True,
+                    spill_dir=spill_dir)
     return {
             'modified': modified
             }
@@ -614,26 +1402,35 @@ def diff_metrics(font_before, font_after, thresh=1, scale_upms=True):
 def _modified_metrics(metrics_before, metrics_after, thresh=2,
                       upm_before=None, upm_after=None, scale_upms=False):
 
-    shared = set(metrics_before.keys()) & set(metrics_after.keys())
+    shared = [k for k in metrics_before if k in metrics_after]
+    shared = _changed_keys(metrics_before, metrics_after, shared)
+    if not shared:
+        return []
+    columns = ('adv', 'lsb', 'rsb')
+    before = np.array([[metrics_before[k][c] for c in columns] for k in shared],
+                      dtype=float)
+    after = np.array([[metrics_after[k][c] for c in columns] for k in shared],
+                     dtype=float)
+    if scale_upms and upm_before and upm_after:
+        after *= float(upm_before) / upm_after
+
+    diff_adv = np.abs(after[:, 0] - before[:, 0])
+    diff_lsb = after[:, 1] - before[:, 1]
+    diff_rsb = after[:, 2] - before[:, 2]
 
     table = []
-    for k in shared:
-        if scale_upms and upm_before and upm_after:
-            metrics_before[k]['adv'] = (metrics_before[k]['adv'] / float(upm_before)) * upm_before
-            metrics_after[k]['adv'] = (metrics_after[k]['adv'] / float(upm_after)) * upm_before
-
-        diff = abs(metrics_after[k]['adv'] - metrics_before[k]['adv'])
-        if diff > thresh:
-            metrics = metrics_before[k]
-            metrics['diff_adv'] = diff
-            metrics['diff_lsb'] = metrics_after[k]['lsb'] - metrics_after[k]['lsb']
-            metrics['diff_rsb'] = metrics_after[k]['rsb'] - metrics_after[k]['rsb']
-            table.append(metrics)
+    for idx in np.flatnonzero(diff_adv > thresh).tolist():
+        metrics = metrics_before[shared[idx]]
+        metrics['diff_adv'] = float(diff_adv[idx])
+        metrics['diff_lsb'] = float(diff_lsb[idx])
+        metrics['diff_rsb'] = float(diff_rsb[idx])
+        table.append(metrics)
     return table
 
 
 @timer
-def diff_attribs(font_before, font_after, scale_upm=True):
+def diff_attribs(font_before, font_after, scale_upm=True, limit=None,
+                 spill_dir=None):
     """Find attribute differences between two fonts.
 
     Rows are matched by using attrib.
@@ -645,6 +1442,11 @@ def diff_attribs(font_before, font_after, scale_upm=True):
     scale_upms:
         Scale values in relation to the font's upms. See readme
         for example.
+    limit: int
+        Amount of the most significant rows to keep for each table.
+        Table counts include every row. Keep all rows if None.
+    spill_dir: str
+        Directory to write every row of each table to, see Tbl.select
 
     Returns
     -------
@@ -656,8 +1458,8 @@ def diff_attribs(font_before, font_after, scale_upm=True):
     attribs_before = font_before.attribs
     attribs_after = font_after.attribs
 
-    upm_before = font_before.ttfont['head'].unitsPerEm
-    upm_after = font_after.ttfont['head'].unitsPerEm
+    upm_before = font_before.upm
+    upm_after = font_after.upm
 
     attribs_before_h = {i['attrib']: i for i in attribs_before}
     attribs_after_h = {i['attrib']: i for i in attribs_after}
@@ -666,7 +1468,7 @@ def diff_attribs(font_before, font_after, scale_upm=True):
                                  upm_before, upm_after, scale_upm=scale_upm)
     modified = DiffTable("attribs modified", font_before, font_after, data=modified)
     modified.report_columns(["table", "attrib", "value_a", "value_b"])
-    modified.sort(key=lambda k: k["table"])
+    modified.select(limit, key=lambda k: k["table"], spill_dir=spill_dir)
     return {'modified': modified}
 
 
@@ -716,7 +1518,8 @@ def _modified_attribs(attribs_before, attribs_after,
 
 @timer
 def diff_marks(font_before, font_after, marks_before, marks_after,
-               name=None, thresh=4, scale_upms=True):
+               name=None, thresh=4, scale_upms=True, limit=None,
+               spill_dir=None):
     """diff mark positioning.
 
     Marks are flattened first.
@@ -733,6 +1536,11 @@ def diff_marks(font_before, font_after, marks_before, marks_after,
     scale_upms:
         Scale values in relation to the font's upms. See readme
         for example.
+    limit: int
+        Amount of the most significant rows to keep for each table.
+        Table counts include every row. Keep all rows if None.
+    spill_dir: str
+        Directory to write every row of each table to, see Tbl.select
 
     Returns
     -------
@@ -743,8 +1551,8 @@ def diff_marks(font_before, font_after, marks_before, marks_after,
             "modified": [diff_table]
         }
     """
-    upm_before = font_before.ttfont['head'].unitsPerEm
-    upm_after = font_after.ttfont['head'].unitsPerEm
+    upm_before = font_before.upm
+    upm_after = font_after.upm
 
     charset_before = set([font_before.glyph(g).key for g in font_before.glyphset])
     charset_after = set([font_after.glyph(g).key for g in font_after.glyphset])
@@ -762,19 +1570,22 @@ def diff_marks(font_before, font_after, marks_before, marks_after,
     new = DiffTable(name + "_new", font_before, font_after, data=new, renderable=True)
     new.report_columns(["base_glyph", "base_x", "base_y",
                         "mark_glyph", "mark_x", "mark_y"])
-    new.sort(key=lambda k: abs(k["base_x"]) - abs(k["mark_x"]) + \
-                           abs(k["base_y"]) - abs(k["mark_y"]))
+    new.select(limit, key=lambda k: abs(k["base_x"]) - abs(k["mark_x"]) + \
+                                  abs(k["base_y"]) - abs(k["mark_y"]),
+               spill_dir=spill_dir)
 
     missing = DiffTable(name + "_missing", font_before, font_after, data=missing,
                         renderable=True)
     missing.report_columns(["base_glyph", "base_x", "base_y",
                             "mark_glyph", "mark_x", "mark_y"])
-    missing.sort(key=lambda k: abs(k["base_x"]) - abs(k["mark_x"]) + \
-                               abs(k["base_y"]) - abs(k["mark_y"]))
+    missing.select(limit, key=lambda k: abs(k["base_x"]) - abs(k["mark_x"]) + \
+                                      abs(k["base_y"]) - abs(k["mark_y"]),
+                   spill_dir=spill_dir)
     modified = DiffTable(name + "_modified", font_before, font_after, data=modified,
                          renderable=True)
     modified.report_columns(["base_glyph", "mark_glyph", "diff_x", "diff_y"])
-    modified.sort(key=lambda k: abs(k["diff_x"]) + abs(k["diff_y"]), reverse=True)
+    modified.select(limit, key=lambda k: abs(k["diff_x"]) + abs(k["diff_y"]),
+                    reverse=True, spill_dir=spill_dir)
     return {
         "new": new,
         "missing": missing,
@@ -814,7 +1625,8 @@ def _modified_marks(marks_before, marks_after, thresh=4,
 
 
 @timer
-def diff_cbdt_glyphs(font_before, font_after, thresh=4, render_path=None, html_output=False):
+def diff_cbdt_glyphs(font_before, font_after, thresh=4, render_path=None, html_output=False,
+                     pixel_tolerance=0, limit=None, spill_dir=None):
     cbdt_before = read_cbdt(font_before.ttfont)
     cbdt_after = read_cbdt(font_after.ttfont)
 
@@ -826,7 +1638,8 @@ def diff_cbdt_glyphs(font_before, font_after, thresh=4, render_path=None, html_o
         glyph_name_before = chars_before[char]
         glyph_name_after = chars_after[char]
         if glyph_name_before in cbdt_before and glyph_name_after in cbdt_after:
-            diff = _diff_images(cbdt_before[glyph_name_before], cbdt_after[glyph_name_after])
+            diff = _diff_images(cbdt_before[glyph_name_before], cbdt_after[glyph_name_after],
+                                pixel_tolerance)
             if diff > thresh:
                 modified.append({
                     "glyph before": glyph_name_before,
@@ -841,7 +1654,8 @@ def diff_cbdt_glyphs(font_before, font_after, thresh=4, render_path=None, html_o
         modified.report_columns(["glyph before", "glyph after", "diff", "string", "image"])
     else:
         modified.report_columns(["glyph before", "glyph after", "diff", "string"])
-    modified.sort(key=lambda k: abs(k["diff"]), reverse=True)
+    modified.select(limit, key=lambda k: abs(k["diff"]), reverse=True,
+                    spill_dir=spill_dir)
 
     return {
         "modified": modified
@@ -849,19 +1663,19 @@ def diff_cbdt_glyphs(font_before, font_after, thresh=4, render_path=None, html_o
 
 
 @timer
-def diff_gdef_base(font_before, font_after):
+def diff_gdef_base(font_before, font_after, limit=None, spill_dir=None):
     """Diff gdef base glyphs"""
-    tables = _gdef(font_before, font_after, "gdef_base")
+    tables = _gdef(font_before, font_after, "gdef_base", limit, spill_dir)
     return tables
 
 
 @timer
-def diff_gdef_mark(font_before, font_after):
+def diff_gdef_mark(font_before, font_after, limit=None, spill_dir=None):
     """Diff gdef mark glyphs"""
-    return _gdef(font_before, font_after, "gdef_mark")
+    return _gdef(font_before, font_after, "gdef_mark", limit, spill_dir)
 
 
-def _gdef(font_before, font_after, type_):
+def _gdef(font_before, font_after, type_, limit=None, spill_dir=None):
     base_before = getattr(font_before, type_)
     base_after = getattr(font_after, type_)
 
@@ -872,10 +1686,12 @@ def _gdef(font_before, font_after, type_):
     new = _subtract_items(base_after_h, base_before_h)
     new = DiffTable(f"{type_} new", font_before, font_after, data=new, renderable=True)
     new.report_columns(["glyph"])
-    new.sort(key=lambda k: k["glyph"].width, reverse=True)
+    new.select(limit, key=lambda k: k["glyph"].width, reverse=True,
+               spill_dir=spill_dir)
     missing = DiffTable(f"{type_} missing", font_before, font_after, data=missing, renderable=True)
     missing.report_columns(["glyph"])
-    missing.sort(key=lambda k: k["glyph"].width, reverse=True)
+    missing.select(limit, key=lambda k: k["glyph"].width, reverse=True,
+                   spill_dir=spill_dir)
     return {
         "new": new,
         "missing": missing,
@@ -1,7 +1,14 @@
 from diffenator import DFontTable, DFontTableIMG
 from fontTools.pens.areaPen import AreaPen
+from fontTools.pens.recordingPen import RecordingPen
+from array import array
+from collections import namedtuple
 import datetime
+import hashlib
+import io
 import logging
+import struct
+import numpy as np
 
 logging.basicConfig(level=logging.WARN)
 logger = logging.getLogger('fontdiffenator')
@@ -195,6 +202,361 @@ def glyph_area(glyphset, glyph):
     return int(pen.value)
 
 
+def _cross(a, b):
+    return a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+
+
+def _glyf_point_deltas(flags, data, short_bit, same_bit):
+    """Decode the x or y deltas of packed glyf points"""
+    short = (flags & short_bit) != 0
+    same = (flags & same_bit) != 0
+    sizes = np.where(short, 1, np.where(same, 0, 2))
+    offsets = np.cumsum(sizes) - sizes
+    raw = np.frombuffer(bytes(data), dtype=np.uint8)
+    deltas = np.zeros(len(flags))
+    idx = np.flatnonzero(short)
+    deltas[idx] = np.where(same[idx], 1, -1) * raw[offsets[idx]]
+    idx = np.flatnonzero(sizes == 2)
+    deltas[idx] = ((raw[offsets[idx]].astype(np.uint16) << 8) |
+                   raw[offsets[idx] + 1]).astype(np.int16)
+    return deltas
+
+
+def _unpack_glyf_glyph(data):
+    """Split a compiled simple glyf glyph into its end points, expanded
+    flags and packed x and y coordinate data."""
+    num_contours = struct.unpack(">h", data[:2])[0]
+    end_pts = struct.unpack(">%dH" % num_contours, data[10:10 + 2 * num_contours])
+    pos = 10 + 2 * num_contours
+    pos += 2 + struct.unpack(">H", data[pos:pos + 2])[0]
+    num_points = end_pts[-1] + 1
+    flags = bytearray()
+    x_size = y_size = 0
+    while len(flags) < num_points:
+        flag = data[pos]
+        repeat = 1
+        if flag & 0x08:
+            repeat += data[pos + 1]
+            pos += 1
+        pos += 1
+        flags.extend(bytes((flag,)) * repeat)
+        x_size += repeat * (1 if flag & 0x02 else 0 if flag & 0x10 else 2)
+        y_size += repeat * (1 if flag & 0x04 else 0 if flag & 0x20 else 2)
+    x_data = data[pos:pos + x_size]
+    y_data = data[pos + x_size:pos + x_size + y_size]
+    return end_pts, flags[:num_points], x_data, y_data
+
+
+def _contour_areas(points, on_curve, ends, owners, point_counts, count):
+    """Sum the signed area of each owner's TrueType contours"""
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    next_pt = np.arange(1, len(points) + 1)
+    next_pt[ends] = starts
+    prev_pt = np.arange(-1, len(points) - 1)
+    prev_pt[starts] = ends
+
+    next_points = points[next_pt]
+    prev_points = points[prev_pt]
+    next_on = on_curve[next_pt]
+    prev_on = on_curve[prev_pt]
+
+    # Six times the area each point's outgoing segment adds
+    terms = np.zeros(len(points))
+    line = on_curve & next_on
+    terms[line] = 3 * _cross(points[line], next_points[line])
+
+    off = ~on_curve
+    control = points[off]
+    start = np.where(prev_on[off, None], prev_points[off],
+                     (prev_points[off] + control) / 2)
+    end = np.where(next_on[off, None], next_points[off],
+                   (control + next_points[off]) / 2)
+    terms[off] = 3 * _cross(start, end) + \
+                 2 * _cross(control - start, end - start)
+
+    point_owners = np.repeat(owners, point_counts)
+    return np.bincount(point_owners, weights=terms, minlength=count) / 6
+
+
+GlyfOutlines = namedtuple("GlyfOutlines", [
+    "points", "on_curve", "ends", "owners", "counts", "composites"])
+
+
+def glyf_outlines(ttfont):
+    """Decode the points of every simple glyph in a glyf font at once.
+
+    Glyphs which haven't been decompiled are decoded straight from
+    their compiled data.
+
+    Parameters
+    ----------
+    ttfont: TTFont
+
+    Returns
+    -------
+    GlyfOutlines
+        points, on_curve and ends hold the points, on curve flags and
+        contour end points of all simple glyphs, one glyph after the
+        other. owners and counts are the id and point count of each of
+        those glyphs. composites maps composite glyph ids to their
+        components.
+    """
+    glyf = ttfont['glyf']
+    glyph_order = ttfont.getGlyphOrder()
+    composites = {}
+    # Compiled and decompiled glyph points
+    packed = dict(flags=bytearray(), x=bytearray(), y=bytearray(),
+                  ends=[], owners=[], counts=[])
+    loaded = dict(coords=array("d"), flags=bytearray(),
+                  ends=[], owners=[], counts=[])
+    for glyph_id, name in enumerate(glyph_order):
+        glyph = glyf.glyphs[name]
+        data = getattr(glyph, "data", None)
+        if data is not None:
+            if len(data) < 10:
+                continue
+            num_contours = struct.unpack(">h", data[:2])[0]
+            if num_contours == 0:
+                continue
+            if num_contours < 0:
+                composites[glyph_id] = glyf[name].components
+                continue
+            end_pts, flags, x_data, y_data = _unpack_glyf_glyph(data)
+            group = packed
+            group["x"].extend(x_data)
+            group["y"].extend(y_data)
+        elif glyph.isComposite():
+            composites[glyph_id] = glyph.components
+            continue
+        elif glyph.numberOfContours <= 0:
+            continue
+        else:
+            end_pts, flags = glyph.endPtsOfContours, glyph.flags
+            group = loaded
+            group["coords"].extend(glyph.coordinates.array)
+        offset = len(group["flags"])
+        group["flags"].extend(flags)
+        group["ends"].extend(offset + e for e in end_pts)
+        group["owners"].append(glyph_id)
+        group["counts"].append(len(flags))
+
+    points, flags, ends = [np.zeros((0, 2))], [np.zeros(0, dtype=np.uint8)], []
+    if packed["owners"]:
+        packed_flags = np.frombuffer(bytes(packed["flags"]), dtype=np.uint8)
+        deltas = np.stack([
+            _glyf_point_deltas(packed_flags, packed["x"], 0x02, 0x10),
+            _glyf_point_deltas(packed_flags, packed["y"], 0x04, 0x20),
+        ], axis=1)
+        # Deltas are relative to the previous point of the same glyph
+        totals = np.cumsum(deltas, axis=0)
+        glyph_ends = np.cumsum(packed["counts"]) - 1
+        before = np.zeros((len(glyph_ends), 2))
+        before[1:] = totals[glyph_ends[:-1]]
+        points.append(totals - np.repeat(before, packed["counts"], axis=0))
+        flags.append(packed_flags)
+    if loaded["owners"]:
+        points.append(np.frombuffer(loaded["coords"], dtype=np.float64).reshape(-1, 2))
+        flags.append(np.frombuffer(bytes(loaded["flags"]), dtype=np.uint8))
+    offset = 0
+    for group in (packed, loaded):
+        ends.append(np.array(group["ends"], dtype=np.intp) + offset)
+        offset += len(group["flags"])
+
+    return GlyfOutlines(
+        points=np.concatenate(points),
+        on_curve=(np.concatenate(flags) & 1).astype(bool),
+        ends=np.concatenate(ends),
+        owners=np.array(packed["owners"] + loaded["owners"], dtype=np.intp),
+        counts=np.array(packed["counts"] + loaded["counts"], dtype=np.intp),
+        composites=composites,
+    )
+
+
+def glyf_areas(ttfont, outlines=None):
+    """Get the surface area of every glyph in a glyf font.
+
+    Areas match glyph_area, except they are exact while AreaPen can
+    accumulate float error, which int() may truncate by a unit. The
+    contours of all simple glyphs are measured at once. Each line
+    segment adds its shoelace term and each quadratic segment adds its
+    chord's term plus 2/3 of the triangle formed by the chord and the
+    control point. Implied on-curve points sit between two off-curve
+    points. Composite glyphs add up their components' areas, scaled by
+    each component's transform.
+
+    Parameters
+    ----------
+    ttfont: TTFont
+    outlines: GlyfOutlines
+        The font's decoded outlines, decoded here if not given
+
+    Returns
+    -------
+    np.ndarray
+        Areas indexed by glyph id
+    """
+    if outlines is None:
+        outlines = glyf_outlines(ttfont)
+    glyph_count = len(ttfont.getGlyphOrder())
+    areas = np.zeros(glyph_count)
+    if len(outlines.owners):
+        areas += _contour_areas(outlines.points, outlines.on_curve,
+                                outlines.ends, outlines.owners,
+                                outlines.counts, glyph_count)
+
+    composites = outlines.composites
+    glyph_ids = ttfont.getReverseGlyphMap()
+    resolved = set()
+
+    def composite_area(glyph_id):
+        if glyph_id in resolved:
+            return areas[glyph_id]
+        resolved.add(glyph_id)
+        area = 0.0
+        for component in composites[glyph_id]:
+            component_id = glyph_ids[component.glyphName]
+            if component_id in composites:
+                component_area = composite_area(component_id)
+            else:
+                component_area = areas[component_id]
+            if hasattr(component, "transform"):
+                (xx, xy), (yx, yy) = component.transform
+                component_area *= xx * yy - xy * yx
+            area += component_area
+        areas[glyph_id] = area
+        return area
+
+    for glyph_id in composites:
+        composite_area(glyph_id)
+    return np.trunc(areas).astype(np.int64)
+
+
+# Tables whose programs can change every hinted glyph
+HINTING_TABLES = ("fpgm", "prep", "cvt ")
+
+
+def _glyf_instructions(glyf, name):
+    """Get a glyph's TrueType instructions without decompiling simple
+    glyphs"""
+    glyph = glyf.glyphs[name]
+    data = getattr(glyph, "data", None)
+    if data is not None and len(data) >= 10:
+        num_contours = struct.unpack(">h", data[:2])[0]
+        if num_contours >= 0:
+            pos = 10 + 2 * num_contours
+            length = struct.unpack(">H", data[pos:pos + 2])[0]
+            return bytes(data[pos + 2:pos + 2 + length])
+        glyph = glyf[name]
+    if hasattr(glyph, "program"):
+        return glyph.program.getBytecode()
+    return b""
+
+
+# Component flags which change where a component is drawn:
+# ROUND_XY_TO_GRID, SCALED_COMPONENT_OFFSET and UNSCALED_COMPONENT_OFFSET
+COMPONENT_PLACEMENT_FLAGS = 0x0004 | 0x0800 | 0x1000
+
+
+def glyph_fingerprints(ttfont, hinted=False, outlines=None):
+    """Hash the outline of every glyph.
+
+    Glyphs with equal fingerprints render identically at the same
+    pixel size. Simple glyphs hash their coordinates divided by the
+    upm, their contour end points and on curve flags. Composite glyphs
+    hash their components' fingerprints, transforms and offsets.
+
+    Parameters
+    ----------
+    ttfont: TTFont
+    hinted: bool
+        Include the glyph and font hinting programs in glyf
+        fingerprints. Hinted CFF glyphs aren't fingerprinted.
+    outlines: GlyfOutlines
+        A glyf font's decoded outlines, decoded here if not given
+
+    Returns
+    -------
+    list
+        A 16 byte digest for each glyph id, or None for glyphs which
+        couldn't be fingerprinted
+    """
+    upm = float(ttfont['head'].unitsPerEm)
+    glyph_order = ttfont.getGlyphOrder()
+    if 'glyf' not in ttfont:
+        if hinted:
+            return [None] * len(glyph_order)
+        glyphset = ttfont.getGlyphSet()
+        fingerprints = []
+        for name in glyph_order:
+            pen = RecordingPen()
+            glyphset[name].draw(pen)
+            digest = hashlib.blake2b(digest_size=16)
+            for operator, points in pen.value:
+                digest.update(operator.encode("ascii"))
+                digest.update((np.array(points, dtype=np.float64) / upm).tobytes())
+            fingerprints.append(digest.digest())
+        return fingerprints
+
+    if outlines is None:
+        outlines = glyf_outlines(ttfont)
+    glyf = ttfont['glyf']
+    font_hints = b""
+    if hinted:
+        font_hints = b"hinted" + b"".join(
+            ttfont.getTableData(tag) for tag in HINTING_TABLES if tag in ttfont)
+
+    def new_digest(glyph_id):
+        digest = hashlib.blake2b(font_hints, digest_size=16)
+        if hinted:
+            digest.update(_glyf_instructions(glyf, glyph_order[glyph_id]))
+        return digest
+
+    fingerprints = [None] * len(glyph_order)
+    scaled = outlines.points / upm
+    stops = np.cumsum(outlines.counts)
+    starts = stops - outlines.counts
+    # Range of contours which belong to each glyph
+    contour_stops = np.searchsorted(outlines.ends, stops)
+    contour_starts = np.concatenate(([0], contour_stops[:-1]))
+    for idx, glyph_id in enumerate(outlines.owners.tolist()):
+        start, stop = starts[idx], stops[idx]
+        digest = new_digest(glyph_id)
+        digest.update(scaled[start:stop].tobytes())
+        ends = outlines.ends[contour_starts[idx]:contour_stops[idx]] - start
+        digest.update(ends.astype(np.int32).tobytes())
+        digest.update(outlines.on_curve[start:stop].tobytes())
+        fingerprints[glyph_id] = digest.digest()
+
+    composites = outlines.composites
+    for glyph_id in range(len(glyph_order)):
+        if fingerprints[glyph_id] is None and glyph_id not in composites:
+            fingerprints[glyph_id] = new_digest(glyph_id).digest()
+
+    glyph_ids = ttfont.getReverseGlyphMap()
+
+    def composite_fingerprint(glyph_id):
+        if fingerprints[glyph_id] is not None:
+            return fingerprints[glyph_id]
+        digest = new_digest(glyph_id)
+        digest.update(b"composite")
+        for component in composites[glyph_id]:
+            digest.update(composite_fingerprint(glyph_ids[component.glyphName]))
+            transform = getattr(component, "transform", ((1, 0), (0, 1)))
+            digest.update(np.array(transform, dtype=np.float64).tobytes())
+            if hasattr(component, "firstPt"):
+                digest.update(struct.pack(">2H", component.firstPt, component.secondPt))
+            else:
+                offset = np.array([component.x, component.y], dtype=np.float64)
+                digest.update((offset / upm).tobytes())
+            digest.update(struct.pack(">H", component.flags & COMPONENT_PLACEMENT_FLAGS))
+        fingerprints[glyph_id] = digest.digest()
+        return fingerprints[glyph_id]
+
+    for glyph_id in composites:
+        composite_fingerprint(glyph_id)
+    return fingerprints
+
+
 def dump_glyphs(font):
     """Dump info for each glyph in a font
 
@@ -214,12 +576,12 @@ def dump_glyphs(font):
             ...
         ]
     """
-    glyphset = font.ttfont.getGlyphSet()
+    areas = font.glyph_store.area
     table = DFontTableIMG(font, "glyphs", renderable=True)
     for name, glyph in sorted(font.glyphset.items()):
         table.append({
             "glyph": glyph,
-            "area": glyph_area(glyphset, name),
+            "area": int(areas[glyph.index]),
             "string": glyph.characters,
             'features': glyph.features,
             'htmlfeatures': u', '.join(glyph.features)
@@ -250,28 +612,17 @@ def dump_glyph_metrics(font):
     """
     table = DFontTableIMG(font, "metrics", renderable=True)
 
-    glyphset = font.ttfont.getGlyphSet()
-    for name, glyph in font.glyphset.items():
-        adv = font.ttfont["hmtx"][name][0]
-        if "glyf" in font.ttfont.keys():
-            try:
-                lsb = font.ttfont["glyf"][name].xMin
-                rsb = adv - font.ttfont['glyf'][name].xMax
-            except AttributeError:
-                lsb = 0
-                rsb = 0
-        elif "CFF " in font.ttfont.keys():
-            try:
-                bounds = font.ttfont["CFF "].cff.values()[0].CharStrings[name].calcBounds(glyphset)
-                lsb = bounds[0]
-                rsb = adv - bounds[-2]
-            except TypeError:
-                lsb = 0
-                rsb = 0
-        else:
-            raise Exception("Only ttf and otf fonts are supported")
+    store = font.glyph_store
+    glyphs = list(font.glyphset.values())
+    indexes = np.array([g.index for g in glyphs], dtype=np.intp)
+    adv = store.advance[indexes]
+    empty = store.empty[indexes]
+    lsb = np.where(empty, 0, store.bounds[indexes, 0])
+    rsb = np.where(empty, 0, adv - store.bounds[indexes, 2])
+    for glyph, glyph_lsb, glyph_rsb, glyph_adv in zip(
+            glyphs, lsb.tolist(), rsb.tolist(), adv.tolist()):
         table.append({'glyph': glyph,
-                'lsb': lsb, 'rsb': rsb, 'adv': adv,
+                'lsb': glyph_lsb, 'rsb': glyph_rsb, 'adv': glyph_adv,
                 'string': glyph.characters,
                 'description': u'{} | {}'.format(
                     glyph.name, glyph.features
@@ -290,49 +641,33 @@ def _kerning_lookup_indexes(font):
     return None
 
 
-def _flatten_pair_kerning(table, results):
-    """Flatten pair on pair kerning"""
-    seen = set(results)
-    first_glyphs = {idx: g for idx, g in enumerate(table.Coverage.glyphs)}
-
-    for idx, pairset in enumerate(table.PairSet):
-        first_glyph = first_glyphs[idx]
-
+def _pair_kerns(table):
+    """Yield (left, right, value) for pair on pair kerning"""
+    for first_glyph, pairset in zip(table.Coverage.glyphs, table.PairSet):
         for record in pairset.PairValueRecord:
-
             if not hasattr(record.Value1, "XAdvance"):
                 continue
-            kern = (first_glyph, record.SecondGlyph, record.Value1.XAdvance)
+            yield first_glyph, record.SecondGlyph, record.Value1.XAdvance
 
-            if kern not in seen:
-                results.append(kern)
-                seen.add(kern)
 
+def _class_kerns(table, glyph_order):
+    """Yield (left, right, value) for class on class kerning.
 
-def _flatten_class_kerning(table, results):
-    """Flatten class on class kerning"""
-    seen = set(results)
+    Glyphs which aren't in ClassDef2 are in class 0."""
     classes1 = _kern_class(table.ClassDef1.classDefs, table.Coverage.glyphs)
-    classes2 = _kern_class(table.ClassDef2.classDefs, table.Coverage.glyphs)
+    classes2 = _kern_class(table.ClassDef2.classDefs, glyph_order)
 
     for idx1, class1 in enumerate(table.Class1Record):
+        if idx1 not in classes1:
+            continue
         for idx2, class2 in enumerate(class1.Class2Record):
-
-            if idx1 not in classes1:
-                continue
             if idx2 not in classes2:
                 continue
-
-            if not hasattr(class2.Value1, 'XAdvance'):
+            if not _x_advance(class2.Value1):
                 continue
-            if abs(class2.Value1.XAdvance) > 0:
-                for glyph1 in classes1[idx1]:
-                    for glyph2 in classes2[idx2]:
-
-                        kern = (glyph1, glyph2, class2.Value1.XAdvance)
-                        if kern not in seen:
-                            results.append(kern)
-                            seen.add(kern)
+            for glyph1 in classes1[idx1]:
+                for glyph2 in classes2[idx2]:
+                    yield glyph1, glyph2, class2.Value1.XAdvance
 
 
 def _kern_class(class_definition, coverage_glyphs):
@@ -351,14 +686,205 @@ def _kern_class(class_definition, coverage_glyphs):
         classes[idx].append(glyph)
         seen_glyphs.add(glyph)
 
-    classes[0] = set(coverage_glyphs) - seen_glyphs
+    classes[0] = [g for g in coverage_glyphs if g not in seen_glyphs]
     return classes
 
 
-def dump_kerning(font):
-    """Dump a font's kerning.
+class ClassKernLookup:
+    """Kerning of a single GPOS lookup or kern subtable.
 
-    If no GPOS kerns exist, try and dump the kern table instead
+    Pair kerns are kept as a dict. Class kerns keep their ClassDefs as
+    arrays indexed by glyph id, and their values as a matrix for each
+    subtable. The first subtable which covers a pair kerns it, as in
+    shaping engines.
+
+    Attributes
+    ----------
+    pairs: dict
+        {(left_id, right_id): value}
+    left_subtable: np.ndarray
+        Class subtable which kerns each left glyph, -1 if none do
+    left_class: np.ndarray
+        ClassDef1 class of each left glyph
+    right_class: np.ndarray
+        ClassDef2 class of each right glyph, a column for each subtable
+    values: list of np.ndarray
+        Class1 x Class2 XAdvance matrix of each subtable
+    """
+    def __init__(self, glyph_count):
+        self.pairs = {}
+        self.left_subtable = np.full(glyph_count, -1, dtype=np.int32)
+        self.left_class = np.zeros(glyph_count, dtype=np.int32)
+        self._right_classes = []
+        self.values = []
+
+    @property
+    def right_class(self):
+        if not self._right_classes:
+            return np.zeros((len(self.left_class), 0), dtype=np.int32)
+        return np.column_stack(self._right_classes)
+
+    def add_pairs(self, pairs):
+        """Add (left_id, right_id, value) kerns. Pairs which an earlier
+        subtable kerns are skipped."""
+        for left, right, value in pairs:
+            if self.left_subtable[left] >= 0 or (left, right) in self.pairs:
+                continue
+            self.pairs[(left, right)] = value
+
+    def add_classes(self, coverage, class_def1, class_def2, values):
+        """Add a class kern subtable.
+
+        Parameters
+        ----------
+        coverage: list
+            Ids of the glyphs the subtable covers
+        class_def1: dict
+            {glyph_id: class}
+        class_def2: dict
+            {glyph_id: class}
+        values: np.ndarray
+            Class1 x Class2 matrix of kern values
+        """
+        subtable = len(self.values)
+        class1_count, class2_count = values.shape
+        left_class = np.zeros(len(self.left_class), dtype=np.int32)
+        for glyph_id, cls in class_def1.items():
+            if cls < class1_count:
+                left_class[glyph_id] = cls
+        coverage = np.array(coverage, dtype=np.intp)
+        coverage = coverage[self.left_subtable[coverage] < 0]
+        self.left_subtable[coverage] = subtable
+        self.left_class[coverage] = left_class[coverage]
+
+        right_class = np.zeros(len(self.left_class), dtype=np.int32)
+        for glyph_id, cls in class_def2.items():
+            if cls < class2_count:
+                right_class[glyph_id] = cls
+        self._right_classes.append(right_class)
+        self.values.append(values)
+
+    def value(self, left, right):
+        """Kern value of a pair of glyph ids"""
+        if (left, right) in self.pairs:
+            return self.pairs[(left, right)]
+        subtable = self.left_subtable[left]
+        if subtable < 0:
+            return 0
+        right_class = self._right_classes[subtable][right]
+        return int(self.values[subtable][self.left_class[left], right_class])
+
+
+class ClassKerning:
+    """A font's kerning, with class kerns kept as classes.
+
+    Flattening class kerns gives every glyph pair of every class pair,
+    which is millions of rows for large fonts. Glyphs with the same
+    classes in each lookup kern alike, so kerning can be compared a
+    class at a time. The values of several lookups add up.
+
+    Parameters
+    ----------
+    glyph_count: int
+    lookups: list of ClassKernLookup
+    """
+    def __init__(self, glyph_count, lookups=None):
+        self.glyph_count = glyph_count
+        self.lookups = lookups or []
+
+    @property
+    def left_classes(self):
+        """Subtable and class of each left glyph in each lookup. Glyphs
+        with equal rows kern alike when on the left."""
+        columns = []
+        for lookup in self.lookups:
+            columns.append(lookup.left_subtable)
+            columns.append(np.where(lookup.left_subtable >= 0,
+                                    lookup.left_class, -1))
+        return self._stack(columns)
+
+    @property
+    def right_classes(self):
+        """Class of each right glyph in each subtable. Glyphs with
+        equal rows kern alike when on the right."""
+        return self._stack([l.right_class for l in self.lookups])
+
+    def _stack(self, columns):
+        if not columns:
+            return np.zeros((self.glyph_count, 0), dtype=np.int32)
+        return np.column_stack(columns)
+
+    def pairs(self):
+        """Glyph id pairs which have pair kerns"""
+        pairs = set()
+        for lookup in self.lookups:
+            pairs.update(lookup.pairs)
+        return pairs
+
+    def value(self, left, right):
+        """Kern value of a pair of glyph ids"""
+        return sum(l.value(left, right) for l in self.lookups)
+
+    def matrix(self, left_ids, right_ids):
+        """Class kern values between each of the left and right glyph
+        ids. Pair kerns are ignored.
+
+        Returns
+        -------
+        np.ndarray
+            len(left_ids) x len(right_ids) matrix
+        """
+        left_ids = np.asarray(left_ids, dtype=np.intp)
+        right_ids = np.asarray(right_ids, dtype=np.intp)
+        matrix = np.zeros((len(left_ids), len(right_ids)), dtype=np.int64)
+        for lookup in self.lookups:
+            subtables = lookup.left_subtable[left_ids]
+            for subtable, values in enumerate(lookup.values):
+                rows = np.flatnonzero(subtables == subtable)
+                if not len(rows):
+                    continue
+                left_class = lookup.left_class[left_ids[rows]]
+                right_class = lookup._right_classes[subtable][right_ids]
+                matrix[rows] += values[np.ix_(left_class, right_class)]
+        return matrix
+
+
+def _x_advance(value_record):
+    return getattr(value_record, "XAdvance", None) or 0
+
+
+def _gpos_kern_lookup(lookup, glyph_ids):
+    kern_lookup = ClassKernLookup(len(glyph_ids))
+    for sub_table in lookup.SubTable:
+        if hasattr(sub_table, 'ExtSubTable'):
+            sub_table = sub_table.ExtSubTable
+
+        if hasattr(sub_table, 'PairSet'):
+            kern_lookup.add_pairs(
+                (glyph_ids[left], glyph_ids[right], value)
+                for left, right, value in _pair_kerns(sub_table)
+            )
+
+        if hasattr(sub_table, 'ClassDef2'):
+            values = np.array(
+                [[_x_advance(c2.Value1) for c2 in c1.Class2Record]
+                 for c1 in sub_table.Class1Record],
+                dtype=np.int64
+            ).reshape(sub_table.Class1Count, sub_table.Class2Count)
+            kern_lookup.add_classes(
+                [glyph_ids[g] for g in sub_table.Coverage.glyphs],
+                {glyph_ids[g]: c for g, c in sub_table.ClassDef1.classDefs.items()},
+                {glyph_ids[g]: c for g, c in sub_table.ClassDef2.classDefs.items()},
+                values
+            )
+    return kern_lookup
+
+
+def dump_class_kerning(font):
+    """Dump a font's kerning without flattening class kerns.
+
+    If no GPOS kerns exist, use the kern table instead. Each kern
+    subtable is treated as its own lookup.
 
     Parameters
     ----------
@@ -366,60 +892,163 @@ def dump_kerning(font):
 
     Returns
     -------
-    DFontTableIMG
-        Each row in the table is represented as a dict.
-        [
-            {'left': A, 'right': V, 'value': -50,
-             'string': 'AV', 'description': "AV | ()", 'features': []},
-            {'left': V, 'right': A, 'value': -50,
-             'string': 'VA', 'description': "VA | ()", 'features': []},
-            ...
-        ]
+    ClassKerning
     """
-    kerning = _dump_gpos_kerning(font)
-    if not kerning:
-        kerning = _dump_table_kerning(font)
+    ttfont = font.ttfont
+    glyph_ids = ttfont.getReverseGlyphMap()
+    kerning = ClassKerning(len(glyph_ids))
+    if 'GPOS' in ttfont:
+        lookup_list = ttfont['GPOS'].table.LookupList
+        for lookup_idx in _kerning_lookup_indexes(ttfont) or []:
+            kerning.lookups.append(
+                _gpos_kern_lookup(lookup_list.Lookup[lookup_idx], glyph_ids)
+            )
+    if not kerning.lookups and 'kern' in ttfont:
+        for table in ttfont['kern'].kernTables:
+            kern_lookup = ClassKernLookup(len(glyph_ids))
+            kern_lookup.add_pairs(
+                (glyph_ids[left], glyph_ids[right], value)
+                for (left, right), value in table.kernTable.items()
+            )
+            kerning.lookups.append(kern_lookup)
     return kerning
 
 
-def _dump_gpos_kerning(font):
-    """Dump a font's GPOS kerning.
+def iter_kerning(ttfont):
+    """Yield (left, right, value) for each kerned glyph pair.
+
+    If no GPOS kerns exist, yield the kern table's kerns instead.
+    Each pair is yielded once. As in shaping engines, the first
+    subtable of a lookup which kerns a pair wins, and a class subtable
+    covering a left glyph hides the later subtables of its lookup from
+    it. The values of several lookups, or kern subtables, add up, as
+    in ClassKerning.
+
+    Parameters
+    ----------
+    ttfont: TTFont
+    """
+    found = False
+    for kern in _iter_gpos_kerning(ttfont):
+        found = True
+        yield kern
+    if not found:
+        for kern in _iter_table_kerning(ttfont):
+            yield kern
 
-    TODO (Marc Foley) Flattening produced too much output. Perhaps it's better
-    to keep the classes and map each class to a single glyph?
 
-    Perhaps it would be better to combine our efforts and help improve
-    https://github.com/adobe-type-tools/kern-dump which has similar
-    functionality?"""
-    if 'GPOS' not in font.ttfont:
+def _iter_gpos_kerning(ttfont):
+    if 'GPOS' not in ttfont:
         logger.warning("Font doesn't have GPOS table. No kerns found")
-        return []
+        return
 
-    kerning_lookup_indexes = _kerning_lookup_indexes(font.ttfont)
+    kerning_lookup_indexes = _kerning_lookup_indexes(ttfont)
     if not kerning_lookup_indexes:
         logger.warning("Font doesn't have a GPOS kern feature")
-        return []
+        return
+
+    glyph_order = ttfont.getGlyphOrder()
+    lookup_list = ttfont['GPOS'].table.LookupList
+    lookups = [lookup_list.Lookup[idx] for idx in kerning_lookup_indexes]
+    if len(lookups) == 1:
+        for kern in _lookup_kerns(lookups[0], glyph_order):
+            yield kern
+        return
+
+    # Several lookups can kern the same pair. A pair is yielded by the
+    # first lookup which kerns it, with the values of the later lookups
+    # added, which are looked up a pair at a time.
+    glyph_ids = ttfont.getReverseGlyphMap()
+    kern_lookups = [_gpos_kern_lookup(l, glyph_ids) for l in lookups]
+    for idx, lookup in enumerate(lookups):
+        for left, right, value in _lookup_kerns(lookup, glyph_order):
+            left_id, right_id = glyph_ids[left], glyph_ids[right]
+            if any(_kerns_pair(l, left_id, right_id)
+                   for l in kern_lookups[:idx]):
+                continue
+            for later in kern_lookups[idx+1:]:
+                value += later.value(left_id, right_id)
+            yield left, right, value
+
+
+def _lookup_kerns(lookup, glyph_order):
+    """Yield (left, right, value) for each pair a GPOS lookup kerns.
+
+    The first subtable which kerns a pair wins, and a class subtable
+    covering a left glyph hides the later subtables from it. Only the
+    pairs of pair subtables are remembered, class kerns are yielded as
+    they are flattened."""
+    # Left glyphs a class subtable of this lookup covers
+    covered = set()
+    seen = set()
+    for sub_table in lookup.SubTable:
+        if hasattr(sub_table, 'ExtSubTable'):
+            sub_table = sub_table.ExtSubTable
+
+        if hasattr(sub_table, 'PairSet'):
+            for left, right, value in _pair_kerns(sub_table):
+                if left in covered or (left, right) in seen:
+                    continue
+                seen.add((left, right))
+                yield left, right, value
+        elif hasattr(sub_table, 'ClassDef2'):
+            for left, right, value in _class_kerns(sub_table, glyph_order):
+                if left in covered or (left, right) in seen:
+                    continue
+                yield left, right, value
+            covered.update(sub_table.Coverage.glyphs)
+
+
+def _kerns_pair(kern_lookup, left, right):
+    """Whether a ClassKernLookup yields a pair of glyph ids"""
+    if (left, right) in kern_lookup.pairs:
+        return True
+    return kern_lookup.left_subtable[left] >= 0 and \
+        kern_lookup.value(left, right) != 0
+
 
-    kern_table = []
-    for lookup_idx in kerning_lookup_indexes:
-        lookup = font.ttfont['GPOS'].table.LookupList.Lookup[lookup_idx]
+def _iter_table_kerning(ttfont):
+    """Some fonts still contain kern tables. Most modern fonts include
+    kerning in the GPOS table"""
+    if not 'kern' in ttfont:
+        return
+    logger.warning('Font contains kern table. Newer fonts are GPOS only')
+    tables = [table.kernTable for table in ttfont['kern'].kernTables]
+    for idx, table in enumerate(tables):
+        for pair, value in table.items():
+            if idx and any(pair in earlier for earlier in tables[:idx]):
+                continue
+            for later in tables[idx+1:]:
+                value += later.get(pair, 0)
+            yield pair[0], pair[1], value
 
-        for sub_table in lookup.SubTable:
 
-            if hasattr(sub_table, 'ExtSubTable'):
-                sub_table = sub_table.ExtSubTable
+def dump_kerning(font):
+    """Dump a font's kerning.
 
-            if hasattr(sub_table, 'PairSet'):
-                _flatten_pair_kerning(sub_table, kern_table)
+    If no GPOS kerns exist, try and dump the kern table instead
 
-            if hasattr(sub_table, 'ClassDef2'):
-                _flatten_class_kerning(sub_table, kern_table)
+    Parameters
+    ----------
+    font: DFont
 
-    _kern_table = DFontTableIMG(font, "kerning", renderable=True)
-    for left, right, val in kern_table:
+    Returns
+    -------
+    DFontTableIMG
+        Each row in the table is represented as a dict.
+        [
+            {'left': A, 'right': V, 'value': -50,
+             'string': 'AV', 'description': "AV | ()", 'features': []},
+            {'left': V, 'right': A, 'value': -50,
+             'string': 'VA', 'description': "VA | ()", 'features': []},
+            ...
+        ]
+    """
+    table = DFontTableIMG(font, "kerning", renderable=True)
+    for left, right, val in iter_kerning(font.ttfont):
         left = font.glyph(left)
         right = font.glyph(right)
-        _kern_table.append({
+        table.append({
             'left': left,
             'right': right,
             'value': val,
@@ -433,43 +1062,30 @@ def _dump_gpos_kerning(font):
                 ', '.join(left.features),
                 ', '.join(right.features))
         })
-    _kern_table.report_columns(["left", "right", "string", "value"])
-    return _kern_table
+    table.report_columns(["left", "right", "string", "value"])
+    return table
 
 
-def _dump_table_kerning(font):
-    """Some fonts still contain kern tables. Most modern fonts include
-    kerning in the GPOS table"""
-    kerns = DFontTableIMG(font, "kerns", renderable=True)
-    if not 'kern' in font.ttfont:
-        return kerns
-    logger.warn('Font contains kern table. Newer fonts are GPOS only')
-    for table in font.ttfont['kern'].kernTables:
-        for kern in table.kernTable:
-            left = font.glyph(kern[0])
-            right = font.glyph(kern[1])
-            kerns.append({
-                'left': left,
-                'right': right,
-                'value': table.kernTable[kern],
-                'string': left.characters + right.characters,
-                'description': u'{}+{} | {}'.format(
-                    left.name,
-                    right.name,
-                    left.features),
-                'features': left.features + right.features,
-                'htmlfeatures': u'{}, {}'.format(
-                    ', '.join(left.features),
-                    ', '.join(right.features)
-                )
-            })
-    return kerns
+class DumpAnchors:
+    """Dump a font's mark and mkmks positions.
 
+    The anchors of each subtable are read into groups, which are only
+    flattened into the marks and mkmks tables once those are read.
 
-class DumpAnchors:
-    """Dump a font's mark and mkmks positions"""
-    def __init__(self, font):
+    Parameters
+    ----------
+    font: DFont
+    groups: tuple
+        (base, marks, mark1, mark2) groups to use instead of reading
+        the font's GPOS, see groups
+    """
+    def __init__(self, font, groups=None):
         self._font = font
+        self._marks_table = None
+        self._mkmks_table = None
+        if groups is not None:
+            self._base, self._marks, self._mark1, self._mark2 = groups
+            return
         self.ttfont = font.ttfont
         self._lookups = self._get_lookups() if 'GPOS' in self.ttfont.keys() else []
 
@@ -480,11 +1096,14 @@ class DumpAnchors:
         self._mark2 = []
         self._get_groups()
 
-        self._marks_table = self._gen_table("marks", self._base, self._marks,
-                                            anc2_is_combining=True)
-        self._mkmks_table = self._gen_table("mkmks", self._mark1, self._mark2,
-                                           anc1_is_combining=True,
-                                           anc2_is_combining=True)
+    @property
+    def groups(self):
+        """Anchor groups of each mark and mkmk subtable.
+
+        (base, marks, mark1, mark2) lists, with a
+        {class: [{'class': 0, 'glyph': A, 'x': 199, 'y': 0}, ...]} dict
+        for each subtable"""
+        return self._base, self._marks, self._mark1, self._mark2
 
     @property
     def base_groups(self):
@@ -496,10 +1115,17 @@ class DumpAnchors:
 
     @property
     def marks_table(self):
+        if self._marks_table is None:
+            self._marks_table = self._gen_table(
+                "marks", self._base, self._marks, anc2_is_combining=True)
         return self._marks_table
 
     @property
     def mkmks_table(self):
+        if self._mkmks_table is None:
+            self._mkmks_table = self._gen_table(
+                "mkmks", self._mark1, self._mark2,
+                anc1_is_combining=True, anc2_is_combining=True)
         return self._mkmks_table
 
     def _get_lookups(self):
@@ -612,15 +1238,20 @@ class DumpAnchors:
         ]
         """
         table = DFontTableIMG(self._font, name, renderable=True)
+        # Read the flags once, Glyph.combining looks up the glyph store
+        # on every access
+        combining = self._font.glyph_store.combining.tolist()
         for l_idx in range(len(anchors1)):
             for m_group in anchors1[l_idx]:
                 for anchor in anchors1[l_idx][m_group]:
-                    if anc1_is_combining and not anchor['glyph'].combining:
+                    if anc1_is_combining and \
+                            not combining[anchor['glyph'].index]:
                         continue
                     if m_group not in anchors2[l_idx]:
                         continue
                     for anchor2 in anchors2[l_idx][m_group]:
-                        if anc2_is_combining and not anchor2['glyph'].combining:
+                        if anc2_is_combining and \
+                                not combining[anchor2['glyph'].index]:
                             continue
                         table.append({
                             'base_glyph': anchor['glyph'],
@@ -656,27 +1287,20 @@ def dump_gdef(font):
     base glyphs, the other for mark glyphs."""
     table_base = DFontTableIMG(font, "gdef_base", renderable=True)
     table_mark = DFontTableIMG(font, "gdef_mark", renderable=True)
-    if "GDEF" not in font.ttfont:
-        return (table_base, table_mark)
-    if not font.ttfont['GDEF'].table.GlyphClassDef:
-        return (table_base, table_mark)
-    gdef_classes = font.ttfont['GDEF'].table.GlyphClassDef.classDefs
-    for glyph_name, class_ in gdef_classes.items():
-        glyph = font.glyph(glyph_name)
+    store = font.glyph_store
+    for glyph_id in np.flatnonzero(np.isin(store.gdef_class, (1, 3))).tolist():
+        class_ = int(store.gdef_class[glyph_id])
+        glyph = font.glyph(store.glyph_order[glyph_id])
+        row = {
+            "glyph": glyph,
+            "class": GDEF_CLASSES[class_],
+            "string": glyph.characters,
+            'features': glyph.features,
+        }
         if class_ == 1:
-            table_base.append({
-                "glyph": glyph,
-                "class": GDEF_CLASSES[class_],
-                "string": glyph.characters,
-                'features': glyph.features,
-            })
-        elif class_ == 3:
-            table_mark.append({
-                "glyph": glyph,
-                "class": GDEF_CLASSES[class_],
-                "string": glyph.characters,
-                'features': glyph.features,
-            })
+            table_base.append(row)
+        else:
+            table_mark.append(row)
     for tbl in (table_base, table_mark):
         tbl.report_columns(["glyph", "class"])
         tbl.sort(key=lambda k: k["class"])
@@ -684,3 +1308,16 @@ def dump_gdef(font):
 
 
 # TODO dump GDEF.LigCaretList
+
+
+def read_cbdt(ttfont):
+    """Return a dict of glyph names to PIL images for a font's
+    CBDT glyphs"""
+    cbdt_glyphs = {}
+    if ttfont.has_key("CBDT"):
+        from PIL import Image
+        cbdt = ttfont["CBDT"]
+        for strike_data in cbdt.strikeData:
+            for key, data in strike_data.items():
+                cbdt_glyphs[key] = Image.open(io.BytesIO(data.imageData)).convert("RGBA")
+    return cbdt_glyphs
@@ -18,11 +18,13 @@ dumper /path/to/font.ttf kerns -s
 
 Output report as markdown:
 dumper /path/to/font.ttf -md
+
+Write a snapshot to diff new builds against:
+dumper /path/to/font.ttf --snapshot font.dsnap
 """
 from __future__ import print_function
 from argparse import RawTextHelpFormatter
 from diffenator.font import DFont
-from diffenator.diff import DiffFonts
 from diffenator import CHOICES
 import argparse
 
@@ -31,7 +33,7 @@ def main():
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=RawTextHelpFormatter)
     parser.add_argument('font')
-    parser.add_argument('dump', choices=CHOICES)
+    parser.add_argument('dump', choices=CHOICES, nargs='?')
     parser.add_argument('-s', '--strings-only', action='store_true')
     parser.add_argument('-ol', '--output-lines', type=int, default=100)
     parser.add_argument('-md', '--markdown', action='store_true')
@@ -39,9 +41,17 @@ def main():
                         help='Variable font instance to diff')
     parser.add_argument('-r', '--render-path',
                         help="Path to generate png to")
+    parser.add_argument('--cache-dir',
+                        help="Directory to cache font dumps in")
+    parser.add_argument('--snapshot',
+                        help=("Write a snapshot of the font's dumps to this "
+                              "path, e.g font.dsnap. diffenator can diff "
+                              "fonts against it."))
     args = parser.parse_args()
+    if not args.dump and not args.snapshot:
+        parser.error("Include a table to dump or a --snapshot path")
 
-    font = DFont(args.font)
+    font = DFont(args.font, lazy=True, cache_dir=args.cache_dir)
 
     if font.is_variable and not args.vf_instance:
         raise Exception("Include a VF instance to dump e.g -i wght=400")
@@ -51,7 +61,15 @@ def main():
                       in args.vf_instance.split(", ")}
         font.set_variations(variations)
 
+    if args.snapshot:
+        from diffenator.snapshot import save_snapshot
+        save_snapshot(font, args.snapshot)
+        if not args.dump:
+            font.save_cache()
+            return
+
     table = getattr(font, args.dump, False)
+    font.save_cache()
     if not table:
         print(("Font doesn't have {} table".format(args.dump)))
         exit()
@@ -1,32 +1,40 @@
 """Module for DFont"""
 from fontTools.ttLib import TTFont, newTable
 from fontTools.pens.ttGlyphPen import TTGlyphPen
-from fontTools.varLib.mutator import instantiateVariableFont
 from diffenator.hbinput import HbInputGenerator
 from diffenator.dump import (
         DumpAnchors,
         dump_kerning,
+        dump_class_kerning,
         dump_glyphs,
         dump_glyph_metrics,
         dump_attribs,
         dump_nametable,
-        dump_gdef
+        dump_gdef,
+        glyph_area,
+        glyf_areas,
+        glyf_outlines,
+        glyph_fingerprints
 )
-from diffenator.constants import FTHintMode
-from copy import copy
-import uharfbuzz as hb
-import freetype
-from freetype.raw import *
-from freetype import (
-        FT_PIXEL_MODE_MONO,
-        FT_PIXEL_MODE_GRAY,
-        FT_Pointer,
-        FT_Bitmap,
-        FT_Fixed,
-        FT_Set_Var_Design_Coordinates
+from diffenator.constants import FTHintMode, FT_LOAD_NO_HINTING
+from diffenator.cache import (
+        BitmapCache,
+        DumpCache,
+        DEFAULT_BITMAP_CACHE_SIZE,
+        font_cache_key,
+        pack_table,
+        unpack_table,
+        UNPACK_ERRORS
 )
+from collections import namedtuple
+from io import BytesIO
+import hashlib
+import os
+import struct
 import sys
+import threading
 import logging
+import numpy as np
 try:
     # try and import unicodedata2 backport for py2.7.
     import unicodedata2 as uni
@@ -77,12 +85,76 @@ WIDTH_NAME_TO_FVAR = {
     "UltraExpanded": 200
 }
 
+# Dumps each DFont table is built by. Some builders produce several tables.
+TABLE_BUILDERS = {
+    "glyphset": "glyphset",
+    "glyph_store": "glyph_store",
+    "glyphs": "glyphs",
+    "marks": "anchors",
+    "mkmks": "anchors",
+    "attribs": "attribs",
+    "names": "names",
+    "kerns": "kerns",
+    "class_kerns": "class_kerns",
+    "metrics": "metrics",
+    "gdef_base": "gdef",
+    "gdef_mark": "gdef",
+}
+
+# Font tables and other dumps which each dump reads. A dump is dropped
+# when anything it depends on gets invalidated. Glyph inputs don't
+# depend on glyph widths since InputGenerator strips their padding.
+TABLE_DEPENDENCIES = {
+    "glyphset": ("cmap", "GSUB"),
+    "glyph_store": ("glyphset", "glyf", "CFF ", "hmtx", "GDEF"),
+    "glyphs": ("glyphset", "glyph_store", "glyf"),
+    "marks": ("glyphset", "glyph_store", "GPOS"),
+    "mkmks": ("glyphset", "glyph_store", "GPOS"),
+    "attribs": ("OS/2", "hhea", "gasp", "head", "post"),
+    "names": ("name",),
+    "kerns": ("glyphset", "GPOS", "kern"),
+    "class_kerns": ("GPOS", "kern"),
+    "metrics": ("glyphset", "glyph_store"),
+    "gdef_base": ("glyphset", "glyph_store"),
+    "gdef_mark": ("glyphset", "glyph_store"),
+}
+
+# Tables which instantiating a VF may change. Dumps which only read
+# other tables are kept when the variations change. GSUB is added
+# if it has FeatureVariations. name is only added the first time a VF
+# is instantiated, the instancer drops fvar's name records at every
+# location alike.
+VARIABLE_TABLES = ("glyf", "hmtx", "hhea", "OS/2", "post", "head",
+                   "GDEF", "GPOS")
+
+# Tables the instancer only reads or never touches. Instances share
+# them with the source font instead of decompiling them again.
+STATIC_TABLES = ("fvar", "avar", "gvar", "HVAR", "MVAR",
+                 "cmap", "kern", "gasp", "CBDT", "CBLC")
+
+# Tables GlyphStore reads straight from the font file while they
+# haven't been decompiled
+RAW_TABLES = ("glyf", "loca", "hmtx")
+
+
 class DFont(TTFont):
-    """Container font for ttfont, freetype and hb fonts"""
+    """Container font for ttfont, freetype and hb fonts
+
+    If a cache_dir is given, dump tables are loaded from and saved to
+    an on-disk DumpCache. Tables which aren't cached yet are computed
+    and stored by save_cache.
+
+    Rasterized glyphs are kept in the bitmaps BitmapCache, which holds
+    up to bitmap_cache_size bytes."""
     def __init__(self, path=None, lazy=False, size=1500,
-                 ft_load_glyph_flags=FTHintMode.UNHINTED):
+                 ft_load_glyph_flags=FTHintMode.UNHINTED, cache_dir=None,
+                 bitmap_cache_size=DEFAULT_BITMAP_CACHE_SIZE):
         self.path = path
-        self.ttfont = TTFont(self.path)
+        # Read the file once and share the buffer between fontTools,
+        # FreeType and HarfBuzz.
+        with open(self.path, 'rb') as fontfile:
+            self._fontdata = fontfile.read()
+        self.ttfont = _open_ttfont(self._fontdata)
 
         has_outlines = self.ttfont.has_key("glyf") or self.ttfont.has_key("CFF ")
         if not has_outlines:
@@ -95,32 +167,128 @@ class DFont(TTFont):
             for name in self.ttfont.getGlyphOrder():
                 self.ttfont["glyf"].glyphs[name] = pen.glyph()
 
-        self._src_ttfont = TTFont(self.path)
-        self.glyphset = None
-        self.recalc_glyphset()
+        # set_variations instantiates into a new TTFont, so the source
+        # can share the parsed font until then.
+        self._src_ttfont = self.ttfont
+        self._tables = {}
+        self._content_hash = None
+        self._table_digests = {}
+        # Tags of font tables which may no longer match the file
+        self._changed_tables = set()
+        self.cache = DumpCache(cache_dir) if cache_dir else None
+        self._cache_entry = None
+        self._cache_entry_key = None
+        self._cache_dirty = False
+        # Dumps may be built by several threads, see DiffFonts. Each
+        # builder has its own lock, _lock guards the cache entry.
+        self._lock = threading.RLock()
+        self._builder_locks = {}
+        self.lazy = lazy
         self.axis_order = None
         self.instance_coordinates = self._get_dflt_instance_coordinates()
         self.instances_coordinates = self._get_instances_coordinates()
-        self.glyphs = self.marks = self.mkmks = self.kerns = \
-            self.glyph_metrics = self.names = self.attribs = None
 
-        self.ftfont = freetype.Face(self.path)
-        self.ftslot = self.ftfont.glyph
         self.ft_load_glyph_flags=ft_load_glyph_flags
-
         self.size = size
-        if self.ftfont.is_scalable:
-            self.ftfont.set_char_size(self.size)
+        # FreeType and HarfBuzz are loaded on first use, most dumps
+        # and diffs never shape or render a glyph.
+        self._ftfont = None
+        self._ft_size = None
+        self._hbface = None
+        self._hbfont = None
+        self.bitmaps = BitmapCache(bitmap_cache_size)
 
-        with open(self.path, 'rb') as fontfile:
-            self._fontdata = fontfile.read()
-        self.hbface = hb.Face.create(self._fontdata)
-        self.hbfont = hb.Font.create(self.hbface)
+        if not lazy:
+            self._build_tables()
 
-        self.hbfont.scale = (self.size, self.size)
+    @property
+    def ftfont(self):
+        if self._ftfont is None:
+            import freetype
+            self._ftfont = freetype.Face(BytesIO(self._fontdata))
+            self._ft_size = None
+            self.set_ft_size(self.size)
+            self._set_ft_variations()
+        return self._ftfont
 
-        if not lazy:
-            self.recalc_tables()
+    def set_ft_size(self, size):
+        """Set the FreeType char size glyphs are rendered at"""
+        if size != self._ft_size and self.ftfont.is_scalable:
+            self.ftfont.set_char_size(size)
+            self._ft_size = size
+
+    @property
+    def ftslot(self):
+        return self.ftfont.glyph
+
+    def glyph_bitmap(self, index):
+        """Render a glyph with FreeType.
+
+        Returns a view of the glyph slot's bitmap, see ft_bitmap_array.
+        It is overwritten when the next glyph is loaded."""
+        self.ftfont.load_glyph(index, flags=self.ft_load_glyph_flags)
+        return ft_bitmap_array(self.ftslot.bitmap)
+
+    def render_glyph(self, index, size=None):
+        """Rasterize a glyph, reusing it from the bitmaps cache if it
+        was rendered before.
+
+        Bitmaps are cached by glyph id, size, hinting flags and
+        variation coordinates.
+
+        Parameters
+        ----------
+        index: int
+            Glyph id
+        size: int
+            FreeType char size. Defaults to the font's size.
+
+        Returns
+        -------
+        GlyphBitmap
+        """
+        size = size or self.size
+        coords = self.instance_coordinates or {}
+        key = (index, size, int(self.ft_load_glyph_flags),
+               tuple(sorted(coords.items())))
+        bitmap = self.bitmaps.get(key)
+        if bitmap is None:
+            self.set_ft_size(size)
+            pixels = self.glyph_bitmap(index)
+            if not pixels.flags.owndata:
+                pixels = pixels.copy()
+            slot = self.ftslot
+            bitmap = GlyphBitmap(pixels, slot.bitmap_left, slot.bitmap_top)
+            self.bitmaps.put(key, bitmap, pixels.nbytes)
+        return bitmap
+
+    @property
+    def hbface(self):
+        if self._hbface is None:
+            import uharfbuzz as hb
+            self._hbface = hb.Face.create(self._fontdata)
+        return self._hbface
+
+    @property
+    def hbfont(self):
+        if self._hbfont is None:
+            import uharfbuzz as hb
+            self._hbfont = hb.Font.create(self.hbface)
+            self._hbfont.scale = (self.size, self.size)
+            if self.axis_order:
+                self._hbfont.set_variations(self.instance_coordinates)
+        return self._hbfont
+
+    def _set_ft_variations(self):
+        if not self.axis_order:
+            return
+        from freetype import FT_Fixed, FT_Set_Var_Design_Coordinates
+        coords = []
+        for name in self.axis_order:
+            coord = FT_Fixed(int(self.instance_coordinates[name]) << 16)
+            coords.append(coord)
+        ft_coords = (FT_Fixed * len(coords))(*coords)
+        FT_Set_Var_Design_Coordinates(self._ftfont._FT_Face, len(ft_coords), ft_coords)
 
     def _get_instances_coordinates(self):
         results = {}
@@ -138,11 +306,233 @@ class DFont(TTFont):
     def glyph(self, name):
         return self.glyphset[name]
 
-    def recalc_glyphset(self):
+    def _table(self, name):
+        """Return a dump table, computing it on first access."""
+        if name not in self._tables:
+            builder_name = TABLE_BUILDERS[name]
+            with self._lock:
+                lock = self._builder_locks.setdefault(builder_name,
+                                                      threading.RLock())
+            with lock:
+                if name not in self._tables and \
+                        not self._load_cached_table(name):
+                    tables = getattr(self, "_build_" + builder_name)()
+                    self._tables.update(tables)
+                    self._store_cached_tables(tables)
+        return self._tables[name]
+
+    @property
+    def content_hash(self):
+        """sha256 hex digest of the font file"""
+        if not self._content_hash:
+            self._content_hash = hashlib.sha256(self._fontdata).hexdigest()
+        return self._content_hash
+
+    def table_digest(self, tag):
+        """sha256 hex digest of a font table's bytes in the font file.
+
+        Returns an empty string if the font has no such table, or None
+        if the table may have changed since it was read, such as the
+        tables instantiating a VF varies. Tables the instancer drops,
+        such as gvar, are read from the VF."""
+        if tag not in self.ttfont and tag not in self._src_ttfont:
+            return ""
+        reader = self._src_ttfont.reader
+        if tag in self._changed_tables or reader is None or tag not in reader:
+            return None
+        if tag not in self._table_digests:
+            self._table_digests[tag] = hashlib.sha256(reader[tag]).hexdigest()
+        return self._table_digests[tag]
+
+    @property
+    def glyph_order(self):
+        return self.ttfont.getGlyphOrder()
+
+    @property
+    def cache_key(self):
+        return font_cache_key(self)
+
+    def _cached_entry(self):
+        with self._lock:
+            if self._cache_entry is None:
+                # Keep the key the entry was loaded with, the font's key
+                # changes before its tables are invalidated.
+                self._cache_entry_key = self.cache_key
+                entry = self.cache.load(self._cache_entry_key)
+                self._cache_entry = entry or {"glyphset": None, "tables": {}}
+            return self._cache_entry
+
+    def _load_cached_table(self, name):
+        if not self.cache:
+            return False
+        with self._lock:
+            entry = self._cached_entry()
+            data = entry["glyphset"] if name == "glyphset" \
+                else entry["tables"].get(name)
+        if data is None:
+            return False
+        if name == "glyphset":
+            self._tables["glyphset"] = {
+                g_name: Glyph(g_name, features, characters, self)
+                for g_name, features, characters in data
+            }
+        else:
+            try:
+                self._tables[name] = unpack_table(self, data)
+            except UNPACK_ERRORS:
+                # Rebuild tables which can't be read, the rebuilt table
+                # replaces them in the entry
+                logger.warning("Ignoring unreadable cached {} table of "
+                               "{}".format(name, self.path))
+                with self._lock:
+                    self._cached_entry()["tables"].pop(name, None)
+                return False
+        return True
+
+    def _store_cached_tables(self, tables):
+        # Tables are packed as soon as they are built because the diff
+        # functions modify rows in place.
+        if not self.cache:
+            return
+        packed = {name: pack_table(self, table)
+                  for name, table in tables.items() if name != "glyphset"}
+        with self._lock:
+            entry = self._cached_entry()
+            if "glyphset" in tables:
+                entry["glyphset"] = [(g.name, g.features, g.characters)
+                                     for g in tables["glyphset"].values()]
+            entry["tables"].update(packed)
+            self._cache_dirty = True
+
+    def save_cache(self):
+        """Write newly computed dump tables to the DumpCache"""
+        with self._lock:
+            if self.cache and self._cache_dirty:
+                self.cache.save(self._cache_entry_key, self._cache_entry)
+                self._cache_dirty = False
+
+    def invalidate_tables(self, *depends_on):
+        """Drop cached dump tables so they get recomputed on next access.
+
+        Parameters
+        ----------
+        depends_on: str
+            Font table tags or dump names which have changed. Every dump
+            which reads them, directly or through another dump, is dropped.
+            If none are given, drop every dump.
+        """
+        if not depends_on:
+            self._changed_tables.update(self.ttfont.keys())
+            self._tables.clear()
+            self.save_cache()
+            self._cache_entry = None
+            return
+        self._changed_tables.update(depends_on)
+        stale = set(depends_on)
+        found = True
+        while found:
+            found = False
+            for name, deps in TABLE_DEPENDENCIES.items():
+                if name not in stale and stale.intersection(deps):
+                    stale.add(name)
+                    found = True
+        for name in stale:
+            self._tables.pop(name, None)
+            if self._cache_entry is not None:
+                self._cache_entry["tables"].pop(name, None)
+        if self._cache_entry is not None and "glyphset" in stale:
+            self._cache_entry["glyphset"] = None
+
+    def _build_glyphset(self):
         if not 'cmap' in self.ttfont.keys():
-            self.glyphset = []
+            return {"glyphset": {}}
         inputs = InputGenerator(self).all_inputs()
-        self.glyphset = {g.name: g for g in inputs}
+        return {"glyphset": {g.name: g for g in inputs}}
+
+    def _build_glyph_store(self):
+        return {"glyph_store": GlyphStore(self)}
+
+    def _build_glyphs(self):
+        return {"glyphs": dump_glyphs(self)}
+
+    def _build_anchors(self):
+        anchors = DumpAnchors(self)
+        return {"marks": anchors.marks_table, "mkmks": anchors.mkmks_table}
+
+    def _build_attribs(self):
+        return {"attribs": dump_attribs(self)}
+
+    def _build_names(self):
+        return {"names": dump_nametable(self)}
+
+    def _build_kerns(self):
+        return {"kerns": dump_kerning(self)}
+
+    def _build_class_kerns(self):
+        return {"class_kerns": dump_class_kerning(self)}
+
+    def _build_metrics(self):
+        return {"metrics": dump_glyph_metrics(self)}
+
+    def _build_gdef(self):
+        gdef_base, gdef_mark = dump_gdef(self)
+        return {"gdef_base": gdef_base, "gdef_mark": gdef_mark}
+
+    @property
+    def glyphset(self):
+        return self._table("glyphset")
+
+    @property
+    def glyph_store(self):
+        return self._table("glyph_store")
+
+    @property
+    def glyphs(self):
+        return self._table("glyphs")
+
+    @property
+    def marks(self):
+        return self._table("marks")
+
+    @property
+    def mkmks(self):
+        return self._table("mkmks")
+
+    @property
+    def attribs(self):
+        return self._table("attribs")
+
+    @property
+    def names(self):
+        return self._table("names")
+
+    @property
+    def kerns(self):
+        return self._table("kerns")
+
+    @property
+    def class_kerns(self):
+        return self._table("class_kerns")
+
+    @property
+    def metrics(self):
+        return self._table("metrics")
+
+    @property
+    def gdef_base(self):
+        return self._table("gdef_base")
+
+    @property
+    def gdef_mark(self):
+        return self._table("gdef_mark")
+
+    def recalc_glyphset(self):
+        self.invalidate_tables("glyphset")
+        return self.glyphset
+
+    @property
+    def upm(self):
+        return self.ttfont['head'].unitsPerEm
 
     @property
     def is_variable(self):
@@ -150,12 +540,58 @@ class DFont(TTFont):
             return True
         return False
 
+    def _instantiate(self, axes):
+        """Return a static TTFont instance of the VF.
+
+        The instance is parsed lazily from the font's bytes so only the
+        tables the instancer modifies get decompiled. Tables which don't
+        vary are shared with the source font."""
+        from fontTools.varLib.mutator import instantiateVariableFont
+        font = _open_ttfont(self._fontdata)
+        shared = list(STATIC_TABLES)
+        if not self._has_gsub_feature_variations():
+            shared.append("GSUB")
+        for tag in shared:
+            if tag in self._src_ttfont:
+                font[tag] = self._src_ttfont[tag]
+        # Dumps don't read cvt and FreeType renders the VF itself, so
+        # skip varying the hinting.
+        if "cvar" in font:
+            del font["cvar"]
+        return instantiateVariableFont(font, axes, inplace=True)
+
+    def _has_gsub_feature_variations(self):
+        if "GSUB" not in self._src_ttfont:
+            return False
+        return bool(getattr(self._src_ttfont["GSUB"].table,
+                            "FeatureVariations", None))
+
+    def _rekey_cache(self):
+        """Move the dumps which survived a variation change into the
+        cache entry for the new coordinates."""
+        old_entry = self._cache_entry
+        self._cache_entry = None
+        if not self.cache or old_entry is None:
+            return
+        entry = self._cached_entry()
+        if entry["glyphset"] is None and old_entry["glyphset"] is not None:
+            entry["glyphset"] = old_entry["glyphset"]
+            self._cache_dirty = True
+        for name, data in old_entry["tables"].items():
+            if name not in entry["tables"]:
+                entry["tables"][name] = data
+                self._cache_dirty = True
+
     def set_variations(self, axes):
-        """Instantiate a ttfont VF with axes vals"""
+        """Instantiate a ttfont VF with axes vals.
+
+        Only dumps which read tables the instancer changes get
+        recomputed."""
         logger.debug("Setting variations to {}".format(axes))
         if self.is_variable:
-            font = instantiateVariableFont(self._src_ttfont, axes, inplace=False)
-            self.ttfont = copy(font)
+            self.save_cache()
+            instanced = self.ttfont is not self._src_ttfont
+            self.ttfont = self._instantiate(axes)
             self.axis_order = [a.axisTag for a in self._src_ttfont['fvar'].axes]
             self.instance_coordinates = {a.axisTag: a.defaultValue for a in
                                     self._src_ttfont['fvar'].axes}
@@ -164,18 +600,20 @@ class DFont(TTFont):
                     self.instance_coordinates[axis] = axes[axis]
                 else:
                     logger.info("font has no axis called {}".format(axis))
-            self.recalc_tables()
-
-            coords = []
-            for name in self.axis_order:
-                coord = FT_Fixed(int(self.instance_coordinates[name]) << 16)
-                coords.append(coord)
-            ft_coords = (FT_Fixed * len(coords))(*coords)
-            FT_Set_Var_Design_Coordinates(self.ftfont._FT_Face, len(ft_coords), ft_coords)
-            self.hbface = hb.Face.create(self._fontdata)
-            self.hbfont = hb.Font.create(self.hbface)
-            self.hbfont.set_variations(self.instance_coordinates)
-            self.hbfont.scale = (self.size, self.size)
+            varied = list(VARIABLE_TABLES)
+            if self._has_gsub_feature_variations():
+                varied.append("GSUB")
+            if not instanced:
+                varied.append("name")
+            self.invalidate_tables(*varied)
+            self._rekey_cache()
+            if not self.lazy:
+                self._build_tables()
+
+            if self._ftfont is not None:
+                self._set_ft_variations()
+            if self._hbfont is not None:
+                self._hbfont.set_variations(self.instance_coordinates)
         else:
             logger.info("Not vf")
 
@@ -253,17 +691,17 @@ class DFont(TTFont):
         self.set_variations(variations)
 
     def recalc_tables(self):
-        """Recalculate DFont tables"""
-        self.recalc_glyphset()
-        anchors = DumpAnchors(self)
-        self.glyphs = dump_glyphs(self)
-        self.marks = anchors.marks_table
-        self.mkmks = anchors.mkmks_table
-        self.attribs = dump_attribs(self)
-        self.names = dump_nametable(self)
-        self.kerns = dump_kerning(self)
-        self.metrics = dump_glyph_metrics(self)
-        self.gdef_base, self.gdef_mark = dump_gdef(self)
+        """Recalculate DFont tables.
+
+        Lazy fonts only drop their tables, which then get recomputed on
+        first access."""
+        self.invalidate_tables()
+        if not self.lazy:
+            self._build_tables()
+
+    def _build_tables(self):
+        for name in TABLE_BUILDERS:
+            self._table(name)
 
 
 class InputGenerator(HbInputGenerator):
@@ -273,10 +711,9 @@ class InputGenerator(HbInputGenerator):
         """Generate harfbuzz inputs for all glyphs in a given font."""
 
         inputs = []
-        glyph_set = self.font.ttfont.getGlyphSet()
-        for name in self.font.ttfont.getGlyphOrder():
-            is_zero_width = glyph_set[name].width == 0
-            cur_input = self.input_from_name(name, pad=is_zero_width)
+        store = self.font.glyph_store
+        for name, advance in zip(store.glyph_order, store.advance.tolist()):
+            cur_input = self.input_from_name(name, pad=advance == 0)
             if cur_input is not None:
                 features, characters = cur_input
                 characters = characters.replace(' ', '')
@@ -288,71 +725,330 @@ class InputGenerator(HbInputGenerator):
                 inputs.append(Glyph(name, features, '', self.font))
         return inputs
 
-    def input_from_name(self, name, seen=None, pad=False):
-        """Given glyph name, return input to harbuzz to render this glyph.
+    def _cmap_input(self, name):
+        value = super(InputGenerator, self)._cmap_input(name)
+        if value is None or value[1] == chr(0):
+            return None
+        return value
 
-        Returns input in the form of a (features, text) tuple, where `features`
-        is a list of feature tags to activate and `text` is an input string.
 
-        Argument `seen` is used by the method to avoid following cycles when
-        recursively looking for possible input. `pad` can be used to add
-        whitespace to text output, for non-spacing glyphs.
+class _LockedReader(object):
+    """SFNTReader proxy which reads one table at a time.
 
-        Can return None in two situations: if no possible input is found (no
-        simple unicode mapping or substitution rule exists to generate the
-        glyph), or if the requested glyph already exists in `seen` (in which
-        case this path of generating input should not be followed further).
-        """
+    fontTools reads a table by seeking the reader's file and reading
+    from it, so reads from several threads would interleave."""
+    def __init__(self, reader):
+        self._reader = reader
+        self._lock = threading.Lock()
 
-        if name in self.memo:
-            return self.memo[name]
+    def __getitem__(self, tag):
+        with self._lock:
+            return self._reader[tag]
 
-        inputs = []
+    def __contains__(self, tag):
+        return tag in self._reader
 
-        # avoid following cyclic paths through features
-        if seen is None:
-            seen = set()
-        if name in seen:
-            return None
-        seen.add(name)
-
-        # see if this glyph has a simple unicode mapping
-        if name in self.reverse_cmap:
-            text = chr(self.reverse_cmap[name])
-            if text != chr(0):
-                inputs.append(((), text))
-
-        # check the substitution features
-        inputs.extend(self._inputs_from_gsub(name, seen))
-        # seen.remove(name)
-
-        # since this method sometimes returns None to avoid cycles, the
-        # recursive calls that it makes might have themselves returned None,
-        # but we should avoid returning None here if there are other options
-        inputs = [i for i in inputs if i is not None]
-        if not inputs:
-            return None
+    def __delitem__(self, tag):
+        del self._reader[tag]
+
+    def __getattr__(self, name):
+        if name == "_reader":
+            raise AttributeError(name)
+        return getattr(self._reader, name)
+
+
+def _open_ttfont(data):
+    """TTFont parsed lazily from a font's bytes, whose tables can be
+    read from several threads"""
+    ttfont = TTFont(BytesIO(data))
+    ttfont.reader = _LockedReader(ttfont.reader)
+    return ttfont
+
+
+def _raw_table(ttfont, tag):
+    """Bytes of a font table which hasn't been decompiled, and so hasn't
+    been changed, or None"""
+    reader = ttfont.reader
+    if ttfont.isLoaded(tag) or reader is None or tag not in reader:
+        return None
+    return reader[tag]
+
+
+def _raw_loca(ttfont, count, glyf_size):
+    """glyf offsets of each glyph and the end of the last one, read
+    straight from the loca data. None if loca has been decompiled or
+    doesn't match the glyf data."""
+    data = _raw_table(ttfont, "loca")
+    if data is None:
+        return None
+    if ttfont["head"].indexToLocFormat:
+        offsets = np.frombuffer(data, dtype=">u4").astype(np.int64)
+    else:
+        offsets = np.frombuffer(data, dtype=">u2").astype(np.int64) * 2
+    if len(offsets) < count + 1:
+        return None
+    offsets = offsets[:count + 1]
+    if np.any(np.diff(offsets) < 0) or \
+            offsets[-1] > glyf_size:
+        return None
+    return offsets
+
+
+class GlyphStore:
+    """Per glyph data for a font, held in NumPy arrays indexed by glyph id.
+
+    advance, lsb, bounds, empty and gdef_class are read in bulk from the
+    font's hmtx, glyf or CFF and GDEF tables. area, combining and
+    digests are computed on first access.
+
+    Attributes
+    ----------
+    glyph_order: list
+    advance: np.ndarray
+        Advance widths from hmtx
+    lsb: np.ndarray
+        Left side bearings from hmtx
+    bounds: np.ndarray
+        (xMin, yMin, xMax, yMax) for each glyph, zeros for empty glyphs
+    empty: np.ndarray
+        True for glyphs without an outline
+    gdef_class: np.ndarray
+        GDEF glyph class, 0 if unclassified
+    """
+    def __init__(self, font):
+        self._font = font
+        self._area = None
+        self._combining = None
+        self._digests = None
+        self._fingerprints = {}
+        self._outlines = None
+        # Guards the lazy data, diff threads may read it at once
+        self._lock = threading.RLock()
+        ttfont = font.ttfont
+        self.glyph_order = ttfont.getGlyphOrder()
+        count = len(self.glyph_order)
+
+        self.advance, self.lsb = self._hmtx_metrics(ttfont)
+
+        if "glyf" in ttfont:
+            self.bounds, self.empty = self._glyf_bounds(ttfont)
+        elif "CFF " in ttfont:
+            self.bounds, self.empty = self._cff_bounds(ttfont)
+        else:
+            raise Exception("Only ttf and otf fonts are supported")
+
+        self.gdef_class = np.zeros(count, dtype=np.int8)
+        if "GDEF" in ttfont and ttfont['GDEF'].table.GlyphClassDef:
+            glyph_ids = ttfont.getReverseGlyphMap()
+            for name, class_ in ttfont['GDEF'].table.GlyphClassDef.classDefs.items():
+                self.gdef_class[glyph_ids[name]] = class_
+
+    @property
+    def _reads_raw_tables(self):
+        # Lazy fonts are only read. Other fonts may be edited in place
+        # before recalc_tables, so their tables are decompiled.
+        return self._font.lazy
+
+    def _hmtx_metrics(self, ttfont):
+        """Advances and lsbs, read straight from the hmtx data unless
+        the table has been decompiled"""
+        count = len(self.glyph_order)
+        data = None
+        if self._reads_raw_tables:
+            data = _raw_table(ttfont, "hmtx")
+        if data is not None:
+            num_long = ttfont["hhea"].numberOfHMetrics
+            size = num_long + count
+            if 0 < num_long <= count and len(data) >= 2 * size:
+                words = np.frombuffer(data, dtype=">i2", count=size)
+                advance = words[:2 * num_long:2].astype(np.uint16)
+                advance = np.concatenate((
+                    advance, np.repeat(advance[-1:], count - num_long)))
+                lsb = np.concatenate((words[1:2 * num_long:2],
+                                      words[2 * num_long:]))
+                return advance.astype(np.int32), lsb.astype(np.int32)
 
-        features, text = min(inputs)
-        # can't pad if we don't support space
-        if pad and self.space_width > 0:
-            width, space = self.widths[name], self.space_width
-            padding = ' ' * (width // space + (1 if width % space else 0))
-            text = padding + text
-        self.memo[name] = features, text
-        return self.memo[name]
+        hmtx = ttfont['hmtx'].metrics
+        metrics = np.array([hmtx[n] for n in self.glyph_order],
+                           dtype=np.int32).reshape(count, 2)
+        return metrics[:, 0], metrics[:, 1]
+
+    def _glyf_bounds(self, ttfont):
+        count = len(self.glyph_order)
+        bounds = np.zeros((count, 4), dtype=np.int32)
+        empty = np.zeros(count, dtype=bool)
+        data = None
+        if self._reads_raw_tables:
+            data = _raw_table(ttfont, "glyf")
+        offsets = None
+        if data is not None:
+            offsets = _raw_loca(ttfont, count, len(data))
+        if offsets is not None:
+            # Read each glyph's bounds from its header in the glyf data
+            data = np.frombuffer(data, dtype=np.uint8)
+            starts = offsets[:-1]
+            empty[:] = offsets[1:] - starts < 10
+            starts = starts[~empty]
+            bounds[~empty] = np.stack([
+                ((data[starts + i].astype(np.uint16) << 8) |
+                 data[starts + i + 1]).astype(np.int16)
+                for i in (2, 4, 6, 8)
+            ], axis=1)
+            return bounds, empty
+
+        glyf = ttfont['glyf']
+        for idx, name in enumerate(self.glyph_order):
+            glyph = glyf.glyphs[name]
+            data = getattr(glyph, "data", None)
+            if data is not None:
+                # Not decompiled yet, read the bounds from the header
+                if len(data) < 10:
+                    empty[idx] = True
+                else:
+                    bounds[idx] = struct.unpack(">4h", data[2:10])
+            elif hasattr(glyph, "xMin"):
+                bounds[idx] = (glyph.xMin, glyph.yMin, glyph.xMax, glyph.yMax)
+            else:
+                empty[idx] = True
+        return bounds, empty
+
+    def _cff_bounds(self, ttfont):
+        glyphset = ttfont.getGlyphSet()
+        char_strings = ttfont["CFF "].cff.values()[0].CharStrings
+        bounds = np.zeros((len(self.glyph_order), 4), dtype=np.int32)
+        empty = np.zeros(len(self.glyph_order), dtype=bool)
+        for idx, name in enumerate(self.glyph_order):
+            glyph_bounds = char_strings[name].calcBounds(glyphset)
+            if glyph_bounds is None:
+                empty[idx] = True
+            else:
+                bounds[idx] = [round(v) for v in glyph_bounds]
+        return bounds, empty
+
+    @property
+    def area(self):
+        """Surface area of each glyph"""
+        with self._lock:
+            if self._area is None:
+                ttfont = self._font.ttfont
+                if "glyf" in ttfont:
+                    self._area = glyf_areas(ttfont, self.outlines)
+                else:
+                    glyphset = ttfont.getGlyphSet()
+                    self._area = np.array([glyph_area(glyphset, n) for n in self.glyph_order],
+                                          dtype=np.int64)
+            return self._area
+
+    @property
+    def fingerprints(self):
+        """Outline hash of each glyph for the font's hinting mode, see
+        glyph_fingerprints"""
+        hinted = not self._font.ft_load_glyph_flags & FT_LOAD_NO_HINTING
+        with self._lock:
+            if hinted not in self._fingerprints:
+                self._fingerprints[hinted] = glyph_fingerprints(
+                    self._font.ttfont, hinted, self.outlines)
+            return self._fingerprints[hinted]
+
+    @property
+    def digests(self):
+        """Digest of each glyph's raw data, None for fonts without a glyf
+        table.
+
+        A glyph's digest covers its compiled glyf data, its hmtx entry
+        and the digests of its components, so glyphs with the same
+        digest have the same outline, area and metrics."""
+        with self._lock:
+            if self._digests is None and "glyf" in self._font.ttfont:
+                self._digests = self._glyf_digests(self._font.ttfont)
+            return self._digests
+
+    def _glyf_digests(self, ttfont):
+        glyf = ttfont['glyf']
+        hmtx = ttfont['hmtx'].metrics
+        digests = {}
+
+        def glyph_digest(name):
+            if name not in digests:
+                glyph = glyf.glyphs[name]
+                data = getattr(glyph, "data", None)
+                if data is None:
+                    # Glyphs drawn since the font was read may not
+                    # have bounds yet
+                    data = glyph.compile(
+                        glyf, recalcBBoxes=not hasattr(glyph, "xMin"))
+                digest = hashlib.blake2b(data, digest_size=16)
+                digest.update(struct.pack(">Hh", *hmtx[name]))
+                if glyph.isComposite():
+                    for component in glyph.getComponentNames(glyf):
+                        digest.update(glyph_digest(component))
+                digests[name] = digest.digest()
+            return digests[name]
+
+        return [glyph_digest(name) for name in self.glyph_order]
+
+    @property
+    def outlines(self):
+        """Decoded glyf outlines, None for fonts without a glyf table"""
+        with self._lock:
+            if self._outlines is None and "glyf" in self._font.ttfont:
+                self._outlines = glyf_outlines(self._font.ttfont)
+            return self._outlines
+
+    def __getstate__(self):
+        # Decoded outlines are large and quick to decode again
+        state = dict(self.__dict__)
+        state["_outlines"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def combining(self):
+        """True for glyphs whose input starts with a combining character"""
+        if self._combining is None:
+            # Read the glyphset first, it is built under its own lock
+            glyphs = self._font.glyphset.values()
+            with self._lock:
+                if self._combining is None:
+                    combining = np.zeros(len(self.glyph_order), dtype=bool)
+                    for glyph in glyphs:
+                        if glyph.characters and \
+                                uni.combining(glyph.characters[0]):
+                            combining[glyph.index] = True
+                    self._combining = combining
+        return self._combining
 
 
 class Glyph:
-    def __init__(self, name, features, characters, font):
+    """A glyph and the input which renders it. Its metrics are read
+    from the font's GlyphStore."""
+    __slots__ = ("name", "features", "characters", "key", "font", "index")
+
+    def __init__(self, name, features, characters, font, index=None):
         self.name = name
         self.features = features
         self.characters = characters
-        self.combining = True if characters and uni.combining(characters[0]) else False
         self.key = self.characters + ''.join(features)
         self.font = font
-        self.index = self.font.ttfont.getGlyphID(name)
-        self.width = self.font.ttfont['hmtx'].metrics[name][0]
+        if index is None:
+            index = self.font.ttfont.getGlyphID(name)
+        self.index = index
+
+    @property
+    def width(self):
+        return int(self.font.glyph_store.advance[self.index])
+
+    @property
+    def combining(self):
+        return bool(self.font.glyph_store.combining[self.index])
+
+    @property
+    def fingerprint(self):
+        return self.font.glyph_store.fingerprints[self.index]
 
     def __repr__(self):
         return self.name
@@ -361,6 +1057,63 @@ class Glyph:
         return self.name
 
 
+FT_PIXEL_MODE_MONO = 1
+FT_PIXEL_MODE_GRAY = 2
+
+# A rasterized glyph. pixels is a rows x width uint8 array, left and
+# top are the offsets of its top left corner from the pen position.
+GlyphBitmap = namedtuple("GlyphBitmap", ["pixels", "left", "top"])
+
+
+def ft_bitmap_memory(bitmap):
+    """Expose an FT_Bitmap's buffer as a rows x abs(pitch) uint8 array
+    without copying it.
+
+    Rows run top to bottom. The array is only valid until FreeType
+    reuses the bitmap, e.g. when the glyph slot loads another glyph.
+
+    Parameters
+    ----------
+    bitmap: freetype.Bitmap or FT_Bitmap
+    """
+    import ctypes
+    content = getattr(bitmap, "_FT_Bitmap", bitmap)
+    pitch = abs(content.pitch)
+    if not content.rows or not pitch or not content.buffer:
+        return np.zeros((content.rows, pitch), dtype=np.uint8)
+    pointer = ctypes.cast(content.buffer, ctypes.POINTER(ctypes.c_ubyte))
+    memory = np.ctypeslib.as_array(pointer, shape=(content.rows, pitch))
+    if content.pitch < 0:
+        # Bitmaps flowing up start with their bottom row
+        memory = memory[::-1]
+    return memory
+
+
+def ft_bitmap_array(bitmap):
+    """Get an FT_Bitmap's pixels as a rows x width uint8 array.
+
+    Grey bitmaps are a view of FreeType's buffer, see ft_bitmap_memory.
+    Mono bitmaps are unpacked into a new array of 0 and 255 values.
+
+    Parameters
+    ----------
+    bitmap: freetype.Bitmap or FT_Bitmap
+
+    Returns
+    -------
+    np.ndarray
+    """
+    content = getattr(bitmap, "_FT_Bitmap", bitmap)
+    memory = ft_bitmap_memory(content)
+    if content.pixel_mode == FT_PIXEL_MODE_MONO:
+        bits = np.unpackbits(memory, axis=1)[:, :content.width]
+        return bits * np.uint8(255)
+    if content.pixel_mode != FT_PIXEL_MODE_GRAY:
+        raise ValueError("Unsupported FreeType pixel mode {}".format(
+            content.pixel_mode))
+    return memory[:, :content.width]
+
+
 def find_token(string, tokens):
     """Find the largest token within a string e.g
 
@@ -16,7 +16,17 @@ TODO (M Foley) Remove this module
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import division, print_function
+from collections import defaultdict
+import heapq
+import itertools
 from fontTools.ttLib import TTFont
+import numpy as np
+
+
+# Features which give access to every alternate of a glyph. Inputs
+# which use them rank after inputs using the features that actually
+# produce a glyph.
+ACCESS_ALL_FEATURES = ("aalt",)
 
 
 class HbInputGenerator(object):
@@ -28,23 +38,18 @@ class HbInputGenerator(object):
 
     def __init__(self, font):
         self.font = font
-        self.memo = {}
-        self.gsub_memo = {}
+        self._inputs = None
         self.reverse_cmap = build_reverse_cmap(self.font.ttfont)
+        self.gsub_index = build_gsub_index(self.font.ttfont)
+        self.lookup_features = build_lookup_features(self.font.ttfont)
+        self.context_index, self.class_defs = build_context_index(
+            self.font.ttfont)
 
-        self.widths = {}
-        glyph_set = self.font.ttfont.getGlyphSet()
-        glyf_table = font.ttfont['glyf']
-        for name in glyph_set.keys():
-            glyph = glyph_set[name]
-            glyf = glyf_table[name]
-            if glyph.width:
-                width = glyph.width
-            elif hasattr(glyf, 'xMax'):
-                width = abs(glyf.xMax - glyf.xMin)
-            else:
-                width = 0
-            self.widths[name] = width
+        # Glyphs without an advance are as wide as their outline
+        store = self.font.glyph_store
+        widths = np.where(store.advance != 0, store.advance,
+                          store.bounds[:, 2] - store.bounds[:, 0])
+        self.widths = dict(zip(store.glyph_order, widths.tolist()))
 
         # some stripped fonts don't have space
         try:
@@ -57,220 +62,197 @@ class HbInputGenerator(object):
         """Generate harfbuzz inputs for all glyphs in a given font."""
 
         inputs = []
-        glyph_set = self.font.ttfont.getGlyphSet()
-        for name in self.font.ttfont.getGlyphOrder():
-            is_zero_width = glyph_set[name].width == 0
-            cur_input = self.input_from_name(name, pad=is_zero_width)
+        store = self.font.glyph_store
+        for name, advance in zip(store.glyph_order, store.advance.tolist()):
+            cur_input = self.input_from_name(name, pad=advance == 0)
             if cur_input is not None:
                 inputs.append(cur_input)
             elif warn:
                 print('not tested (unreachable?): %s' % name)
         return inputs
 
-    def input_from_name(self, name, seen=None, pad=False):
+    @property
+    def inputs(self):
+        """Dictionary mapping each reachable glyph name to its
+        (features, text) input, solved on first access."""
+        if self._inputs is None:
+            self._inputs = self.solve_inputs()
+        return self._inputs
+
+    def input_from_name(self, name, pad=False):
         """Given glyph name, return input to harbuzz to render this glyph.
 
         Returns input in the form of a (features, text) tuple, where `features`
         is a list of feature tags to activate and `text` is an input string.
+        `pad` can be used to add whitespace to text output, for non-spacing
+        glyphs.
 
-        Argument `seen` is used by the method to avoid following cycles when
-        recursively looking for possible input. `pad` can be used to add
-        whitespace to text output, for non-spacing glyphs.
-
-        Can return None in two situations: if no possible input is found (no
-        simple unicode mapping or substitution rule exists to generate the
-        glyph), or if the requested glyph already exists in `seen` (in which
-        case this path of generating input should not be followed further).
+        Returns None if no possible input is found (no simple unicode
+        mapping or substitution rule exists to generate the glyph).
         """
 
-        if name in self.memo:
-            return self.memo[name]
-
-        inputs = []
-
-        # avoid following cyclic paths through features
-        if seen is None:
-            seen = set()
-        if name in seen:
-            return None
-        seen.add(name)
-
-        # see if this glyph has a simple unicode mapping
-        if name in self.reverse_cmap:
-            text = chr(self.reverse_cmap[name])
-            inputs.append(((), text))
-
-        # check the substitution features
-        inputs.extend(self._inputs_from_gsub(name, seen))
-        # seen.remove(name)
-
-        # TODO (MFOLEY) report it gets stuck here ^
-        # disabling does no affect the output, infact it  stops the
-        # cycling which is what they want.
-
-        # since this method sometimes returns None to avoid cycles, the
-        # recursive calls that it makes might have themselves returned None,
-        # but we should avoid returning None here if there are other options
-        inputs = [i for i in inputs if i is not None]
-        if not inputs:
+        if name not in self.inputs:
             return None
-
-        features, text = min(inputs)
+        features, text = self.inputs[name]
         # can't pad if we don't support space
         if pad and self.space_width > 0:
             width, space = self.widths[name], self.space_width
             padding = ' ' * (width // space + (1 if width % space else 0))
             text = padding + text
-        self.memo[name] = features, text
-        return self.memo[name]
+        return features, text
 
-    def _inputs_from_gsub(self, name, seen):
-        """Check GSUB for possible input yielding glyph with given name.
-        The `seen` argument is passed in from the original call to
-        input_from_name().
+    def _cmap_input(self, name):
+        """Return the input for a glyph with a unicode mapping, or None"""
+        if name not in self.reverse_cmap:
+            return None
+        return (), chr(self.reverse_cmap[name])
+
+    def solve_inputs(self):
+        """Find the smallest input for every reachable glyph.
+
+        Glyphs and (input glyphs, lookup index) contexts are nodes of a
+        graph. A context is reached by switching on a feature which
+        references its lookup once all its input glyphs are reached, or
+        through a contextual rule which calls its lookup. A glyph is
+        reached through its unicode mapping or through any context which
+        substitutes it in.
+
+        Inputs are ranked by their amount of ACCESS_ALL_FEATURES, then
+        their amount of features, then the length of their text, then
+        the features and text themselves. Every feature switched on
+        makes an input larger than the inputs it is built from, so the
+        graph is solved like a shortest path problem, settling nodes
+        smallest first. Each node and edge is visited once
+        and the result doesn't depend on the order glyphs are asked for.
+
+        Returns
+        -------
+        dict
+            Glyph names mapped to (features, text) tuples
         """
+        # node -> nodes which are reached with the same input
+        passes_to = defaultdict(list)
+        # glyph -> feature edges it is an input of
+        feature_edges = defaultdict(list)
+        # each feature edge is [unreached inputs, context, feature tag]
+        edges = []
+
+        contexts = []
+        seen = set()
+        for name, substitutions in self.gsub_index.items():
+            for lookup_index, glyphs in substitutions:
+                context = (glyphs, lookup_index)
+                passes_to[context].append(name)
+                if context not in seen:
+                    seen.add(context)
+                    contexts.append(context)
+
+        while contexts:
+            context = contexts.pop()
+            glyphs, lookup_index = context
+            for feature_tag in self.lookup_features.get(lookup_index, ()):
+                edge = [len(set(glyphs)), context, feature_tag]
+                edges.append(edge)
+                for glyph in set(glyphs):
+                    feature_edges[glyph].append(edge)
+
+            for cur_i, rule_type, st, rule in self.context_index.get(lookup_index, ()):
+                for input_glyphs in self._context_inputs(rule_type, st, rule, glyphs):
+                    outer = (tuple(input_glyphs), cur_i)
+                    passes_to[outer].append(context)
+                    if outer not in seen:
+                        seen.add(outer)
+                        contexts.append(outer)
+
+        queue = []
+        counter = itertools.count()
+
+        def push(node, value):
+            features, text = value
+            access_all = sum(f in ACCESS_ALL_FEATURES for f in features)
+            rank = (access_all, len(features), len(text), features, text)
+            heapq.heappush(queue, (rank, next(counter), node, value))
 
-        inputs = []
-        if 'GSUB' not in self.font.ttfont:
-            return inputs
-        gsub = self.font.ttfont['GSUB'].table
-        if gsub.LookupList is None:
-            return inputs
-        for lookup_index, lookup in enumerate(gsub.LookupList.Lookup):
-            for st in lookup.SubTable:
-
-                # see if this glyph can be a single-glyph substitution
-                if lookup.LookupType == 1:
-                    for glyph, subst in st.mapping.items():
-                        if subst == name:
-                            inputs.append(self._input_with_context(
-                                gsub, [glyph], lookup_index, seen))
-
-                # see if this glyph is a ligature
-                elif lookup.LookupType == 4:
-                    for prefix, ligatures in st.ligatures.items():
-                        for ligature in ligatures:
-                            if ligature.LigGlyph == name:
-                                glyphs = [prefix] + list(ligature.Component)
-                                inputs.append(self._input_with_context(
-                                    gsub, glyphs, lookup_index, seen))
+        for name in self.font.ttfont.getGlyphOrder():
+            value = self._cmap_input(name)
+            if value is not None:
+                push(name, value)
+
+        settled = {}
+        inputs = {}
+        while queue:
+            _, _, node, value = heapq.heappop(queue)
+            if node in settled:
+                continue
+            settled[node] = value
+            if isinstance(node, str):
+                inputs[node] = value
+                for edge in feature_edges.get(node, ()):
+                    edge[0] -= 1
+                    if edge[0] == 0:
+                        glyphs, _ = edge[1]
+                        features = (edge[2],)
+                        for glyph in glyphs:
+                            features += settled[glyph][0]
+                        text = ''.join(settled[glyph][1] for glyph in glyphs)
+                        push(edge[1], (features, text))
+            for target in passes_to.get(node, ()):
+                if target not in settled:
+                    push(target, value)
         return inputs
 
-    def _input_with_context(self, gsub, glyphs, target_i, seen):
-        """Given GSUB, input glyphs, and target lookup index, return input to
-        harfbuzz to render the input glyphs with the target lookup activated.
-        """
+    def _context_inputs(self, rule_type, st, rule, glyphs):
+        """Return the input glyph lists of a contextual rule which apply
+        its lookups to the given glyphs."""
+        input_from_rule = getattr(self, '_input_from_%d_%d' % rule_type)
+        return input_from_rule(st, rule, list(glyphs))
 
-        inputs = []
-        memo_key = (tuple(glyphs), target_i)
-        if memo_key in self.gsub_memo:
-            return self.gsub_memo[memo_key]
-        # try to get a feature tag to activate this lookup
-        for feature in gsub.FeatureList.FeatureRecord:
-            if target_i in feature.Feature.LookupListIndex:
-                inputs.append(self._sequence_from_glyph_names(
-                    glyphs, (feature.FeatureTag,), seen))
-
-        for cur_i, lookup in enumerate(gsub.LookupList.Lookup):
-            # try contextual substitutions
-            if lookup.LookupType == 5:
-                for st in lookup.SubTable:
-                    #TODO handle format 3
-                    if st.Format == 1:
-                        inputs.extend(self._input_from_5_1(
-                            gsub, st, glyphs, target_i, cur_i, seen))
-                    if st.Format == 2:
-                        inputs.extend(self._input_from_5_2(
-                            gsub, st, glyphs, target_i, cur_i, seen))
-
-            # try chaining substitutions
-            if lookup.LookupType == 6:
-                for st in lookup.SubTable:
-                    #TODO handle format 2
-                    if st.Format == 1:
-                        inputs.extend(self._input_from_6_1(
-                            gsub, st, glyphs, target_i, cur_i, seen))
-                    if st.Format == 3:
-                        inputs.extend(self._input_from_6_3(
-                            gsub, st, glyphs, target_i, cur_i, seen))
-
-        inputs = [i for i in inputs if i is not None]
-        self.gsub_memo[memo_key] = min(inputs) if inputs else None
-        return self.gsub_memo[memo_key]
-
-    def _input_from_5_1(self, gsub, st, glyphs, target_i, cur_i, seen):
-        """Return inputs from GSUB type 5.1 (simple context) rules."""
+    def _input_from_5_1(self, st, rule, glyphs):
+        """Return inputs from a GSUB type 5.1 (simple context) rule."""
 
         inputs = []
-        for ruleset in st.SubRuleSet:
-            for rule in ruleset.SubRule:
-                if not any(subst_lookup.LookupListIndex == target_i
-                           for subst_lookup in rule.SubstLookupRecord):
-                    continue
-                for prefix in st.Coverage.glyphs:
-                    input_glyphs = [prefix] + rule.Input
-                    if not self._is_sublist(input_glyphs, glyphs):
-                        continue
-                    inputs.append(self._input_with_context(
-                        gsub, input_glyphs, cur_i, seen))
+        for prefix in st.Coverage.glyphs:
+            input_glyphs = [prefix] + rule.Input
+            if not self._is_sublist(input_glyphs, glyphs):
+                continue
+            inputs.append(input_glyphs)
         return inputs
 
-    def _input_from_5_2(self, gsub, st, glyphs, target_i, cur_i, seen):
-        """Return inputs from GSUB type 5.2 (class-based context) rules."""
+    def _input_from_5_2(self, st, rule, glyphs):
+        """Return inputs from a GSUB type 5.2 (class-based context) rule."""
 
-        inputs = []
-        involved = set(st.ClassDef.classDefs.keys()) | set(st.Coverage.glyphs)
+        involved, class_glyphs = self.class_defs[id(st)]
         if not any([glyph in involved for glyph in glyphs]):
             return []
-        prefixes = st.Coverage.glyphs
-        class_defs = st.ClassDef.classDefs.items()
-        for ruleset in st.SubClassSet:
-            if ruleset is None:
-                continue
-            for rule in ruleset.SubClassRule:
-                if not any(subst_lookup.LookupListIndex == target_i
-                            for subst_lookup in rule.SubstLookupRecord):
-                    continue
-                classes = [
-                    [n for n, c in class_defs if c == cls]
-                    for cls in rule.Class]
-                input_lists = [prefixes] + classes
-                input_glyphs = self._min_permutation(input_lists, glyphs)
-                if not self._is_sublist(input_glyphs, glyphs):
-                    continue
-                inputs.append(self._input_with_context(
-                    gsub, input_glyphs, cur_i, seen))
-        return inputs
+        classes = [class_glyphs.get(cls, []) for cls in rule.Class]
+        input_lists = [st.Coverage.glyphs] + classes
+        input_glyphs = self._min_permutation(input_lists, glyphs)
+        if not self._is_sublist(input_glyphs, glyphs):
+            return []
+        return [input_glyphs]
 
-    def _input_from_6_1(self, gsub, st, glyphs, target_i, cur_i, seen):
-        """Return inputs from GSUB type 6.1 (simple chaining) rules."""
+    def _input_from_6_1(self, st, rule, glyphs):
+        """Return inputs from a GSUB type 6.1 (simple chaining) rule."""
 
         inputs = []
-        for ruleset in st.ChainSubRuleSet:
-            for rule in ruleset.ChainSubRule:
-                if not any(subst_lookup.LookupListIndex == target_i
-                           for subst_lookup in rule.SubstLookupRecord):
-                    continue
-                for prefix in st.Coverage.glyphs:
-                    input_glyphs = [prefix] + rule.Input
-                    if not self._is_sublist(input_glyphs, glyphs):
-                        continue
-                    if rule.LookAhead:
-                        input_glyphs = input_glyphs + rule.LookAhead
-                    if rule.Backtrack:
-                        bt = list(reversed(rule.Backtrack))
-                        input_glyphs = bt + input_glyphs
-                    inputs.append(self._input_with_context(
-                        gsub, input_glyphs, cur_i, seen))
+        for prefix in st.Coverage.glyphs:
+            input_glyphs = [prefix] + rule.Input
+            if not self._is_sublist(input_glyphs, glyphs):
+                continue
+            if rule.LookAhead:
+                input_glyphs = input_glyphs + rule.LookAhead
+            if rule.Backtrack:
+                bt = list(reversed(rule.Backtrack))
+                input_glyphs = bt + input_glyphs
+            inputs.append(input_glyphs)
         return inputs
 
-    def _input_from_6_3(self, gsub, st, glyphs, target_i, cur_i, seen):
-        """Return inputs from GSUB type 6.3 (coverage-based chaining) rules."""
+    def _input_from_6_3(self, st, rule, glyphs):
+        """Return inputs from GSUB type 6.3 (coverage-based chaining) rules.
+        The subtable is its own rule."""
         input_lists = [c.glyphs for c in st.InputCoverage]
         input_glyphs = self._min_permutation(input_lists, glyphs)
-        if not (any(subst_lookup.LookupListIndex == target_i
-                    for subst_lookup in st.SubstLookupRecord) and
-                self._is_sublist(input_glyphs, glyphs)):
+        if not self._is_sublist(input_glyphs, glyphs):
             return []
         if st.LookAheadCoverage:
             la = [min(c.glyphs) for c in st.LookAheadCoverage]
@@ -279,21 +261,7 @@ class HbInputGenerator(object):
             bt = list(reversed([min(c.glyphs)
                                 for c in st.BacktrackCoverage]))
             input_glyphs = bt + input_glyphs
-        return [self._input_with_context(
-            gsub, input_glyphs, cur_i, seen)]
-
-    def _sequence_from_glyph_names(self, glyphs, features, seen):
-        """Return a sequence of glyphs from glyph names."""
-
-        text = []
-        for glyph in glyphs:
-            cur_input = self.input_from_name(glyph, seen)
-            if cur_input is None:
-                return None
-            cur_features, cur_text = cur_input
-            features += cur_features
-            text.append(cur_text)
-        return features, ''.join(text)
+        return [input_glyphs]
 
     def _min_permutation(self, lists, target):
         """Deterministically select a permutation, containing target list as a
@@ -332,6 +300,120 @@ def build_reverse_cmap(font):
     return {n: v for v, n in reversed(sorted(cmap_items))}
 
 
+def _gsub_lookups(font):
+    """Yield (lookup index, lookup type, subtable) for each GSUB subtable,
+    unwrapping extension subtables."""
+
+    if 'GSUB' not in font:
+        return
+    gsub = font['GSUB'].table
+    if gsub.LookupList is None:
+        return
+    for lookup_index, lookup in enumerate(gsub.LookupList.Lookup):
+        for st in lookup.SubTable:
+            lookup_type = lookup.LookupType
+            if lookup_type == 7:
+                lookup_type = st.ExtensionLookupType
+                st = st.ExtSubTable
+            yield lookup_index, lookup_type, st
+
+
+def build_gsub_index(font):
+    """Build a dictionary mapping each glyph name GSUB can substitute in
+    to a list of (lookup index, input glyph names) tuples which produce it.
+
+    Covers single, multiple, alternate and ligature substitutions,
+    including ones wrapped in extension lookups. For alternate
+    substitutions only the first alternate is used, since that is the
+    one a feature selects when it is switched on.
+    """
+
+    index = defaultdict(list)
+    for lookup_index, lookup_type, st in _gsub_lookups(font):
+        if lookup_type == 1:
+            for glyph, subst in st.mapping.items():
+                index[subst].append((lookup_index, (glyph,)))
+
+        elif lookup_type == 2:
+            for glyph, sequence in st.mapping.items():
+                for subst in dict.fromkeys(sequence):
+                    index[subst].append((lookup_index, (glyph,)))
+
+        elif lookup_type == 3:
+            for glyph, alternates in st.alternates.items():
+                if alternates:
+                    index[alternates[0]].append((lookup_index, (glyph,)))
+
+        elif lookup_type == 4:
+            for prefix, ligatures in st.ligatures.items():
+                for ligature in ligatures:
+                    glyphs = (prefix,) + tuple(ligature.Component)
+                    index[ligature.LigGlyph].append((lookup_index, glyphs))
+    return index
+
+
+def build_lookup_features(font):
+    """Build a dictionary mapping GSUB lookup indices to the tags of the
+    features which reference them."""
+
+    lookup_features = defaultdict(list)
+    if 'GSUB' not in font:
+        return lookup_features
+    gsub = font['GSUB'].table
+    if gsub.FeatureList is None:
+        return lookup_features
+    for feature in gsub.FeatureList.FeatureRecord:
+        for lookup_index in feature.Feature.LookupListIndex:
+            tags = lookup_features[lookup_index]
+            if feature.FeatureTag not in tags:
+                tags.append(feature.FeatureTag)
+    return lookup_features
+
+
+def _called_lookups(subst_lookup_records):
+    return dict.fromkeys(r.LookupListIndex for r in subst_lookup_records)
+
+
+def build_context_index(font):
+    """Index GSUB contextual and chaining rules by the lookups they call.
+
+    Returns a dictionary mapping each called lookup index to a list of
+    (lookup index, (lookup type, format), subtable, rule) tuples, and a
+    dictionary mapping the id of each class-based context subtable to
+    the set of glyphs it involves and its classes inverted to lists of
+    glyph names. Subtables which are a single rule, such as format 3,
+    are their own rule.
+    """
+
+    index = defaultdict(list)
+    class_defs = {}
+    for lookup_index, lookup_type, st in _gsub_lookups(font):
+        if lookup_type not in (5, 6):
+            continue
+        rule_type = (lookup_type, st.Format)
+        # TODO handle formats 5.3 and 6.2
+        if rule_type == (5, 1):
+            rules = [r for rs in st.SubRuleSet for r in rs.SubRule]
+        elif rule_type == (5, 2):
+            class_glyphs = defaultdict(list)
+            for name, cls in st.ClassDef.classDefs.items():
+                class_glyphs[cls].append(name)
+            involved = set(st.ClassDef.classDefs.keys()) | set(st.Coverage.glyphs)
+            class_defs[id(st)] = (involved, class_glyphs)
+            rules = [r for rs in st.SubClassSet if rs is not None
+                     for r in rs.SubClassRule]
+        elif rule_type == (6, 1):
+            rules = [r for rs in st.ChainSubRuleSet for r in rs.ChainSubRule]
+        elif rule_type == (6, 3):
+            rules = [st]
+        else:
+            continue
+        for rule in rules:
+            for target_i in _called_lookups(rule.SubstLookupRecord):
+                index[target_i].append((lookup_index, rule_type, st, rule))
+    return index, class_defs
+
+
 def get_largest_cmap(font):
   cmap_table = font['cmap']
   cmap = None
@@ -0,0 +1,170 @@
+"""
+Module to diff many pairs of fonts at once.
+
+Shared by the instance sweep and diffenator-batch. Pairs are diffed
+over a pool of forked processes, which inherit the fonts parsed before
+the pool starts. Each pair's tables are reported in a section of a
+single report.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+import os
+from diffenator.diff import DiffFonts, FORMATTERS, report_formatter
+from diffenator.font import DFont, STATIC_TABLES
+
+
+__all__ = ['preload', 'output_dir', 'diff_report', 'run_pool',
+           'combined_report']
+
+logger = logging.getLogger('fontdiffenator')
+
+# Pool state for the current process. Workers inherit it when they
+# are forked.
+_pool = {}
+
+
+def preload(font):
+    """Decompile the source tables instances share, so forked workers
+    inherit them instead of each decompiling their own."""
+    if not isinstance(font, DFont):
+        return
+    for tag in STATIC_TABLES:
+        if tag in font._src_ttfont:
+            font._src_ttfont[tag]
+
+
+def output_dir(path, name):
+    """Subdirectory of path to write the output of the pair name to"""
+    safe_name = "".join(c if c.isalnum() or c in "-_." else "_"
+                        for c in name)
+    return os.path.join(path, safe_name)
+
+
+def diff_report(name, font_before, font_after, settings, limit=50,
+                r_type="txt"):
+    """Diff two fonts and report their diff tables.
+
+    Parameters
+    ----------
+    name: str
+        Name of the pair. If settings have a render_path or spill_dir,
+        gifs and spilled rows are written to a subdirectory named
+        after it.
+    font_before: DFont
+    font_after: DFont
+    settings: dict
+        DiffFonts settings
+    limit: int
+        Amount of rows to report for each diff table
+    r_type: str
+        Report type, either "txt", "md" or "html"
+
+    Returns
+    -------
+    diff: DiffFonts
+    tables: list
+        Report of each diff table, see DiffFonts.table_reports
+    """
+    if settings.get("spill_dir"):
+        settings = dict(settings, spill_dir=output_dir(
+            settings["spill_dir"], name))
+    diff = DiffFonts(font_before, font_after, settings)
+    font_before.save_cache()
+    font_after.save_cache()
+
+    image_dir = None
+    if settings.get("render_path"):
+        image_dir = output_dir(settings["render_path"], name)
+        diff.to_gifs(image_dir, limit)
+    return diff, diff.table_reports(limit, r_type, image_dir)
+
+
+def _run_job(job):
+    return _pool["diff_job"](job, _pool["state"])
+
+
+def run_pool(diff_job, jobs, state, processes=None):
+    """Call diff_job(job, state) for each job over a pool of forked
+    processes.
+
+    state is shared with the workers, which inherit it when they are
+    forked, so it may hold parsed fonts. If processes run in parallel,
+    the DiffFonts settings in state["settings"] diff categories and
+    render glyphs serially.
+
+    Parameters
+    ----------
+    diff_job: function
+    jobs: list
+    state: dict
+    processes: int
+        Amount of processes to use. Defaults to the cpu count. Jobs
+        are run in this process if processes is 1 or the platform
+        can't fork.
+
+    Returns
+    -------
+    list
+        Result of each job
+    """
+    _pool.update(diff_job=diff_job, state=state)
+    try:
+        processes = min(processes or os.cpu_count() or 1, len(jobs))
+        if processes > 1 and \
+                "fork" not in multiprocessing.get_all_start_methods():
+            logger.info("Platform can't fork, diffing serially")
+            processes = 1
+        if processes <= 1:
+            return [_run_job(job) for job in jobs]
+
+        logger.info("Diffing {} pairs over {} processes".format(
+            len(jobs), processes))
+        # Pairs already use every process, diff their categories and
+        # render their glyphs serially
+        state["settings"]["render_jobs"] = 1
+        state["settings"]["diff_jobs"] = 1
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(processes, mp_context=context) as pool:
+            return list(pool.map(_run_job, jobs))
+    finally:
+        _pool.clear()
+
+
+def combined_report(sections, limit=50, r_type="txt", dst=None,
+                    summary=None):
+    """Combine the reports of several pairs into a single report with a
+    section for each pair.
+
+    Parameters
+    ----------
+    sections: list
+        (heading, tables) tuple for each pair
+    limit: int
+        Amount of rows reported for each diff table
+    r_type: str
+        Report type, either "txt", "md" or "html"
+    dst: str
+        Path to write the report to. If no path is given, return it.
+    summary: list
+        Reports to put before the sections
+
+    Returns
+    -------
+    str
+    """
+    reports = [report_formatter(r_type, limit).text]
+    reports += summary or []
+    for heading, tables in sections:
+        section = FORMATTERS[r_type]()
+        section.subheading(heading)
+        if not tables:
+            section.paragraph("No differences")
+        reports.append(section.text)
+        reports += tables
+
+    if dst:
+        with open(dst, 'w') as doc:
+            doc.write("\n\n".join(reports))
+    else:
+        return "\n\n".join(reports)
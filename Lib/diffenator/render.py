@@ -0,0 +1,201 @@
+"""Module to render tables using HarfBuzz, FreeType and Cairo.
+
+The rendering stack is slow to import, so this module is only loaded
+once an image is requested.
+"""
+import os
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from cairo import Context, ImageSurface, FORMAT_A8, FORMAT_ARGB32
+import uharfbuzz as hb
+from diffenator.dump import read_cbdt
+
+
+def shape_string(font, string, ot_features):
+    buf = hb.Buffer.create()
+    buf.add_str(string)
+    buf.guess_segment_properties()
+    try:
+        features = {f: True for f in ot_features}
+        hb.shape(font.hbfont, buf, features)
+    except KeyError:
+        hb.shape(font.hbfont, buf)
+    return buf
+
+
+def tab_width(table, font, limit=800):
+    result = 0
+    for row in table._data[:limit]:
+        buf = shape_string(font, row['string'], row['features'])
+        if not buf.glyph_positions:
+            continue
+        adv = sum([i.x_advance for i in buf.glyph_positions])
+        if adv > result:
+            result = adv
+    return result + 300
+
+
+def table_to_png(table, font, font_position=None, dst=None,
+                 limit=800, size=1500, tab_width=1500, prefix_characters="",
+                 suffix_characters=""):
+    """Use HB, FreeType and Cairo to produce a png for a table.
+
+    Parameters
+    ----------
+    table: Tbl
+    font: DFont
+    font_position: str
+        Label indicating which font has been used.
+    dst: str
+        Path to output image. If no path is given, return in-memory
+    """
+    # TODO (M Foley) better packaging for pycairo, freetype-py
+    # and uharfbuzz.
+    # Users should be able to pip install these bindings without needing
+    # to install the correct libs.
+
+    # A special mention to the individuals who maintain these packages. Using
+    # these dependencies has sped up the process of creating diff images
+    # significantly. It's an incredible age we live in.
+    data = table._data
+    y_tab = int(1500 / 25)
+    x_tab = int(tab_width / 64)
+    width, height = 1024, 200
+
+    cells_per_row = int((width - x_tab) / x_tab)
+    # Compute height of image
+    x, y, baseline = x_tab, 0, 0
+    for idx, row in enumerate(data[:limit]):
+        x += x_tab
+
+        if idx % cells_per_row == 0:
+            y += y_tab
+            x = x_tab
+    height += y
+    height += 100
+
+    # draw image
+    Z = ImageSurface(FORMAT_ARGB32, width, height)
+    ctx = Context(Z)
+    ctx.rectangle(0, 0, width, height)
+    ctx.set_source_rgb(1, 1, 1)
+    ctx.fill()
+
+    # label image
+    ctx.set_font_size(30)
+    ctx.set_source_rgb(0.5, 0.5, 0.5)
+    ctx.move_to(x_tab, 50)
+    ctx.show_text("{}: {}".format(table.table_name, table.count))
+    ctx.move_to(x_tab, 100)
+    if font_position:
+        ctx.show_text("Font Set: {}".format(font_position))
+    if table.count > limit:
+        ctx.set_font_size(20)
+        ctx.move_to(x_tab, 150)
+        ctx.show_text("Warning: {} different items. Only showing most serious {}".format(
+            table.count, limit)
+        )
+
+    hb.ot_font_set_funcs(font.hbfont)
+
+    # Draw glyphs
+    x, y, baseline = x_tab, 200, 0
+    x_pos = x_tab
+    y_pos = 200
+    for idx, row in enumerate(data[:limit]):
+        string = "{}{}{}".format(
+            prefix_characters,
+            row['string'],
+            suffix_characters)
+        buf = shape_string(font, string, row['features'])
+        char_info = buf.glyph_infos
+        char_pos = buf.glyph_positions
+        if not char_info or not char_pos:
+            continue
+        for info, pos in zip(char_info, char_pos):
+            bitmap = font.render_glyph(info.codepoint)
+
+            if bitmap.pixels.size > 0:
+                ctx.set_source_rgb(0, 0, 0)
+                glyph_surface = _make_image_surface(bitmap.pixels)
+                ctx.set_source_surface(glyph_surface,
+                                       x_pos + bitmap.left + (pos.x_offset / 64.),
+                                       y_pos - bitmap.top - (pos.y_offset / 64.))
+                glyph_surface.flush()
+                ctx.paint()
+            x_pos += (pos.x_advance) / 64.
+            y_pos += (pos.y_advance) / 64.
+
+        x_pos += x_tab - (x_pos % x_tab)
+        if idx % cells_per_row == 0:
+            # add label
+            if font_position:
+                ctx.set_source_rgb(0.5, 0.5, 0.5)
+                ctx.set_font_size(10)
+                ctx.move_to(width - 20, y_pos)
+                ctx.rotate(1.5708)
+                ctx.show_text(font_position)
+                ctx.set_source_rgb(0,0,0)
+                ctx.rotate(-1.5708)
+            # Start a new row
+            y_pos += y_tab
+            x_pos = x_tab
+    Z.flush()
+    if dst:
+        Z.write_to_png(dst)
+    else:
+        img = BytesIO()
+        Z.write_to_png(img)
+        return Image.open(img)
+
+
+def _make_image_surface(pixels):
+    """Convert a rows x width array of gray pixels to a Cairo
+    ImageSurface.
+
+    Special thanks to Hintak and his example code:
+    https://github.com/rougier/freetype-py/blob/master/examples/bitmap_to_surface.py
+
+    If the array's rows already have Cairo's stride, the surface uses
+    its buffer directly. Otherwise the pixels are copied once into a
+    buffer with Cairo's stride."""
+    rows, width = pixels.shape
+    cairo_format = FORMAT_A8
+    dst_pitch = ImageSurface.format_stride_for_width(cairo_format, width)
+
+    if not pixels.flags.c_contiguous or width != dst_pitch:
+        padded = np.zeros((rows, dst_pitch), dtype=np.uint8)
+        padded[:, :width] = pixels
+        pixels = padded
+    result = ImageSurface.create_for_data(
+        pixels, cairo_format, width, rows, dst_pitch)
+    return result
+
+
+def cbdt_to_gif(table, dst):
+    """Output before and after gifs for each row of a cbdt DiffTable"""
+    font_a_images = read_cbdt(table._font_a.ttfont)
+    font_b_images = read_cbdt(table._font_b.ttfont)
+
+    for element in table._data:
+        key_before = element["glyph before"]
+        key_after = element["glyph after"]
+
+        image_1 = font_a_images[key_before]
+        image_1_gif = Image.new('RGBA', image_1.size, (255, 255, 255))
+        image_1_gif.paste(image_1, image_1)
+        image_1_gif = image_1_gif.convert('RGB').convert('P', palette=Image.ADAPTIVE)
+
+        image_2 = font_b_images[key_after]
+        image_2_gif = Image.new('RGBA', image_2.size, (255, 255, 255))
+        image_2_gif.paste(image_2, image_2)
+        image_2_gif = image_2_gif.convert('RGB').convert('P', palette=Image.ADAPTIVE)
+
+        img_path = os.path.join(dst, f"{key_before}.gif")
+        image_1_gif.save(img_path,
+                         save_all=True,
+                         append_images=[image_2_gif],
+                         duration=1000,
+                         loop=0
+        )
@@ -0,0 +1,146 @@
+"""Module to write diffs as machine readable records.
+
+DiffFonts._serialise yields a stream of records, which are plain dicts
+of strings, numbers, lists and dicts:
+
+header
+    The diffenator version, the FORMAT of the records, the fonts which
+    were diffed and the rows_limit tables were cut to, null if tables
+    hold every row
+category
+    A diffed category
+table
+    A diff table of the last category, with its name, count, summary
+    and report columns
+row
+    A row of the last table
+
+Each record has a "type" key. Rows are written as they are encoded,
+so a reader can process a diff table by table. Glyphs are encoded as
+[name, gid, key] lists, see GLYPH_FIELDS. Columns which only format
+the txt, md and html reports are left out, see REPORT_ONLY_COLUMNS.
+"""
+import json
+import sys
+import numpy as np
+from diffenator import __version__
+from diffenator.font import Glyph
+
+
+__all__ = ['FORMAT', 'RECORD_WRITERS', 'encode_value', 'encode_row',
+           'write_records']
+
+# Version of the record layout. Bump it whenever records change in a
+# way readers would notice.
+FORMAT = 1
+
+GLYPH_FIELDS = ("name", "gid", "key")
+
+REPORT_ONLY_COLUMNS = ("description", "htmlfeatures", "image")
+
+
+def encode_value(value):
+    """Convert a diff table value to plain Python types"""
+    if isinstance(value, Glyph):
+        return [value.name, int(value.index), value.key]
+    if isinstance(value, dict):
+        return {str(k): encode_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def encode_row(row):
+    """Encode a diff table row, leaving out its report only columns"""
+    return {k: encode_value(v) for k, v in row.items()
+            if k not in REPORT_ONLY_COLUMNS}
+
+
+def encode_font(font):
+    return dict(
+        path=font.path,
+        upm=int(font.upm),
+        coordinates=encode_value(font.instance_coordinates or {}),
+    )
+
+
+def header_record(font_before, font_after, rows_limit=None):
+    return dict(
+        type="header",
+        version=__version__,
+        format=FORMAT,
+        glyph_fields=list(GLYPH_FIELDS),
+        font_before=encode_font(font_before),
+        font_after=encode_font(font_after),
+        rows_limit=rows_limit,
+    )
+
+
+def table_record(category, subtable, table):
+    return dict(
+        type="table",
+        category=category,
+        table=subtable,
+        name=table.table_name,
+        count=int(table.count),
+        summary=encode_value(table.summary),
+        columns=[c for c in table._report_columns or []
+                 if c not in REPORT_ONLY_COLUMNS],
+    )
+
+
+def _write_jsonl(records, doc):
+    for record in records:
+        doc.write(json.dumps(record, ensure_ascii=False,
+                             separators=(",", ":")))
+        doc.write("\n")
+
+
+def _write_msgpack(records, doc):
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError("Writing MessagePack needs msgpack, install it "
+                          "with pip install fontdiffenator[msgpack]")
+    packer = msgpack.Packer()
+    for record in records:
+        doc.write(packer.pack(record))
+
+
+# Writer and whether it writes bytes, for each record format
+RECORD_WRITERS = {
+    "json": (_write_jsonl, False),
+    "msgpack": (_write_msgpack, True),
+}
+
+
+def write_records(records, fmt="json", dst=None):
+    """Write records as JSON Lines or as a stream of MessagePack
+    objects.
+
+    Parameters
+    ----------
+    records: iterable of dict
+    fmt: str
+        Either "json" or "msgpack"
+    dst: str or file object
+        Path or file to write to. Records are written to stdout if no
+        dst is given.
+    """
+    writer, binary = RECORD_WRITERS[fmt]
+    if dst is None:
+        dst = sys.stdout.buffer if binary else sys.stdout
+    if hasattr(dst, "write"):
+        writer(records, dst)
+        dst.flush()
+        return
+    if binary:
+        with open(dst, "wb") as doc:
+            writer(records, doc)
+    else:
+        with open(dst, "w", encoding="utf-8") as doc:
+            writer(records, doc)
@@ -0,0 +1,322 @@
+"""Module for dump snapshots.
+
+A snapshot holds what DiffFonts needs to diff a font without the font
+binary: its glyphset, the GlyphStore arrays, names and attribs rows,
+the anchors of each mark and mkmk subtable, the kern lookups in class
+form, digests of the font's tables and its glyph order. A DSnapshot
+loaded from one stands in for the font's DFont in every category which
+doesn't render glyphs.
+
+Snapshots only store plain data: arrays, lists, dicts and strings.
+Glyphs are stored by name, or by glyph id in arrays. The glyphs,
+metrics, GDEF and anchor dump tables are rebuilt from this data once
+they are read, by the same dump functions which build them for a DFont.
+
+Snapshots are lzma compressed pickles. Only load snapshots you trust.
+"""
+import logging
+import lzma
+import os
+import pickle
+import threading
+import numpy as np
+from diffenator import __version__, DFontTable
+from diffenator.constants import SNAPSHOT_EXT
+from diffenator.dump import (
+    ClassKerning,
+    ClassKernLookup,
+    DumpAnchors,
+    dump_gdef,
+    dump_glyph_metrics,
+    dump_glyphs,
+)
+from diffenator.font import Glyph
+
+
+__all__ = ['DSnapshot', 'save_snapshot', 'match_snapshot']
+
+logger = logging.getLogger('fontdiffenator')
+
+# Version of the snapshot layout. Bump it whenever the stored data
+# changes, so older snapshots are dumped again.
+SNAPSHOT_FORMAT = 2
+
+# GlyphStore arrays stored in a snapshot
+GLYPH_STORE_FIELDS = ("glyph_order", "advance", "lsb", "bounds", "empty",
+                      "gdef_class", "area", "combining", "digests")
+
+# Dump tables stored as their rows. They don't reference glyphs.
+ROW_TABLES = ("names", "attribs")
+
+# Arrays stored for the anchors of each subtable
+ANCHOR_FIELDS = ("class", "glyph", "x", "y")
+
+# ClassKernLookup attributes stored for each kern lookup
+KERN_LOOKUP_FIELDS = ("pairs", "left_subtable", "left_class",
+                      "_right_classes", "values")
+
+# Builder of each dump table a DSnapshot has, see font.TABLE_BUILDERS
+SNAPSHOT_BUILDERS = {
+    "glyph_store": "glyph_store",
+    "glyphs": "glyphs",
+    "marks": "anchors",
+    "mkmks": "anchors",
+    "attribs": "rows",
+    "names": "rows",
+    "class_kerns": "class_kerns",
+    "metrics": "metrics",
+    "gdef_base": "gdef",
+    "gdef_mark": "gdef",
+}
+
+# DiffFonts categories which can be diffed against a snapshot
+SNAPSHOT_CATEGORIES = ("names", "attribs", "glyphs", "kerns", "metrics",
+                       "marks", "mkmks", "gdef_base", "gdef_mark")
+
+
+def _pack_rows(table):
+    return dict(table_name=table.table_name, renderable=table.renderable,
+                columns=list(table._report_columns or []),
+                rows=list(table._data))
+
+
+def _pack_anchors(groups):
+    """Anchor groups with the anchors of each subtable stored as
+    ANCHOR_FIELDS arrays, glyphs by glyph id"""
+    packed = []
+    for group in groups:
+        packed.append([])
+        for subtable in group:
+            anchors = [a for cls in subtable.values() for a in cls]
+            packed[-1].append({
+                field: np.array(
+                    [a['glyph'].index if field == 'glyph' else a[field]
+                     for a in anchors], dtype=np.int32)
+                for field in ANCHOR_FIELDS
+            })
+    return packed
+
+
+def _unpack_anchors(font, packed):
+    """Anchor groups packed by _pack_anchors, with glyphs from font"""
+    groups = []
+    for group in packed:
+        groups.append([])
+        for arrays in group:
+            subtable = {}
+            for cls, glyph_id, x, y in zip(
+                    *(arrays[field].tolist() for field in ANCHOR_FIELDS)):
+                subtable.setdefault(cls, []).append({
+                    'class': cls,
+                    'glyph': font.glyph(font.glyph_order[glyph_id]),
+                    'x': x,
+                    'y': y
+                })
+            groups[-1].append(subtable)
+    return groups
+
+
+def _pack_class_kerns(kerning):
+    return [{field: getattr(lookup, field) for field in KERN_LOOKUP_FIELDS}
+            for lookup in kerning.lookups]
+
+
+def save_snapshot(font, dst):
+    """Write a snapshot of a DFont's dump tables.
+
+    Parameters
+    ----------
+    font: DFont
+    dst: str
+        Path to write the snapshot to
+    """
+    store = font.glyph_store
+    entry = dict(
+        format=SNAPSHOT_FORMAT,
+        version=__version__,
+        name=os.path.basename(font.path or ""),
+        upm=font.upm,
+        instance_coordinates=font.instance_coordinates,
+        digests={str(tag): font.table_digest(tag)
+                 for tag in font.ttfont.keys()},
+        glyphset=[(str(g.name), [str(f) for f in g.features], g.characters,
+                   g.index) for g in font.glyphset.values()],
+        glyph_store={field: getattr(store, field)
+                     for field in GLYPH_STORE_FIELDS},
+        tables={name: _pack_rows(font._table(name)) for name in ROW_TABLES},
+        anchors=_pack_anchors(DumpAnchors(font).groups),
+        class_kerns=_pack_class_kerns(font.class_kerns),
+    )
+    data = lzma.compress(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+    with open(dst, 'wb') as doc:
+        doc.write(data)
+
+
+class SnapshotGlyphStore:
+    """GlyphStore arrays loaded from a snapshot. Has the attributes
+    listed in GLYPH_STORE_FIELDS."""
+    def __init__(self, fields):
+        for field in GLYPH_STORE_FIELDS:
+            setattr(self, field, fields[field])
+
+
+class DSnapshot:
+    """Dump tables of a font, loaded from a snapshot written by
+    save_snapshot.
+
+    Parameters
+    ----------
+    path: str
+        Path to a snapshot
+    """
+    is_variable = False
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as doc:
+            data = doc.read()
+        try:
+            entry = pickle.loads(lzma.decompress(data))
+        except lzma.LZMAError:
+            # Snapshots before format 2 were zlib compressed
+            raise ValueError("{} was written by an older diffenator, dump "
+                             "it again".format(path))
+        if entry.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError("{} was written by diffenator {}, dump it "
+                             "again".format(path, entry.get("version")))
+        self.name = entry["name"]
+        self.upm = entry["upm"]
+        self.instance_coordinates = entry["instance_coordinates"]
+        self.glyph_order = entry["glyph_store"]["glyph_order"]
+        self._digests = entry["digests"]
+        self._entry = entry
+        self._lock = threading.RLock()
+        self._tables = {"glyphset": {
+            name: Glyph(name, features, characters, self, index)
+            for name, features, characters, index in entry["glyphset"]
+        }}
+
+    def _table(self, name):
+        """Return a dump table, building it from the snapshot's data on
+        first access."""
+        if name not in self._tables:
+            if name not in SNAPSHOT_BUILDERS:
+                raise ValueError("Snapshot {} has no {} table".format(
+                    self.path, name))
+            with self._lock:
+                if name not in self._tables:
+                    builder_name = SNAPSHOT_BUILDERS[name]
+                    self._tables.update(
+                        getattr(self, "_build_" + builder_name)())
+        return self._tables[name]
+
+    def _build_glyph_store(self):
+        return {"glyph_store": SnapshotGlyphStore(self._entry["glyph_store"])}
+
+    def _build_glyphs(self):
+        return {"glyphs": dump_glyphs(self)}
+
+    def _build_metrics(self):
+        return {"metrics": dump_glyph_metrics(self)}
+
+    def _build_gdef(self):
+        gdef_base, gdef_mark = dump_gdef(self)
+        return {"gdef_base": gdef_base, "gdef_mark": gdef_mark}
+
+    def _build_anchors(self):
+        groups = _unpack_anchors(self, self._entry["anchors"])
+        anchors = DumpAnchors(self, groups)
+        return {"marks": anchors.marks_table, "mkmks": anchors.mkmks_table}
+
+    def _build_rows(self):
+        tables = {}
+        for name, packed in self._entry["tables"].items():
+            table = DFontTable(self, packed["table_name"],
+                               renderable=packed["renderable"])
+            for row in packed["rows"]:
+                table.append(row)
+            table.report_columns(packed["columns"])
+            tables[name] = table
+        return tables
+
+    def _build_class_kerns(self):
+        kerning = ClassKerning(len(self.glyph_order))
+        for fields in self._entry["class_kerns"]:
+            lookup = ClassKernLookup(0)
+            for field in KERN_LOOKUP_FIELDS:
+                setattr(lookup, field, fields[field])
+            kerning.lookups.append(lookup)
+        return {"class_kerns": kerning}
+
+    def glyph(self, name):
+        return self.glyphset[name]
+
+    def table_digest(self, tag):
+        """Digest of a font table, as returned by DFont.table_digest
+        when the snapshot was written"""
+        return self._digests.get(tag, "")
+
+    @property
+    def glyphset(self):
+        return self._table("glyphset")
+
+    @property
+    def glyph_store(self):
+        return self._table("glyph_store")
+
+    @property
+    def glyphs(self):
+        return self._table("glyphs")
+
+    @property
+    def marks(self):
+        return self._table("marks")
+
+    @property
+    def mkmks(self):
+        return self._table("mkmks")
+
+    @property
+    def attribs(self):
+        return self._table("attribs")
+
+    @property
+    def names(self):
+        return self._table("names")
+
+    @property
+    def class_kerns(self):
+        return self._table("class_kerns")
+
+    @property
+    def metrics(self):
+        return self._table("metrics")
+
+    @property
+    def gdef_base(self):
+        return self._table("gdef_base")
+
+    @property
+    def gdef_mark(self):
+        return self._table("gdef_mark")
+
+    def __repr__(self):
+        return "<DSnapshot: {}>".format(self.name)
+
+
+def match_snapshot(font_before, font_after, axes=None):
+    """Instantiate a variable font so it matches a snapshot. The VF is
+    set to the axes dict if one is given, otherwise to the coordinates
+    of the instance the snapshot was dumped from."""
+    for font, other in ((font_before, font_after), (font_after, font_before)):
+        if isinstance(font, DSnapshot) or not font.is_variable:
+            continue
+        if axes:
+            coords = {s.split('=')[0]: float(s.split('=')[1]) for s
+                      in axes.split(", ")}
+        elif isinstance(other, DSnapshot) and other.instance_coordinates:
+            coords = other.instance_coordinates
+        else:
+            raise ValueError("Include a VF instance to diff against a "
+                             "snapshot e.g -i wght=400")
+        font.set_variations(coords)
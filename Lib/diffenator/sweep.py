@@ -0,0 +1,146 @@
+"""
+Module to diff variable fonts across all their named instances.
+
+Two variable fonts are diffed at each fvar named instance of the
+before font. A variable font and a directory of static fonts are
+diffed by instantiating the variable font to match each static font.
+
+The variable fonts are parsed once. Instances are diffed over a pool
+of forked processes, which inherit the parsed fonts.
+"""
+from collections import namedtuple
+from glob import glob
+import logging
+import os
+from diffenator.font import DFont
+from diffenator.multidiff import (
+    combined_report,
+    diff_report,
+    preload,
+    run_pool
+)
+
+
+__all__ = ['InstanceDiff', 'diff_instances', 'instances_report']
+
+logger = logging.getLogger('fontdiffenator')
+
+FONT_EXTS = (".ttf", ".otf")
+
+InstanceDiff = namedtuple("InstanceDiff", ["name", "coordinates", "tables"])
+
+
+def _static_paths(path):
+    return sorted(p for p in glob(os.path.join(path, "*"))
+                  if p.lower().endswith(FONT_EXTS))
+
+
+def _sweep_jobs(font_before, font_after):
+    """Return a (name, coordinates, static_path) tuple for each
+    instance to diff"""
+    if isinstance(font_before, DFont) and isinstance(font_after, DFont):
+        if not font_before.is_variable or not font_after.is_variable:
+            raise ValueError("Diffing all instances needs two variable "
+                             "fonts, or a variable font and a directory of "
+                             "static fonts")
+        return [(name, coords, None) for name, coords in
+                font_before.instances_coordinates.items()]
+
+    vf = font_before if isinstance(font_before, DFont) else font_after
+    static_dir = font_after if vf is font_before else font_before
+    if not isinstance(vf, DFont) or not vf.is_variable:
+        raise ValueError("{} is not a variable font".format(vf))
+    paths = _static_paths(static_dir)
+    if not paths:
+        raise ValueError("No fonts found in {}".format(static_dir))
+    return [(os.path.basename(p), None, p) for p in paths]
+
+
+def _diff_instance(job, sweep):
+    """Diff a single instance using the fonts of the sweep"""
+    name, coordinates, static_path = job
+    font_before, font_after = sweep["fonts"]
+    if static_path:
+        vf = font_before if isinstance(font_before, DFont) else font_after
+        static = DFont(static_path, lazy=True,
+                       ft_load_glyph_flags=vf.ft_load_glyph_flags,
+                       cache_dir=vf.cache.path if vf.cache else None)
+        vf.set_variations_from_static(static)
+        if vf is font_before:
+            font_after = static
+        else:
+            font_before = static
+    else:
+        vf = font_before
+        font_before.set_variations(coordinates)
+        font_after.set_variations(coordinates)
+
+    _, tables = diff_report(name, font_before, font_after, sweep["settings"],
+                            sweep["limit"], sweep["r_type"])
+    return InstanceDiff(name, dict(vf.instance_coordinates), tables)
+
+
+def diff_instances(font_before, font_after, settings=None, limit=50,
+                   r_type="txt", jobs=None):
+    """Diff two fonts at every named instance.
+
+    Parameters
+    ----------
+    font_before: DFont or str
+        A variable font, or a directory of static fonts.
+    font_after: DFont or str
+        A variable font, or a directory of static fonts.
+    settings: dict
+        DiffFonts settings. If it has a render_path or spill_dir, gifs
+        and spilled rows for each instance are written to a
+        subdirectory named after it.
+    limit: int
+        Amount of rows to report for each diff table
+    r_type: str
+        Report type, either "txt", "md" or "html"
+    jobs: int
+        Amount of processes to use. Defaults to the cpu count. Instances
+        are diffed in this process if jobs is 1 or the platform can't
+        fork.
+
+    Returns
+    -------
+    list of InstanceDiff
+    """
+    sweep_jobs = _sweep_jobs(font_before, font_after)
+    preload(font_before)
+    preload(font_after)
+    sweep = dict(
+        fonts=(font_before, font_after),
+        settings=dict(settings or {}),
+        limit=limit,
+        r_type=r_type,
+    )
+    return run_pool(_diff_instance, sweep_jobs, sweep, jobs)
+
+
+def instances_report(instance_diffs, limit=50, r_type="txt", dst=None):
+    """Combine instance diffs into a single report with a section for
+    each instance.
+
+    Parameters
+    ----------
+    instance_diffs: list of InstanceDiff
+    limit: int
+        Amount of rows reported for each diff table
+    r_type: str
+        Report type, either "txt", "md" or "html"
+    dst: str
+        Path to write the report to. If no path is given, return it.
+
+    Returns
+    -------
+    str
+    """
+    sections = []
+    for instance in instance_diffs:
+        coords = ", ".join("{}={}".format(k, v) for k, v in
+                           sorted(instance.coordinates.items()))
+        sections.append(("{} ({})".format(instance.name, coords),
+                         instance.tables))
+    return combined_report(sections, limit, r_type, dst)
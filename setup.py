@@ -16,6 +16,7 @@ setup(
             "diffenator = diffenator.__main__:main",
             "fontdiffenator = diffenator.__main__:main",
             "dumper = diffenator.dumper:main",
+            "diffenator-batch = diffenator.batch:main",
         ],
     },
     install_requires=[
@@ -23,6 +24,10 @@ setup(
         "Pillow>=5.4.1",
         "pycairo>=1.18.0",
         "uharfbuzz>=0.3.0",
-        "freetype-py>=2.0.0.post6",
+        "freetype-py>=2.1.0",
+        "numpy",
     ],
+    extras_require={
+        "msgpack": ["msgpack>=1.0"],
+    },
 )
@@ -4,4 +4,8 @@ python test_diff.py
 python test_dump.py
 python test_functional.py
 python test_font.py
+python test_cache.py
 
+python test_sweep.py
+python test_batch.py
+python test_snapshot.py
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+from diffenator.batch import (
+    FontPair,
+    diff_family,
+    family_report,
+    font_paths,
+    pair_fonts
+)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        data = os.path.join(os.path.dirname(__file__), 'data')
+        self.before_dir = tempfile.mkdtemp()
+        self.after_dir = tempfile.mkdtemp()
+        for path in ('vf_test/Fahkwang-Light.ttf', 'Play-Regular.ttf'):
+            shutil.copy(os.path.join(data, path), self.before_dir)
+        for path in ('vf_test/Fahkwang-VF.ttf', 'Play-Regular.ttf',
+                     'Roboto-Regular.ttf'):
+            shutil.copy(os.path.join(data, path), self.after_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.before_dir)
+        shutil.rmtree(self.after_dir)
+
+    def _path(self, family_dir, name):
+        return os.path.join(family_dir, name)
+
+    def test_pair_fonts(self):
+        pairs, unmatched = pair_fonts(font_paths(self.before_dir),
+                                      font_paths(self.after_dir))
+        self.assertEqual(pairs, [
+            FontPair('Play-Regular.ttf',
+                     self._path(self.before_dir, 'Play-Regular.ttf'),
+                     self._path(self.after_dir, 'Play-Regular.ttf')),
+            FontPair('Fahkwang-Light.ttf',
+                     self._path(self.before_dir, 'Fahkwang-Light.ttf'),
+                     self._path(self.after_dir, 'Fahkwang-VF.ttf')),
+        ])
+        self.assertEqual(unmatched,
+                         [self._path(self.after_dir, 'Roboto-Regular.ttf')])
+
+    def test_glob_pattern(self):
+        paths = font_paths(os.path.join(self.after_dir, 'P*.ttf'))
+        self.assertEqual(paths, [self._path(self.after_dir, 'Play-Regular.ttf')])
+
+    def test_diff_family(self):
+        pairs, unmatched = pair_fonts(font_paths(self.before_dir),
+                                      font_paths(self.after_dir))
+        pair_diffs = diff_family(pairs, {"to_diff": ["names"]}, jobs=2)
+        self.assertEqual([p.name for p in pair_diffs],
+                         ['Play-Regular.ttf', 'Fahkwang-Light.ttf'])
+        play, fahkwang = pair_diffs
+        self.assertEqual(play.counts, {"names": 0})
+        self.assertEqual(play.tables, [])
+        self.assertGreater(fahkwang.counts["names"], 0)
+        self.assertNotEqual(fahkwang.tables, [])
+
+        report = family_report(pair_diffs, unmatched)
+        self.assertIn("pairs: 2", report)
+        self.assertIn("Unmatched fonts: Roboto-Regular.ttf", report)
+        self.assertIn("Fahkwang-Light.ttf (Fahkwang-Light.ttf vs "
+                      "Fahkwang-VF.ttf)", report)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from diffenator.cache import DumpCache
+from diffenator.font import DFont
+
+
+class TestDumpCache(unittest.TestCase):
+
+    def setUp(self):
+        self._path = os.path.dirname(__file__)
+        self.font_path = os.path.join(self._path, 'data', 'Play-Regular.ttf')
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache_hit(self):
+        font = DFont(self.font_path, lazy=True, cache_dir=self.cache_dir)
+        kerns = [(r['left'].name, r['right'].name, r['value']) for r in font.kerns]
+        marks = len(font.marks)
+        font.save_cache()
+
+        cached_font = DFont(self.font_path, lazy=True, cache_dir=self.cache_dir)
+        cached_font._build_kerns = cached_font._build_glyphset = None
+        cached_font._build_anchors = None
+        cached_kerns = [(r['left'].name, r['right'].name, r['value'])
+                        for r in cached_font.kerns]
+        self.assertEqual(kerns, cached_kerns)
+        self.assertEqual(marks, len(cached_font.marks))
+        self.assertIs(cached_font.kerns._font, cached_font)
+        self.assertIs(cached_font.kerns._data[0]['left'],
+                      cached_font.glyph(cached_kerns[0][0]))
+
+    def test_corrupt_table(self):
+        font = DFont(self.font_path, lazy=True, cache_dir=self.cache_dir)
+        names = font.names._data
+        font.save_cache()
+        cache = DumpCache(self.cache_dir)
+        entry = cache.load(font.cache_key)
+        entry["tables"]["names"] = entry["tables"]["names"][:20]
+        cache.save(font.cache_key, entry)
+
+        cached_font = DFont(self.font_path, lazy=True, cache_dir=self.cache_dir)
+        self.assertEqual(cached_font.names._data, names)
+        cached_font.save_cache()
+        entry = cache.load(font.cache_key)
+        self.assertGreater(len(entry["tables"]["names"]), 20)
+
+    def test_cache_key(self):
+        font_a = DFont(self.font_path, lazy=True)
+        font_b = DFont(self.font_path, lazy=True, ft_load_glyph_flags=0)
+        self.assertNotEqual(font_a.cache_key, font_b.cache_key)
+
+    def test_evict(self):
+        cache = DumpCache(self.cache_dir, max_size=0)
+        cache.save("a", {"glyphset": None, "tables": {}})
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_evict_removed_entries(self):
+        # Another process removes entries while this one evicts
+        cache = DumpCache(self.cache_dir, max_size=0)
+        cache.save("a", {"glyphset": None, "tables": {}})
+        listdir = os.listdir
+        with mock.patch("diffenator.cache.os.listdir",
+                        lambda path: listdir(path) + ["gone.dcache"]):
+            cache.evict()
+        cache = DumpCache(self.cache_dir)
+        cache.save("b", {"glyphset": None, "tables": {}})
+        with mock.patch("diffenator.cache.os.remove",
+                        side_effect=FileNotFoundError), \
+                mock.patch("diffenator.cache.os.utime",
+                           side_effect=FileNotFoundError):
+            self.assertIsNotNone(cache.load("b"))
+            cache.max_size = 0
+            cache.evict()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,16 @@
 from copy import copy
+import io
+import json
+import os
+import tempfile
 import unittest
+from unittest import mock
+from fontTools.pens.ttGlyphPen import TTGlyphPen
 from mockfont import mock_font, test_glyph
+from diffenator import DiffTable
+from diffenator.font import DFont
 from diffenator.diff import (
+    CATEGORY_DIFF_TABLES,
     DiffFonts,
     diff_nametable,
     diff_attribs,
@@ -10,12 +19,18 @@ from diffenator.diff import (
     diff_marks,
     diff_kerning,
     diff_area,
+    diff_renderings,
     _diff_images,
     diff_gdef_base,
     diff_gdef_mark,
+    _changed_keys,
 )
 import sys
 from PIL import Image
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 if sys.version_info.major == 3:
     unicode = str
 
@@ -173,6 +188,51 @@ class TestGlyphs(unittest.TestCase):
         missing = self.diff['missing']._data
         self.assertNotEqual(missing, [])
 
+    def test_render_diffs_skip_identical_outlines(self):
+        font_a = mock_font()
+        font_b = mock_font()
+        pen = TTGlyphPen(None)
+        pen.moveTo((100, 100))
+        pen.lineTo((100, 900))
+        pen.lineTo((500, 100))
+        pen.closePath()
+        font_b.ttfont['glyf']['V'] = pen.glyph()
+        font_b.recalc_tables()
+
+        with mock.patch("diffenator.diff.diff_rendering", return_value=0.5) as render:
+            diff = diff_glyphs(font_a, font_b, render_diffs=True)
+        rendered = [c[0][0].name for c in render.call_args_list]
+        self.assertEqual(rendered, ["V"])
+        self.assertEqual([r["glyph"].name for r in diff["modified"]], ["V"])
+
+    def test_changed_glyphs(self):
+        fonts = []
+        for offset in (0, 50):
+            font = mock_font()
+            pen = TTGlyphPen(font.ttfont.getGlyphSet())
+            pen.addComponent("A", (1, 0, 0, 1, 0, 0))
+            pen.addComponent("acutecomb", (1, 0, 0, 1, 0, 0))
+            font.ttfont['glyf']['Aacute'] = pen.glyph()
+            font.ttfont['glyf']['acutecomb'].coordinates.translate((offset, 0))
+            font.recalc_tables()
+            fonts.append({r['glyph'].key: r for r in font.glyphs})
+
+        changed = _changed_keys(fonts[0], fonts[1], list(fonts[0]))
+        # Composites change with their components
+        self.assertEqual(sorted(fonts[0][k]['glyph'].name for k in changed),
+                         ["Aacute", "acutecomb"])
+
+    def test_diff_renderings_jobs(self):
+        data_dir = os.path.join(os.path.dirname(__file__), 'data')
+        font_a = DFont(os.path.join(data_dir, 'Play-Regular.ttf'), lazy=True)
+        font_b = DFont(os.path.join(data_dir, 'Roboto-Regular.ttf'), lazy=True)
+        pairs = [(name, font_a.glyph(name), font_b.glyph(name))
+                 for name in ("A", "B", "O", "period", "space")]
+        serial = list(diff_renderings(pairs, jobs=1))
+        self.assertEqual([k for k, _ in serial], ["A", "B", "O", "period", "space"])
+        self.assertTrue(serial[0][1] > 0)
+        self.assertEqual(list(diff_renderings(pairs, jobs=2)), serial)
+
     def test_area(self):
         area_a = 100
         area_b = 75
@@ -240,6 +300,29 @@ class TestGlyphs(unittest.TestCase):
         img_b.putdata(img_b_px)
         self.assertEqual(_diff_images(img_a, img_b), 0.375)
 
+    def test_render_diff_tolerance(self):
+        """Antialiasing noise is ignored within the tolerance"""
+        img_a_px = [
+            255, 1,   1,   1,
+            255, 1,   255, 255,
+        ]
+        img_b_px = [
+            250, 4,   1,   1,
+            255, 1,   200, 255,
+        ]
+        img_a = Image.new('L', (4, 2))
+        img_a.putdata(img_a_px)
+        img_b = Image.new('L', (4, 2))
+        img_b.putdata(img_b_px)
+        self.assertEqual(_diff_images(img_a, img_b), 0.375)
+        self.assertEqual(_diff_images(img_a, img_b, tolerance=5), 0.125)
+
+    def test_render_diff_sizes(self):
+        """Pixels outside either image are changed"""
+        img_a = Image.new('L', (4, 4), 255)
+        img_b = Image.new('L', (2, 4), 255)
+        self.assertEqual(_diff_images(img_a, img_b), 0.5)
+
 
 class TestMarks(unittest.TestCase):
 
@@ -435,6 +518,49 @@ class TestKerns(unittest.TestCase):
         modified = diff['modified']._data
         self.assertEqual(modified, [])
 
+    def test_modified_class_kerns(self):
+        font_a = mock_font()
+        fea="""
+                @left = [A Aacute];
+                @right = [V A];
+                feature kern {
+                pos A V -30;
+                pos @left @right -120;} kern;
+            """
+        font_a.builder.addOpenTypeFeatures(fea)
+        font_a.recalc_tables()
+
+        font_b = mock_font()
+        fea="""
+                @left = [A Aacute];
+                @right = [V A];
+                feature kern {
+                pos A V -30;
+                pos @left @right -140;} kern;
+            """
+        font_b.builder.addOpenTypeFeatures(fea)
+        font_b.recalc_tables()
+        diff = diff_kerning(font_a, font_b)
+        modified = diff['modified']
+        # The A V pair kern is unchanged
+        pairs = set((r['left'].name, r['right'].name) for r in modified)
+        self.assertEqual(pairs, set([("A", "A"), ("Aacute", "V"), ("Aacute", "A")]))
+        self.assertEqual([r['diff'] for r in modified], [-20, -20, -20])
+
+        diff = diff_kerning(font_a, font_b, limit=1)
+        self.assertEqual(len(diff['modified']._data), 1)
+        self.assertEqual(diff['modified'].count, 3)
+        self.assertEqual(diff['modified'].summary,
+                         dict(min=20, max=20, mean=20))
+
+        with tempfile.TemporaryDirectory() as spill_dir:
+            diff = diff_kerning(font_a, font_b, limit=1, spill_dir=spill_dir)
+            with open(diff['modified'].spill) as doc:
+                lines = doc.read().splitlines()
+        self.assertEqual(len(diff['modified']._data), 1)
+        self.assertEqual(lines[0], "left\tright\tdiff\tstring")
+        self.assertEqual(len(lines), 4)
+
 
 class TestGDEF(unittest.TestCase):
 
@@ -510,6 +636,32 @@ class TestGDEF(unittest.TestCase):
 
 
 
+class TestDiffTable(unittest.TestCase):
+
+    def test_select(self):
+        rows = [{"glyph": str(i), "diff": i % 7} for i in range(100)]
+        expected = sorted(rows, key=lambda r: r["diff"], reverse=True)
+        table = DiffTable("glyphs modified", None, None, data=list(rows))
+        table.report_columns(["glyph", "diff"])
+        table.select(10, key=lambda r: r["diff"], reverse=True)
+        # Rows with equal keys keep their order, like a stable sort
+        self.assertEqual(table._data, expected[:10])
+        self.assertEqual(table.count, 100)
+        self.assertEqual(table.summary, dict(min=0, max=6, mean=2.95))
+
+        table = DiffTable("glyphs new", None, None)
+        table.report_columns(["glyph", "diff"])
+        with tempfile.TemporaryDirectory() as spill_dir:
+            table.select(5, spill_dir=spill_dir, rows=iter(rows))
+            with open(os.path.join(spill_dir, "glyphs_new.tsv")) as doc:
+                lines = doc.read().splitlines()
+        self.assertEqual(table._data, rows[:5])
+        self.assertEqual(table.count, 100)
+        self.assertIsNone(table.summary)
+        self.assertEqual(len(lines), 101)
+        self.assertEqual(lines[1], "0\t0")
+
+
 class TestDiffFonts(unittest.TestCase):
 
     def test_to_diff_categories(self):
@@ -527,6 +679,132 @@ class TestDiffFonts(unittest.TestCase):
         diff = DiffFonts(font_a, font_b, settings=dict(to_diff=["*", "glyphs"]))
         self.assertGreaterEqual(len(diff._data.keys()), 7)
 
+    def test_diff_jobs(self):
+        font_a = mock_font()
+        font_a.builder.setupOS2(sTypoAscender=800)
+        font_b = mock_font()
+        font_b.builder.setupOS2(sTypoAscender=1000)
+
+        reports = []
+        for settings in (dict(diff_jobs=1),
+                         dict(diff_jobs=3, diff_pool="thread"),
+                         dict(diff_jobs=3, diff_pool="process")):
+            # Rebuild every dump, so they get scheduled
+            font_a.invalidate_tables()
+            font_b.invalidate_tables()
+            diff = DiffFonts(font_a, font_b,
+                             settings=dict(to_diff=["*"], **settings))
+            reports.append((list(diff._data), diff.to_txt()))
+        self.assertIn("sTypoAscender", reports[0][1])
+        self.assertEqual(reports[1], reports[0])
+        self.assertEqual(reports[2], reports[0])
+
+    def test_diff_jobs_decompile(self):
+        # Threads only decompile the tables their dumps read, and leave
+        # glyf and hmtx to be read raw
+        data = os.path.join(os.path.dirname(__file__), 'data')
+        font_a = DFont(os.path.join(data, 'Play-Regular.ttf'), lazy=True)
+        font_b = DFont(os.path.join(data, 'Roboto-Regular.ttf'), lazy=True)
+        DiffFonts(font_a, font_b, settings=dict(to_diff=["names", "metrics"],
+                                                diff_jobs=2))
+        for tag in ("glyf", "hmtx", "GPOS"):
+            self.assertFalse(font_a.ttfont.isLoaded(tag))
+        self.assertTrue(font_a.ttfont.isLoaded("name"))
+
+    def test_skip_unchanged(self):
+        font_a = mock_font()
+        font_b = mock_font()
+        font_b.builder.setupNameTable({"familyName": "Changed"})
+        font_b.invalidate_tables("name")
+
+        self.assertTrue(font_a.table_digest("glyf"))
+        self.assertEqual(font_a.table_digest("glyf"),
+                         font_b.table_digest("glyf"))
+        self.assertIsNone(font_b.table_digest("name"))
+        self.assertEqual(font_a.table_digest("CBDT"), "")
+
+        with mock.patch("diffenator.diff.diff_glyphs") as glyphs:
+            diff = DiffFonts(font_a, font_b, settings=dict(to_diff=["*"]))
+        glyphs.assert_not_called()
+        self.assertEqual(len(diff._data["glyphs"]["modified"]), 0)
+        self.assertEqual(len(diff._data["kerns"]["new"]), 0)
+        self.assertNotEqual(diff._data["names"]["modified"]._data, [])
+
+        # Skipped categories get the tables diffing them would return
+        categories = list(CATEGORY_DIFF_TABLES)
+        skipped = DiffFonts(font_a, font_a, settings=dict(to_diff=categories))
+        diffed = DiffFonts(font_a, font_a, settings=dict(
+            to_diff=categories, skip_unchanged=False))
+
+        def shape(diff):
+            return {category: [(subtable, t.table_name, t.renderable,
+                                list(t._report_columns), t.count, t.summary)
+                               for subtable, t in tables.items()]
+                    for category, tables in diff._data.items()}
+        self.assertEqual(list(skipped._data), categories)
+        self.assertEqual(shape(skipped), shape(diffed))
+
+    def test_settings_not_shared(self):
+        font_a = mock_font()
+        font_b = mock_font()
+        diff = DiffFonts(font_a, font_b, settings=dict(
+            to_diff=["names"], rows_limit=1, skip_unchanged=False))
+        self.assertEqual(diff._settings["rows_limit"], 1)
+        diff = DiffFonts(font_a, font_b, settings=dict(to_diff=["names"]))
+        self.assertIsNone(diff._settings["rows_limit"])
+        self.assertTrue(diff._settings["skip_unchanged"])
+
+    def _missing_glyphs_diff(self):
+        font_a = mock_font()
+        font_b = mock_font()
+        font_b.builder.setupGlyphOrder([".notdef", ".null", "A"])
+        font_b.builder.setupCharacterMap({65: "A"})
+        font_b.builder.setupGlyf({".notdef": test_glyph(),
+                                  ".null": test_glyph(), "A": test_glyph()})
+        font_b.recalc_tables()
+        return DiffFonts(font_a, font_b, settings=dict(
+            to_diff=["glyphs", "names"], skip_unchanged=False))
+
+    def test_to_dict(self):
+        diff = self._missing_glyphs_diff()
+        data = diff.to_dict()
+        self.assertEqual(data["format"], 1)
+        self.assertEqual(list(data["categories"]), ["names", "glyphs"])
+        self.assertEqual(data["categories"]["names"]["new"]["rows"], [])
+
+        missing = data["categories"]["glyphs"]["missing"]
+        self.assertEqual(missing["name"], "glyphs missing")
+        self.assertEqual(missing["count"], len(missing["rows"]))
+        row = missing["rows"][0]
+        glyph = diff._data["glyphs"]["missing"]._data[0]["glyph"]
+        self.assertEqual(row["glyph"], [glyph.name, glyph.index, glyph.key])
+        self.assertNotIn("htmlfeatures", row)
+        self.assertIsInstance(row["area"], int)
+
+    def test_to_json(self):
+        diff = self._missing_glyphs_diff()
+        doc = io.StringIO()
+        diff.to_json(doc)
+        records = [json.loads(line) for line in doc.getvalue().splitlines()]
+        self.assertEqual([r["type"] for r in records[:3]],
+                         ["header", "category", "table"])
+        self.assertIsNone(records[0]["rows_limit"])
+        rows = [r["row"] for r in records if r["type"] == "row"
+                and r["table"] == "missing"]
+        self.assertEqual(
+            rows, diff.to_dict()["categories"]["glyphs"]["missing"]["rows"])
+
+    @unittest.skipUnless(msgpack, "msgpack isn't installed")
+    def test_to_msgpack(self):
+        diff = self._missing_glyphs_diff()
+        doc = io.StringIO()
+        diff.to_json(doc)
+        packed = io.BytesIO()
+        diff.to_msgpack(packed)
+        packed.seek(0)
+        self.assertEqual(list(msgpack.Unpacker(packed)),
+                         [json.loads(l) for l in doc.getvalue().splitlines()])
+
 
 if __name__ == '__main__':
     unittest.main()
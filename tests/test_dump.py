@@ -1,5 +1,9 @@
+import struct
 import unittest
+from unittest import mock
+from fontTools.ttLib.tables._g_l_y_f import Glyph
 from mockfont import mock_font, test_glyph
+from diffenator.dump import glyf_outlines, iter_kerning
 
 
 class TestGposKerningDump(unittest.TestCase):
@@ -33,6 +37,64 @@ class TestGposKerningDump(unittest.TestCase):
         font.recalc_tables()
         self.assertEqual(len(font.kerns), 4)
 
+    def test_first_subtable_wins(self):
+        font = mock_font()
+        fea="""
+            @left = [ A Aacute ];
+            @right = [ A V ];
+
+            feature kern {
+            pos A V -30;
+            pos @left @right -120;} kern;
+        """
+        font.builder.addOpenTypeFeatures(fea)
+        font.recalc_tables()
+        kerns = {(k['left'].name, k['right'].name): k['value'] for k in font.kerns}
+        self.assertEqual(len(font.kerns), 4)
+        self.assertEqual(kerns[("A", "V")], -30)
+        self.assertEqual(kerns[("Aacute", "V")], -120)
+
+    def test_lookups_add_up(self):
+        font = mock_font()
+        fea="""
+            @left = [ A Aacute ];
+            @right = [ V ];
+
+            feature kern {
+            lookup kern1 {
+                pos A V -30;
+            } kern1;
+            lookup kern2 {
+                pos @left @right -20;
+            } kern2;
+            } kern;
+        """
+        font.builder.addOpenTypeFeatures(fea)
+        font.recalc_tables()
+        kerns = {(k['left'].name, k['right'].name): k['value'] for k in font.kerns}
+        self.assertEqual(kerns[("A", "V")], -50)
+        self.assertEqual(kerns[("Aacute", "V")], -20)
+        glyph_id = font.ttfont.getGlyphID
+        self.assertEqual(font.class_kerns.value(glyph_id("A"), glyph_id("V")),
+                         -50)
+
+    def test_single_lookup_streamed(self):
+        font = mock_font()
+        fea="""
+            feature kern {
+            pos A V -140;
+            pos V A -140;} kern;
+        """
+        font.builder.addOpenTypeFeatures(fea)
+        font.recalc_tables()
+
+        def pair_kerns(table):
+            yield "A", "V", -140
+            raise AssertionError("Pairs read before the first was used")
+        with mock.patch("diffenator.dump._pair_kerns", pair_kerns):
+            kerns = iter_kerning(font.ttfont)
+            self.assertEqual(next(kerns), ("A", "V", -140))
+
     def test_class_on_class_kerns2(self):
         """TODO (M Foley) Simple groups e.g
 
@@ -93,5 +155,18 @@ class TestGDEFMarks(unittest.TestCase):
         self.assertEqual(len(font.gdef_base), 2)
 
 
+class TestGlyfOutlines(unittest.TestCase):
+
+    def test_empty_compiled_glyph(self):
+        font = mock_font()
+        glyf = font.ttfont['glyf']
+        glyf.glyphs['V'] = Glyph(struct.pack(">hhhhh", 0, 0, 0, 0, 0))
+        outlines = glyf_outlines(font.ttfont)
+        glyph_id = font.ttfont.getGlyphID('V')
+        self.assertNotIn(glyph_id, outlines.owners)
+        self.assertNotIn(glyph_id, outlines.composites)
+        self.assertIn(font.ttfont.getGlyphID('A'), outlines.owners)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
+import tempfile
+import time
 import unittest
+from unittest import mock
+from fontTools.feaLib.builder import addOpenTypeFeaturesFromString
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib import TTFont
+from diffenator.cache import BitmapCache, BITMAP_ENTRY_OVERHEAD
 from diffenator.constants import FTHintMode
+from diffenator.dump import glyf_areas, glyph_area
+from diffenator.hbinput import (
+    build_gsub_index,
+    build_lookup_features,
+    build_context_index
+)
 from diffenator.font import (
     DFont,
+    GlyphStore,
+    InputGenerator,
     find_token,
     WIDTH_NAME_TO_FVAR,
     WEIGHT_NAME_TO_FVAR
@@ -38,6 +55,245 @@ class TestFont(unittest.TestCase):
 
         self.assertNotEqual(unhinted_bitmap.buffer, hinted_bitmap.buffer)
 
+    def test_ft_hint_mode_flags(self):
+        from freetype import raw
+        self.assertEqual(FTHintMode.NORMAL,
+                         raw.FT_LOAD_TARGET_NORMAL | raw.FT_LOAD_RENDER)
+        self.assertEqual(FTHintMode.UNHINTED,
+                         raw.FT_LOAD_NO_HINTING | raw.FT_LOAD_RENDER)
+        self.assertEqual(FTHintMode.LIGHT,
+                         raw.FT_LOAD_TARGET_LIGHT | raw.FT_LOAD_RENDER)
+
+    def test_lazy_tables(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        self.assertEqual(font._tables, {})
+
+        font.names
+        self.assertEqual(set(font._tables), {"names"})
+
+        font.kerns
+        self.assertIn("glyphset", font._tables)
+        self.assertNotIn("glyphs", font._tables)
+
+    def test_tables_built_once_across_threads(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        build_names = font._build_names
+
+        def slow_build():
+            time.sleep(0.05)
+            return build_names()
+
+        with mock.patch.object(font, "_build_names",
+                               side_effect=slow_build) as build, \
+                ThreadPoolExecutor(4) as pool:
+            tables = list(pool.map(lambda _: font.names, range(4)))
+        self.assertEqual(build.call_count, 1)
+        self.assertTrue(all(t is tables[0] for t in tables))
+
+        with ThreadPoolExecutor(4) as pool:
+            combining = list(pool.map(
+                lambda _: font.glyph_store.combining, range(4)))
+        self.assertTrue(all(c is combining[0] for c in combining))
+
+    def test_invalidate_tables(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        font = DFont(font_path)
+        font.invalidate_tables("GPOS")
+        for name in ("kerns", "marks", "mkmks"):
+            self.assertNotIn(name, font._tables)
+        for name in ("glyphset", "names", "glyphs", "metrics"):
+            self.assertIn(name, font._tables)
+
+        font.invalidate_tables("cmap")
+        self.assertEqual(set(font._tables), {"names", "attribs"})
+
+    def test_set_variations(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'vf_test',
+                                 'Fahkwang-VF.ttf')
+        font = DFont(font_path, lazy=True)
+        glyphset = font.glyphset
+
+        font.set_variations({"wght": 700})
+        self.assertIs(font.glyphset, glyphset)
+        self.assertNotIn("fvar", font.ttfont)
+        self.assertEqual(font.ttfont["OS/2"].usWeightClass, 700)
+        self.assertEqual(font.instance_coordinates["wght"], 700)
+
+        # Names don't vary once the VF is instantiated
+        names = font.names
+        font.set_variations({"wght": 400})
+        self.assertIs(font.names, names)
+
+    def test_gsub_index(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        index = build_gsub_index(TTFont(font_path))
+        # Ligature
+        self.assertEqual(index['uni03020300'], [(4, ('uni0302', 'gravecomb'))])
+        # Single and alternate substitutions
+        self.assertEqual(index['kgreenlandic.smcp'],
+                         [(1, ('kgreenlandic',)), (26, ('kgreenlandic',))])
+        self.assertNotIn('kgreenlandic', index)
+
+    def test_inputs_prefer_real_features(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        # aalt also reaches kgreenlandic.smcp
+        glyph = font.glyph('kgreenlandic.smcp')
+        self.assertEqual(glyph.features, ('smcp',))
+        self.assertEqual(glyph.characters, '\u0138')
+
+    def test_gsub_context_index(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        ttfont = TTFont(font_path)
+        lookup_features = build_lookup_features(ttfont)
+        self.assertEqual(lookup_features[25], ['c2sc'])
+        self.assertNotIn(33, lookup_features)
+
+        # Lookup 33 is only called by chaining rules
+        context_index, _ = build_context_index(ttfont)
+        self.assertEqual(set((e[0], e[1]) for e in context_index[33]),
+                         {(2, (6, 3)), (3, (6, 3))})
+
+    def test_glyph_inputs(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        inputs = InputGenerator(font).inputs
+        self.assertEqual(inputs['A'], ((), 'A'))
+        self.assertEqual(inputs['zero.dnom'], (('dnom',), '0'))
+        self.assertEqual(inputs['uni03020300'], (('ccmp',), '\u0302\u0300'))
+
+    def test_glyph_inputs_deep_chain(self):
+        # Each glyph in the chain is only reachable from the one before
+        # it, deeper than the recursion limit allows to follow
+        depth = 500
+        names = [".notdef", "a"] + ["a.%d" % i for i in range(depth)]
+        fb = FontBuilder(1000, isTTF=True)
+        fb.setupGlyphOrder(names)
+        fb.setupCharacterMap({ord("a"): "a"})
+        glyph = TTGlyphPen(None).glyph()
+        fb.setupGlyf({n: glyph for n in names})
+        fb.setupHorizontalMetrics({n: (500, 0) for n in names})
+        fb.setupHorizontalHeader()
+        fb.setupNameTable({"familyName": "Chain", "styleName": "Regular"})
+        fb.setupOS2()
+        fb.setupPost()
+        lookups = []
+        for i in range(depth):
+            lookups.append("lookup chain%d { sub %s by a.%d; } chain%d;" % (
+                i, names[i + 1], i, i))
+        addOpenTypeFeaturesFromString(fb.font, "feature ss01 {\n%s\n} ss01;" % (
+            "\n".join(lookups)))
+        with tempfile.TemporaryDirectory() as font_dir:
+            font_path = os.path.join(font_dir, "Chain-Regular.ttf")
+            fb.save(font_path)
+            glyphs = InputGenerator(DFont(font_path, lazy=True)).all_inputs()
+        last = glyphs[-1]
+        self.assertEqual(last.name, "a.%d" % (depth - 1))
+        self.assertEqual(last.characters, "a")
+        self.assertEqual(len(last.features), depth)
+
+    def test_glyph_store(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        store = font.glyph_store
+        ttfont = font.ttfont
+        gid = ttfont.getGlyphID('A')
+        self.assertEqual(store.advance[gid], ttfont['hmtx']['A'][0])
+        glyph = ttfont['glyf']['A']
+        self.assertEqual(store.bounds[gid].tolist(),
+                         [glyph.xMin, glyph.yMin, glyph.xMax, glyph.yMax])
+        self.assertTrue(store.empty[ttfont.getGlyphID('space')])
+        self.assertEqual(store.gdef_class[gid], 1)
+
+        self.assertEqual(font.glyph('A').width, store.advance[gid])
+        self.assertTrue(font.glyph('gravecomb').combining)
+        self.assertFalse(font.glyph('A').combining)
+        with self.assertRaises(AttributeError):
+            font.glyph('A').foo = 1
+
+    def test_glyph_store_raw_tables(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Roboto-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        store = font.glyph_store
+        # Read from the table data, without decompiling the tables
+        for tag in ("hmtx", "loca", "glyf"):
+            self.assertFalse(font.ttfont.isLoaded(tag))
+        for tag in ("hmtx", "glyf"):
+            font.ttfont[tag]
+        decompiled = GlyphStore(font)
+        for attr in ("advance", "lsb", "bounds", "empty"):
+            self.assertEqual(getattr(store, attr).tolist(),
+                             getattr(decompiled, attr).tolist())
+
+    def test_glyf_areas(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        ttfont = TTFont(font_path)
+        areas = glyf_areas(ttfont)
+        glyphset = ttfont.getGlyphSet()
+        for name in ('A', 'O', 'space', 'Aacute', 'Oslash'):
+            gid = ttfont.getGlyphID(name)
+            self.assertAlmostEqual(areas[gid], glyph_area(glyphset, name), delta=1)
+        # Decompiled glyphs give the same areas as compiled ones
+        for name in ttfont.getGlyphOrder():
+            ttfont['glyf'][name].expand(ttfont['glyf'])
+        self.assertEqual(glyf_areas(ttfont).tolist(), areas.tolist())
+
+    def test_ft_bitmap_array(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        gid = font.ttfont.getGlyphID('A')
+        pixels = font.glyph_bitmap(gid)
+        bitmap = font.ftslot.bitmap
+        self.assertEqual(pixels.shape, (bitmap.rows, bitmap.width))
+        self.assertEqual(pixels.ravel().tolist(), bitmap.buffer)
+        # The array is a view of the glyph slot's buffer
+        self.assertFalse(pixels.flags.owndata)
+
+        # Mono bitmaps are unpacked to 0 or 255
+        font.ft_load_glyph_flags = FTHintMode.UNHINTED | 0x20000
+        pixels = font.glyph_bitmap(gid)
+        self.assertEqual(font.ftslot.bitmap.pixel_mode, 1)
+        self.assertEqual(set(pixels.ravel().tolist()), set([0, 255]))
+
+    def test_render_glyph_cache(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data', 'Play-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        gid_a = font.ttfont.getGlyphID('A')
+        gid_v = font.ttfont.getGlyphID('V')
+        bitmap = font.render_glyph(gid_a)
+        self.assertEqual(bitmap.pixels.tolist(), font.glyph_bitmap(gid_a).tolist())
+        self.assertEqual(bitmap.left, font.ftslot.bitmap_left)
+        self.assertEqual(bitmap.top, font.ftslot.bitmap_top)
+
+        # Rendering other glyphs doesn't overwrite cached bitmaps
+        font.render_glyph(gid_v)
+        self.assertIs(font.render_glyph(gid_a), bitmap)
+        self.assertEqual(bitmap.pixels.tolist(), font.glyph_bitmap(gid_a).tolist())
+        self.assertEqual((font.bitmaps.hits, font.bitmaps.misses), (1, 2))
+
+        # Other sizes and hinting modes are cached separately
+        self.assertIsNot(font.render_glyph(gid_a, 750), bitmap)
+        font.ft_load_glyph_flags = FTHintMode.LIGHT
+        self.assertIsNot(font.render_glyph(gid_a), bitmap)
+        self.assertEqual(font.bitmaps.misses, 4)
+
+    def test_bitmap_cache_eviction(self):
+        cache = BitmapCache(max_size=3 * (100 + BITMAP_ENTRY_OVERHEAD))
+        for key in range(3):
+            cache.put(key, key, 100)
+        cache.get(0)
+        cache.put(3, 3, 100)
+        # 1 was the least recently used
+        self.assertIsNone(cache.get(1))
+        self.assertEqual([cache.get(k) for k in (0, 2, 3)], [0, 2, 3])
+        self.assertEqual(cache.size, 3 * (100 + BITMAP_ENTRY_OVERHEAD))
+        # Bitmaps bigger than the whole cache aren't stored
+        cache.put(4, 4, cache.max_size)
+        self.assertIsNone(cache.get(4))
+        self.assertEqual(len(cache), 3)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -12,6 +12,8 @@ paths = ['path/to/font_a', 'path/to/font_b']
 This test is slow and should be run on challenging fonts.
 """
 from diffenator import CHOICES
+from diffenator.__main__ import add_diff_arguments, diff_options, OUTPUT_LINES
+import argparse
 from itertools import permutations
 import subprocess
 from glob import glob
@@ -19,6 +21,20 @@ import os
 import unittest
 import tempfile
 import shutil
+import sys
+
+
+# Time allowed for importing the CLI entry points, as a multiple of the
+# time fontTools.ttLib takes to import in the same process, so a slow
+# or busy machine slows both alike. The CLIs currently take ~3x as long.
+CLI_IMPORT_BUDGET = 8
+
+# Modules which are only imported once an image is rendered, an
+# instance sweep is run or a snapshot is read
+DEFERRED_MODULES = ('cairo', 'PIL', 'freetype', 'uharfbuzz',
+                    'diffenator.snapshot', 'diffenator.sweep',
+                    'diffenator.multidiff')
+
 
 class TestFunctionality(unittest.TestCase):
 
@@ -84,6 +100,42 @@ class TestFunctionality(unittest.TestCase):
             ])
             self.assertNotEqual(cmd, None)
 
+    def test_output_lines(self):
+        """--json and --msgpack keep every row unless -ol is given"""
+        parser = argparse.ArgumentParser()
+        formatter_group = add_diff_arguments(parser)
+        formatter_group.add_argument('--json', nargs='?', const='-')
+        for options, rows_limit in (([], OUTPUT_LINES),
+                                    (["--json"], None),
+                                    (["--json", "-ol", "10"], 10),
+                                    (["-ol", "10"], 10)):
+            args = parser.parse_args(options)
+            self.assertEqual(diff_options(args)["rows_limit"], rows_limit)
+
+    def test_cli_startup(self):
+        """The CLIs must not import the rendering stack, the sweep or
+        snapshots at startup, and must import within CLI_IMPORT_BUDGET"""
+        script = (
+            "import sys, time\n"
+            "start = time.time()\n"
+            "import fontTools.ttLib\n"
+            "baseline = time.time() - start\n"
+            "start = time.time()\n"
+            "import diffenator.__main__, diffenator.dumper\n"
+            "print((time.time() - start) / baseline)\n"
+            "for mod in {}:\n"
+            "    if mod in sys.modules:\n"
+            "        print(mod)\n"
+        ).format(DEFERRED_MODULES)
+        ratios = []
+        # Best of three runs
+        for _ in range(3):
+            output = subprocess.check_output([sys.executable, "-c", script])
+            lines = output.decode("utf-8").split()
+            self.assertEqual(lines[1:], [])
+            ratios.append(float(lines[0]))
+        self.assertLess(min(ratios), CLI_IMPORT_BUDGET)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+from mockfont import mock_font
+from diffenator.diff import DiffFonts
+from diffenator.snapshot import DSnapshot, save_snapshot, match_snapshot
+from diffenator.font import DFont
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.font_a = mock_font()
+        self.font_a.builder.setupOS2(sTypoAscender=800)
+        self.font_b = mock_font()
+        self.font_b.builder.setupOS2(sTypoAscender=1000)
+        self.font_b.invalidate_tables()
+        fd, self.path = tempfile.mkstemp(suffix=".dsnap")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _report(self, font_before, font_after, **settings):
+        diff = DiffFonts(font_before, font_after,
+                         dict(to_diff=["*"], **settings))
+        return list(diff._data), diff.to_txt()
+
+    def test_load_snapshot(self):
+        save_snapshot(self.font_a, self.path)
+        snapshot = DSnapshot(self.path)
+        self.assertEqual(snapshot.upm, self.font_a.upm)
+        self.assertEqual(list(snapshot.glyphset), list(self.font_a.glyphset))
+        # Tables are unpacked once they are read
+        self.assertNotIn("names", snapshot._tables)
+        self.assertEqual(snapshot.names._data, self.font_a.names._data)
+        glyph = snapshot.glyph("A")
+        self.assertEqual(glyph.index, self.font_a.glyph("A").index)
+        self.assertEqual(glyph.width, self.font_a.glyph("A").width)
+
+    def test_skip_unchanged_snapshot(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data',
+                                 'Play-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        save_snapshot(font, self.path)
+        snapshot = DSnapshot(self.path)
+        self.assertEqual(snapshot.table_digest("glyf"),
+                         font.table_digest("glyf"))
+        self.assertEqual(snapshot.glyph_order, font.glyph_order)
+        diff = DiffFonts(snapshot, DFont(font_path, lazy=True))
+        self.assertTrue(diff.unchanged("glyphs"))
+        self.assertEqual(len(diff._data["marks"]["new"]), 0)
+        self.assertNotIn("glyphs", snapshot._tables)
+
+    def test_snapshot_size(self):
+        font_path = os.path.join(os.path.dirname(__file__), 'data',
+                                 'Roboto-Regular.ttf')
+        font = DFont(font_path, lazy=True)
+        save_snapshot(font, self.path)
+        self.assertLess(os.path.getsize(self.path),
+                        os.path.getsize(font_path) / 3)
+        snapshot = DSnapshot(self.path)
+
+        def anchors(table):
+            return [(r['base_glyph'].name, r['base_x'], r['base_y'],
+                     r['mark_glyph'].name, r['mark_x'], r['mark_y'])
+                    for r in table._data]
+        self.assertEqual(anchors(snapshot.marks), anchors(font.marks))
+        self.assertEqual(anchors(snapshot.mkmks), anchors(font.mkmks))
+
+    def test_diff_snapshot(self):
+        save_snapshot(self.font_a, self.path)
+        categories, report = self._report(self.font_a, self.font_b)
+        categories.remove("cbdt")
+        self.assertIn("sTypoAscender", report)
+        for settings in (dict(), dict(diff_jobs=3), dict(render_diffs=True)):
+            self.assertEqual(
+                self._report(DSnapshot(self.path), self.font_b, **settings),
+                (categories, report)
+            )
+
+    def test_match_snapshot(self):
+        vf_path = os.path.join(os.path.dirname(__file__), 'data',
+                               'vf_test', 'Fahkwang-VF.ttf')
+        vf = DFont(vf_path, lazy=True)
+        vf.set_variations({"wght": 300, "ital": 0})
+        save_snapshot(vf, self.path)
+
+        vf = DFont(vf_path, lazy=True)
+        match_snapshot(DSnapshot(self.path), vf)
+        self.assertEqual(vf.instance_coordinates, {"wght": 300, "ital": 0})
+        # Snapshots of static fonts don't have coordinates
+        save_snapshot(self.font_a, self.path)
+        with self.assertRaises(ValueError):
+            match_snapshot(DSnapshot(self.path), DFont(vf_path, lazy=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
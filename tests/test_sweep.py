@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+from diffenator.font import DFont
+from diffenator.sweep import diff_instances, instances_report
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self._path = os.path.join(os.path.dirname(__file__), 'data', 'vf_test')
+        self.vf_path = os.path.join(self._path, 'Fahkwang-VF.ttf')
+
+    def test_diff_vf_instances(self):
+        font_before = DFont(self.vf_path, lazy=True)
+        font_after = DFont(self.vf_path, lazy=True)
+        instance_diffs = diff_instances(font_before, font_after,
+                                        {"to_diff": ["names"]}, jobs=2)
+        self.assertEqual([i.name for i in instance_diffs],
+                         list(font_before.instances_coordinates))
+        for instance in instance_diffs:
+            self.assertEqual(instance.tables, [])
+        report = instances_report(instance_diffs)
+        self.assertIn("Bold (ital=0.0, wght=700.0)", report)
+
+    def test_diff_static_dir(self):
+        static_dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(self._path, 'Fahkwang-Light.ttf'), static_dir)
+        try:
+            vf = DFont(self.vf_path, lazy=True)
+            instance_diffs = diff_instances(vf, static_dir,
+                                            {"to_diff": ["names"]}, jobs=1)
+        finally:
+            shutil.rmtree(static_dir)
+        self.assertEqual(len(instance_diffs), 1)
+        self.assertEqual(instance_diffs[0].name, 'Fahkwang-Light.ttf')
+        self.assertNotEqual(instance_diffs[0].tables, [])
+
+    def test_not_variable(self):
+        static = DFont(os.path.join(self._path, 'Fahkwang-Light.ttf'), lazy=True)
+        with self.assertRaises(ValueError):
+            diff_instances(static, static)
+
+
+if __name__ == "__main__":
+    unittest.main()